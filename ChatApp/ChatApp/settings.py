@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.instrumentation.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,11 +77,68 @@ ASGI_APPLICATION = "ChatApp.asgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+#
+# CHAT_DB_PROFILE picks the database: "sqlite" (default) or "postgres".
+# Consumers run their queries on CHAT_DB_THREADS threads (see chat/db.py),
+# each of which keeps its connection open between calls.
+
+CHAT_DB_PROFILE = os.environ.get('CHAT_DB_PROFILE', 'sqlite')
+CHAT_DB_THREADS = int(os.environ.get('CHAT_DB_THREADS', 4))
+
+if CHAT_DB_PROFILE == 'postgres':
+    # Needs psycopg[pool]. Pooled connections replace persistent ones, so
+    # CONN_MAX_AGE stays 0; the pool covers the consumer threads plus the
+    # threads serving HTTP views.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'chatapp'),
+            'USER': os.environ.get('POSTGRES_USER', 'chatapp'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'OPTIONS': {
+                'pool': {'min_size': 2, 'max_size': CHAT_DB_THREADS + 4, 'timeout': 10},
+            },
+        }
     }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': None,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                # Take the write lock when a transaction starts, a deferred
+                # transaction that upgrades later fails at once instead of waiting
+                'transaction_mode': 'IMMEDIATE',
+            },
+        },
+        # The per room/conversation sequence counters (chat/sequences.py) are
+        # bumped before every message is broadcast. In their own file that
+        # doesn't wait on the write lock held by message inserts. Create it
+        # with: manage.py migrate --run-syncdb --database sequences
+        'sequences': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'sequences.sqlite3',
+            'CONN_MAX_AGE': None,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
+        },
+    }
+
+DATABASE_ROUTERS = ['chat.routers.SequenceRouter']
+
+# Applied to every new SQLite connection by chat/signals.py. The journal mode
+# is kept in the database file instead, `manage.py prepare_sqlite` sets it:
+# WAL lets the consumer threads and worker processes read while one of them
+# writes.
+CHAT_SQLITE_JOURNAL_MODE = 'WAL'
+CHAT_SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 20000,
 }
 
 
@@ -120,12 +179,104 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Shared between the worker processes started by `manage.py runworkers`
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        'BACKEND': 'chat.layers.UnixSocketChannelLayer',
+        'CONFIG': {
+            'path': '/tmp/chatapp-channels',
+            'capacity': 100,
+            'group_expiry': 86400,
+        },
     }
 }
 
+# Number of messages sent on connect and per "load older" request
+CHAT_HISTORY_PAGE_SIZE = 50
+
+# New messages are buffered and written with bulk_create once this many are
+# waiting or after this many seconds, whichever comes first. Rows that fail
+# to insert are retried every CHAT_WRITE_RETRY_INTERVAL seconds
+CHAT_WRITE_BATCH_SIZE = 100
+CHAT_WRITE_FLUSH_INTERVAL = 0.05
+CHAT_WRITE_RETRY_INTERVAL = 1.0
+
+# Newest messages kept in memory per room/conversation with a local
+# subscriber, and the cap on messages held across all of them
+CHAT_HOT_HISTORY_PER_ROOM = 200
+CHAT_HOT_HISTORY_MAX_MESSAGES = 50000
+
+# `manage.py archive_messages` moves messages older than this many days into
+# the archive tables, this many rows per transaction
+CHAT_ARCHIVE_AFTER_DAYS = 30
+CHAT_ARCHIVE_BATCH_SIZE = 1000
+
+# Conversations per page of the DM sidebar
+CHAT_CONVERSATION_PAGE_SIZE = 20
+
+# Read cursors are written at most once per this many seconds, and each room
+# or conversation gets at most one read_receipts frame per the second interval
+CHAT_READ_FLUSH_INTERVAL = 1.0
+CHAT_READ_RECEIPT_INTERVAL = 2.0
+
+# Results per page of the message search endpoint
+CHAT_SEARCH_PAGE_SIZE = 20
+
+# Per connection flow control (see chat/flow.py): largest frame accepted,
+# frames a second per user and room/conversation with the burst allowed,
+# and frames queued for a client before it is disconnected as too slow, or
+# under daphne, bytes written that the client hasn't read yet
+CHAT_MAX_FRAME_BYTES = 8192
+CHAT_RATE_LIMIT = 5
+CHAT_RATE_BURST = 20
+CHAT_SEND_QUEUE_SIZE = 256
+CHAT_SEND_BUFFER_BYTES = 1024 * 1024
+
+# Presence (see chat/presence.py): changes are sent once per tick, snapshots
+# every interval; users are dropped after the TTL without a heartbeat and
+# typing indicators after the typing TTL
+CHAT_PRESENCE_TICK = 1.0
+CHAT_PRESENCE_SNAPSHOT_INTERVAL = 20
+CHAT_PRESENCE_TTL = 60
+CHAT_TYPING_TTL = 5
+
+# Requests and WebSocket events costing more than this are logged as
+# warnings by chat/instrumentation.py. CHAT_BUDGETS overrides it per name,
+# e.g. {"http GET chat:room": {"queries": 8}}. Hops are calls handed to the
+# database thread pool.
+CHAT_BUDGET = {'queries': 20, 'db_ms': 100, 'wall_ms': 500, 'hops': 3}
+CHAT_BUDGETS = {}
+
+# Reconnecting clients get only what changed (see chat/resume.py) unless more
+# messages than this are new; deleted ids are kept this many days for them
+CHAT_RESUME_MAX_MESSAGES = 50
+CHAT_TOMBSTONE_DAYS = 7
+
+# Client message ids remembered per process to drop retried messages (see
+# chat/idempotency.py)
+CHAT_RECENT_CLIENT_IDS = 10000
+
+# Metrics (see chat/metrics.py): each worker publishes its registry to the
+# directory every interval for /chat/metrics/ to merge. Besides staff, the
+# endpoint answers requests with "Authorization: Bearer <CHAT_METRICS_TOKEN>"
+CHAT_METRICS_DIR = None  # a chatapp-metrics directory in the temp dir
+CHAT_METRICS_INTERVAL = 5
+CHAT_METRICS_TOKEN = os.environ.get('CHAT_METRICS_TOKEN')
+
+# Seconds a consumer trusts its cached lookup of a user by username (see
+# chat/access.py); saving or deleting the user drops it sooner in its process
+CHAT_USER_CACHE_TTL = 30
+
+# Seconds a WebSocket connect trusts the cached user of its session cookie
+# (see chat/auth.py); logging out or saving the user drops it sooner in its
+# process
+CHAT_AUTH_CACHE_TTL = 10
+
+# Usernames returned by the autocomplete endpoint, and how long each prefix's
+# results are cached
+USER_AUTOCOMPLETE_LIMIT = 10
+USER_AUTOCOMPLETE_TTL = 10
+
 LOGIN_REDIRECT_URL = 'users:dashboard'
 LOGOUT_REDIRECT_URL = 'users:dashboard'
 
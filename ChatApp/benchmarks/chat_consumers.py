@@ -0,0 +1,102 @@
+# benchmarks/chat_consumers.py
+#
+# Runs the chat workload (see workload.py) against the consumers in this
+# process through channels.testing.WebsocketCommunicator, with the full ASGI
+# stack from ChatApp/asgi.py, a throwaway SQLite database and the configured
+# channel layer. No server or network is involved, so this isolates the cost
+# of consumers.py and what it calls.
+#
+#   python benchmarks/chat_consumers.py --users 200 --rooms 10 --output before.json
+import argparse
+import asyncio
+import io
+import os
+import sys
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import workload
+
+
+def setup_django(tmp, layer):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatApp.settings')
+    import django
+    from django.conf import settings
+
+    settings.DATABASES['default']['NAME'] = os.path.join(tmp, 'bench.sqlite3')
+    if 'sequences' in settings.DATABASES:
+        settings.DATABASES['sequences']['NAME'] = os.path.join(tmp, 'sequences.sqlite3')
+    # Build the tables straight from the models, migrations aren't in the repo
+    settings.MIGRATION_MODULES = {'chat': None, 'users': None}
+    settings.ALLOWED_HOSTS = ['localhost']
+    if layer == 'memory':
+        settings.CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+    elif settings.CHANNEL_LAYERS['default'].get('BACKEND') == 'chat.layers.UnixSocketChannelLayer':
+        settings.CHANNEL_LAYERS['default'].setdefault('CONFIG', {})['path'] = os.path.join(tmp, 'channels')
+    django.setup()
+
+    from django.core.management import call_command
+    for alias in settings.DATABASES:
+        call_command('migrate', run_syncdb=True, database=alias, verbosity=0)
+    call_command('prepare_sqlite', stdout=io.StringIO())
+
+
+class Client:
+    def __init__(self, communicator):
+        self.communicator = communicator
+
+    async def send(self, frame):
+        await self.communicator.send_json_to(frame)
+
+    async def receive(self):
+        while True:
+            try:
+                message = await self.communicator.receive_output(timeout=3600)
+            except asyncio.TimeoutError:
+                continue
+            if message['type'] == 'websocket.close':
+                return None
+            return workload.json.loads(message['text'])
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+async def main(args):
+    from asgiref.sync import sync_to_async
+    from channels.testing import WebsocketCommunicator
+
+    from ChatApp.asgi import application
+
+    plan = workload.plan_from(args)
+    sessions = await sync_to_async(workload.seed)(plan)
+
+    async def connect(username):
+        communicator = WebsocketCommunicator(application, workload.STREAM_PATH, headers=[
+            (b'host', b'localhost'),
+            (b'origin', b'http://localhost'),
+            (b'cookie', f'sessionid={sessions[username]}'.encode()),
+        ])
+        connected, _ = await communicator.connect(timeout=args.timeout)
+        if not connected:
+            raise RuntimeError(f"{username} was refused")
+        return Client(communicator)
+
+    results = await workload.run_from(args, plan, connect)
+    results["benchmark"] = "chat_consumers"
+    results["config"]["layer"] = args.layer
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    workload.add_arguments(parser)
+    parser.add_argument('--layer', choices=['configured', 'memory'], default='configured',
+                        help="channel layer from settings, or InMemoryChannelLayer")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_django(tmp, args.layer)
+        workload.write(args, asyncio.run(main(args)))
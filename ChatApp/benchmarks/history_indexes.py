@@ -0,0 +1,185 @@
+# benchmarks/history_indexes.py
+#
+# Seeds a throwaway SQLite database with the chat tables and times the room and
+# direct message history queries: with only the original foreign key indexes,
+# with only the (room|conversation, seq) indexes, and with the seq indexes plus
+# the (room|conversation, timestamp, id) indexes the retention cutoff is
+# looked up on.
+#
+# Pro users have no cutoff, basic users see the last day. The quiet room and
+# conversation had nothing sent in the last month, the worst case for a
+# cutoff checked row by row on the seq index.
+#
+#   python benchmarks/history_indexes.py --rows 1000000
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+SCHEMA = """
+CREATE TABLE users_user (id integer PRIMARY KEY AUTOINCREMENT, username varchar(150) NOT NULL UNIQUE);
+CREATE TABLE chat_room (id integer PRIMARY KEY AUTOINCREMENT, name varchar(100) NOT NULL UNIQUE);
+CREATE TABLE chat_message (
+    id integer PRIMARY KEY AUTOINCREMENT, username varchar(100) NOT NULL, message text NOT NULL,
+    timestamp datetime NOT NULL, room_id bigint NOT NULL REFERENCES chat_room (id), seq bigint NULL
+);
+CREATE INDEX chat_message_room_id ON chat_message (room_id);
+CREATE TABLE chat_directmessage (
+    id integer PRIMARY KEY AUTOINCREMENT, message text NOT NULL, timestamp datetime NOT NULL,
+    receiver_id bigint NOT NULL REFERENCES users_user (id), sender_id bigint NOT NULL REFERENCES users_user (id),
+    conversation varchar(41) NOT NULL, seq bigint NULL
+);
+CREATE INDEX chat_directmessage_receiver_id ON chat_directmessage (receiver_id);
+CREATE INDEX chat_directmessage_sender_id ON chat_directmessage (sender_id);
+"""
+
+SEQ_INDEXES = """
+CREATE INDEX chat_message_room_seq_idx ON chat_message (room_id, seq);
+CREATE INDEX chat_dm_conversation_seq_idx ON chat_directmessage (conversation, seq);
+"""
+
+TIMESTAMP_INDEXES = """
+CREATE INDEX chat_message_room_ts_idx ON chat_message (room_id, timestamp, id);
+CREATE INDEX chat_dm_conversation_ts_idx ON chat_directmessage (conversation, timestamp, id);
+"""
+
+# What history.paginate_seq() sends, with and without the cutoff as a seq bound
+ROOM_PAGE = """
+SELECT id, username, message, timestamp, seq FROM chat_message
+WHERE room_id = ? AND timestamp >= ?
+ORDER BY seq DESC LIMIT 51
+"""
+
+ROOM_PAGE_BOUND = """
+SELECT id, username, message, timestamp, seq FROM chat_message
+WHERE room_id = ? AND timestamp >= ? AND seq >= (
+    SELECT seq FROM chat_message WHERE room_id = ? AND timestamp >= ? ORDER BY timestamp, id LIMIT 1
+)
+ORDER BY seq DESC LIMIT 51
+"""
+
+DM_PAGE = """
+SELECT d.id, u.username, d.message, d.timestamp, d.seq FROM chat_directmessage d
+INNER JOIN users_user u ON (d.sender_id = u.id)
+WHERE d.conversation = ? AND d.timestamp >= ?
+ORDER BY d.seq DESC LIMIT 51
+"""
+
+DM_PAGE_BOUND = """
+SELECT d.id, u.username, d.message, d.timestamp, d.seq FROM chat_directmessage d
+INNER JOIN users_user u ON (d.sender_id = u.id)
+WHERE d.conversation = ? AND d.timestamp >= ? AND d.seq >= (
+    SELECT seq FROM chat_directmessage WHERE conversation = ? AND timestamp >= ? ORDER BY timestamp, id LIMIT 1
+)
+ORDER BY d.seq DESC LIMIT 51
+"""
+
+START = datetime(2024, 1, 1)
+DAYS = 365
+
+
+def seed(db, rows, users, rooms):
+    step = timedelta(days=DAYS) / rows
+    quiet_after = rows - rows * 30 // DAYS  # the quiet room and conversation stop here
+
+    db.executemany("INSERT INTO users_user (username) VALUES (?)", [(f"user{i}",) for i in range(users)])
+    db.executemany("INSERT INTO chat_room (name) VALUES (?)", [(f"Room{i}",) for i in range(rooms)])
+
+    def room_rows():
+        seqs = {}
+        for i in range(rows):
+            room = random.randrange(2 if i >= quiet_after else 1, rooms + 1)
+            seqs[room] = seqs.get(room, 0) + 1
+            yield (f"user{i % users}", "hello there", (START + step * i).isoformat(" "), room, seqs[room])
+
+    def dm_rows():
+        seqs = {}
+        for i in range(rows):
+            # Users 1 and 2 are the busy conversation, 1 and 3 the quiet one
+            if i % 10 == 0:
+                sender, receiver = random.sample((1, 2) if i >= quiet_after else random.choice(((1, 2), (1, 3))), 2)
+            else:
+                sender, receiver = random.sample(range(4, users + 1), 2)
+            low, high = sorted((sender, receiver))
+            key = f"{low}_{high}"
+            seqs[key] = seqs.get(key, 0) + 1
+            yield ("hello there", (START + step * i).isoformat(" "), receiver, sender, key, seqs[key])
+
+    db.executemany(
+        "INSERT INTO chat_message (username, message, timestamp, room_id, seq) VALUES (?, ?, ?, ?, ?)", room_rows()
+    )
+    db.executemany(
+        "INSERT INTO chat_directmessage (message, timestamp, receiver_id, sender_id, conversation, seq) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        dm_rows(),
+    )
+    db.commit()
+    db.execute("ANALYZE")
+
+
+def measure(db, sql, params, repeat):
+    plan = " / ".join(row[-1] for row in db.execute("EXPLAIN QUERY PLAN " + sql, params))
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        db.execute(sql, params).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), plan
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000, help="rows seeded into each message table")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = sqlite3.connect(os.path.join(tmp, 'bench.sqlite3'))
+        db.executescript(SCHEMA)
+
+        started = time.perf_counter()
+        seed(db, args.rows, args.users, args.rooms)
+        print(f"seeded {args.rows} room and {args.rows} direct messages in {time.perf_counter() - started:.1f}s")
+
+        epoch = "1970-01-01 00:00:00"
+        cutoff = (START + timedelta(days=DAYS - 1)).isoformat(" ")
+        pages = {
+            "room page, pro": (ROOM_PAGE, ROOM_PAGE, (2, epoch)),
+            "room page, basic": (ROOM_PAGE, ROOM_PAGE_BOUND, (2, cutoff)),
+            "quiet room, basic": (ROOM_PAGE, ROOM_PAGE_BOUND, (1, cutoff)),
+            "dm page, pro": (DM_PAGE, DM_PAGE, ("1_2", epoch)),
+            "dm page, basic": (DM_PAGE, DM_PAGE_BOUND, ("1_2", cutoff)),
+            "quiet dm, basic": (DM_PAGE, DM_PAGE_BOUND, ("1_3", cutoff)),
+        }
+
+        def run(bound):
+            results = {}
+            for name, (sql, bound_sql, params) in pages.items():
+                if bound and sql is not bound_sql:
+                    sql, params = bound_sql, params * 2
+                results[name] = measure(db, sql, params, args.repeat)
+            return results
+
+        stages = [("no indexes", run(False))]
+        db.executescript(SEQ_INDEXES)
+        db.execute("ANALYZE")
+        stages.append(("seq indexes", run(False)))
+        db.executescript(TIMESTAMP_INDEXES)
+        db.execute("ANALYZE")
+        stages.append(("both, seq bound", run(True)))
+
+        for name in pages:
+            print(f"\n{name}")
+            for stage, results in stages:
+                ms, plan = results[name]
+                print(f"  {stage + ':':17} {ms:8.2f} ms  {plan}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# benchmarks/history_payloads.py
+#
+# Encodes history pages the way the consumers send them (chat/serialization.py)
+# as JSON, with orjson when it is installed, and as MessagePack, message by
+# message and in columns, and prints the median encode time and the size of
+# each. Pages are synthetic: usernames from a small pool, message lengths
+# spread around typical chat lines, seq and timestamps increasing.
+#
+#   python benchmarks/history_payloads.py --pages 50 200 --repeat 200
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import zlib
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import msgpack
+
+from chat import events, serialization
+
+WORDS = "hey ok sure lunch meeting tomorrow deploy done thanks lol why what see you later ship it".split()
+
+
+def page(size, users, seed=0):
+    rng = random.Random(seed)
+    usernames = [f'user{i}' for i in range(users)]
+    started = 1_760_000_000_000
+    messages = []
+    for seq in range(1, size + 1):
+        text = " ".join(rng.choice(WORDS) for _ in range(max(1, int(rng.expovariate(1 / 8)))))
+        message = {
+            "username": rng.choice(usernames), "message": text,
+            "timestamp": started + seq * rng.randint(500, 60_000), "message_id": 100_000 + seq, "seq": seq,
+        }
+        if rng.random() < 0.3:
+            message["client_id"] = f'{rng.getrandbits(64):016x}'
+        messages.append(message)
+    return events.history(messages, {"seq": 1}, True, stream='room:General', synced=started)
+
+
+def encoders():
+    yield 'json', lambda frame: json.dumps(frame, ensure_ascii=False, separators=(',', ':')).encode()
+    if serialization.orjson is not None:
+        yield 'orjson', serialization.orjson.dumps
+    yield 'msgpack rows', lambda frame: msgpack.packb(frame, use_bin_type=True)
+    yield 'msgpack columns', serialization.pack
+
+
+def measure(encode, frame, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        encoded = encode(frame)
+        timings.append((time.perf_counter() - started) * 1_000_000)
+    return statistics.median(timings), len(encoded), len(zlib.compress(encoded))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, nargs='+', default=[50, 200], help="messages per history page")
+    parser.add_argument('--users', type=int, default=20, help="distinct senders in a page")
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    for size in args.pages:
+        frame = page(size, args.users)
+        print(f"\n{size} messages")
+        print(f"  {'':16} {'encode':>10} {'bytes':>8} {'deflated':>9}")
+        for name, encode in encoders():
+            micros, size_bytes, deflated = measure(encode, frame, args.repeat)
+            print(f"  {name:16} {micros:8.1f}us {size_bytes:8} {deflated:9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+# benchmarks/workload.py
+#
+# Chat workload shared by chat_consumers.py (in process, through
+# WebsocketCommunicator) and ws_driver.py (over the network against daphne).
+#
+# N users connect to the multiplexed endpoint (ws/stream/), subscribe to their
+# rooms and DMs, send messages to them and delete some of their own. Everything
+# is timed with perf_counter in the driving process, so latencies are
+# end-to-end as the clients see them. Results are a JSON document.
+import asyncio
+import json
+import math
+import platform
+import statistics
+import sys
+import time
+
+STREAM_PATH = '/ws/stream/'
+
+
+class Plan:
+    """
+    Who is in which room and who talks to whom. User i joins rooms
+    i, i+1, ... (mod M) and has a DM with user i+1 for the first `dm_pairs`
+    users.
+    """
+
+    def __init__(self, users, rooms, rooms_per_user=1, dm_pairs=None):
+        self.usernames = [f'bench{i}' for i in range(users)]
+        self.rooms = [f'Bench{i}' for i in range(rooms)]
+        self.members = {room: [] for room in self.rooms}
+        self.targets = {username: [] for username in self.usernames}  # subscribe requests per user
+
+        for i, username in enumerate(self.usernames):
+            for k in range(min(rooms_per_user, rooms)):
+                room = self.rooms[(i + k) % rooms]
+                self.members[room].append(username)
+                self.targets[username].append(('room', room))
+
+        self.dms = []
+        if users > 1:
+            for i in range(users if dm_pairs is None else min(dm_pairs, users)):
+                pair = (self.usernames[i], self.usernames[(i + 1) % users])
+                if users == 2 and i == 1:
+                    break  # bench0-bench1 already covers it
+                self.dms.append(pair)
+                self.targets[pair[0]].append(('dm', pair[1]))
+                self.targets[pair[1]].append(('dm', pair[0]))
+
+    def recipients(self, target):
+        kind, name = target
+        return len(self.members[name]) if kind == 'room' else 2
+
+    def config(self):
+        return {
+            "users": len(self.usernames),
+            "rooms": len(self.rooms),
+            "dms": len(self.dms),
+            "subscriptions": sum(len(targets) for targets in self.targets.values()),
+        }
+
+
+def seed(plan):
+    """
+    Create the plan's users, rooms and memberships (reusing any left by an
+    earlier run) and return a fresh session key per user. Needs Django set up.
+    """
+    from importlib import import_module
+
+    from django.conf import settings
+    from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+
+    from chat.models import Room
+    from users.models import User
+
+    users = {}
+    for username in plan.usernames:
+        user = User.objects.filter(username=username).first()
+        if user is None:
+            user = User.objects.create_user(username, password=username, user_type='pro')
+        users[username] = user
+
+    for name, members in plan.members.items():
+        room, _ = Room.objects.get_or_create(name=name)
+        room.users.add(*(users[username] for username in members))
+
+    store = import_module(settings.SESSION_ENGINE).SessionStore
+    sessions = {}
+    for username, user in users.items():
+        session = store()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        sessions[username] = session.session_key
+    return sessions
+
+
+def summary(samples):
+    # Milliseconds, nearest-rank percentiles
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return round(ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+class Session:
+    """One user's socket. A reader task timestamps every frame as it arrives."""
+
+    def __init__(self, run, username):
+        self.run = run
+        self.username = username
+        self.client = None
+        self.streams = {}        # (kind, name) -> stream id
+        self.subscribed_at = {}  # (kind, name) -> perf_counter when subscribe was sent
+        self.pending_history = set()
+        self.history_done = asyncio.Event()
+        self.first_history_at = None
+        self.own = []            # (message id, stream) of this user's messages as they arrive
+        self.deleting = {}       # (stream, message id) -> perf_counter when delete was sent
+        self.reader = None
+
+    async def open(self, connect):
+        targets = self.run.plan.targets[self.username]
+        self.pending_history = set(targets)
+        if not targets:
+            self.history_done.set()
+
+        started = time.perf_counter()
+        self.client = await connect(self.username)
+        self.run.connect.append(time.perf_counter() - started)
+        self.reader = asyncio.ensure_future(self.read())
+
+        for kind, name in targets:
+            self.subscribed_at[(kind, name)] = time.perf_counter()
+            await self.send({"type": "subscribe", kind: name})
+
+        await self.history_done.wait()
+        if self.first_history_at is not None:
+            self.run.first_history.append(self.first_history_at - started)
+
+    async def read(self):
+        while True:
+            frame = await self.client.receive()
+            if frame is None:
+                return
+            now = time.perf_counter()
+            handler = getattr(self, f"on_{frame.get('type')}", None)
+            if handler is not None:
+                handler(frame, now)
+
+    def on_subscribed(self, frame, now):
+        target = ('room', frame['room']) if 'room' in frame else ('dm', frame['dm'])
+        self.streams[target] = frame['stream']
+
+    def on_history(self, frame, now):
+        target = next((target for target, stream in self.streams.items() if stream == frame.get('stream')), None)
+        if target not in self.pending_history:
+            return
+        if len(self.pending_history) == len(self.run.plan.targets[self.username]):
+            self.first_history_at = now
+        self.run.subscribe_history.append(now - self.subscribed_at[target])
+        self.pending_history.discard(target)
+        if not self.pending_history:
+            self.history_done.set()
+
+    def on_message_created(self, frame, now):
+        text = frame['message']['message']
+        if not text.startswith('bench|'):
+            return
+        _, sender, sent = text.split('|')[:3]
+        self.run.delivered(now - float(sent))
+        if sender == self.username:
+            self.own.append((frame['message']['message_id'], frame['stream']))
+
+    def on_message_deleted(self, frame, now):
+        sent = self.deleting.pop((frame.get('stream'), frame['message_id']), None)
+        if sent is not None:
+            self.run.deletes.append(now - sent)
+            self.run.deleted()
+
+    def on_error(self, frame, now):
+        self.run.errors += 1
+
+    async def send(self, frame):
+        # A dropped connection is counted, the rest of the run carries on
+        try:
+            await self.client.send(frame)
+        except Exception:
+            self.run.errors += 1
+
+    async def send_messages(self, count, rate):
+        targets = self.run.plan.targets[self.username]
+        if not targets:
+            return
+        interval = 1 / rate if rate else 0
+        for seq in range(count):
+            target = targets[seq % len(targets)]
+            self.run.expected += self.run.plan.recipients(target)
+            self.run.sent += 1
+            await self.send({
+                "type": "message",
+                "stream": self.streams[target],
+                "message": f"bench|{self.username}|{time.perf_counter():.9f}|{seq}",
+            })
+            if interval:
+                await asyncio.sleep(interval)
+            elif seq % 10 == 9:
+                await asyncio.sleep(0)  # let the readers run between bursts
+
+    async def delete_messages(self, count):
+        for message_id, stream in self.own[:count]:
+            self.deleting[(stream, message_id)] = time.perf_counter()
+            self.run.delete_expected += 1
+            await self.send({"type": "delete", "stream": stream, "message_id": message_id})
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.client is not None:
+            await self.client.close()
+
+
+class Run:
+    def __init__(self, plan):
+        self.plan = plan
+        self.connect = []
+        self.first_history = []
+        self.subscribe_history = []
+        self.send_to_receive = []
+        self.deletes = []
+        self.sent = 0
+        self.expected = 0
+        self.delete_expected = 0
+        self.errors = 0
+        self.sending_done = False
+        self.last_delivery = None
+        self.all_delivered = asyncio.Event()
+        self.all_deleted = asyncio.Event()
+
+    def delivered(self, latency):
+        self.send_to_receive.append(latency)
+        self.last_delivery = time.perf_counter()
+        if self.sending_done and len(self.send_to_receive) >= self.expected:
+            self.all_delivered.set()
+
+    def deleted(self):
+        if len(self.deletes) >= self.delete_expected:
+            self.all_deleted.set()
+
+
+async def run(plan, connect, messages=20, rate=0, deletes=2, timeout=30, concurrency=100):
+    """
+    Drive `plan` through `connect(username)`, an async function returning a
+    client with async send(frame), receive() -> frame or None, and close().
+    """
+    result = Run(plan)
+    sessions = [Session(result, username) for username in plan.usernames]
+    limit = asyncio.Semaphore(concurrency)
+
+    async def open_session(session):
+        async with limit:
+            await session.open(connect)
+
+    try:
+        started = time.perf_counter()
+        await asyncio.wait_for(asyncio.gather(*(open_session(session) for session in sessions)), timeout)
+        connect_phase = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await asyncio.gather(*(session.send_messages(messages, rate) for session in sessions))
+        result.sending_done = True
+        if len(result.send_to_receive) >= result.expected:
+            result.all_delivered.set()
+        try:
+            await asyncio.wait_for(result.all_delivered.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        send_phase = (result.last_delivery or time.perf_counter()) - started
+
+        await asyncio.gather(*(session.delete_messages(deletes) for session in sessions))
+        if len(result.deletes) >= result.delete_expected:
+            result.all_deleted.set()
+        try:
+            await asyncio.wait_for(result.all_deleted.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    finally:
+        await asyncio.gather(*(session.close() for session in sessions), return_exceptions=True)
+
+    delivered = len(result.send_to_receive)
+    return {
+        "config": dict(plan.config(), messages_per_user=messages, rate_per_user=rate, deletes_per_user=deletes),
+        "connect": summary(result.connect),
+        "connect_to_first_history": summary(result.first_history),
+        "subscribe_to_history": summary(result.subscribe_history),
+        "send_to_receive": summary(result.send_to_receive),
+        "delete_to_receive": summary(result.deletes),
+        "throughput": {
+            "connect_phase_s": round(connect_phase, 3),
+            "send_phase_s": round(send_phase, 3),
+            "sent": result.sent,
+            "expected_deliveries": result.expected,
+            "delivered": delivered,
+            "lost": max(0, result.expected - delivered),
+            "messages_per_s": round(result.sent / send_phase, 1) if send_phase else None,
+            "deliveries_per_s": round(delivered / send_phase, 1) if send_phase else None,
+            "deletes_expected": result.delete_expected,
+            "deletes_seen": len(result.deletes),
+            "errors": result.errors,
+        },
+        "environment": {"python": sys.version.split()[0], "platform": platform.platform()},
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rooms', type=int, default=5)
+    parser.add_argument('--rooms-per-user', type=int, default=1)
+    parser.add_argument('--dm-pairs', type=int, default=None, help="users with a DM to the next user (default all)")
+    parser.add_argument('--messages', type=int, default=20, help="messages sent by each user")
+    parser.add_argument('--rate', type=float, default=0, help="messages per second per user, 0 for as fast as possible")
+    parser.add_argument('--deletes', type=int, default=2, help="own messages each user deletes")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--concurrency', type=int, default=100, help="connections opened at once")
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+
+
+def plan_from(args):
+    return Plan(args.users, args.rooms, args.rooms_per_user, args.dm_pairs)
+
+
+def write(args, results):
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+
+def run_from(args, plan, connect):
+    return run(
+        plan, connect, messages=args.messages, rate=args.rate, deletes=args.deletes,
+        timeout=args.timeout, concurrency=args.concurrency,
+    )
@@ -0,0 +1,83 @@
+# benchmarks/ws_driver.py
+#
+# Runs the chat workload (see workload.py) over real WebSocket connections
+# against a running server, e.g. `python manage.py runworkers --workers 4` or
+# `daphne ChatApp.asgi:application`. Users, rooms and sessions are created
+# directly in the server's database through the Django settings, so run it
+# from this checkout with the same settings as the server.
+#
+# Needs the websockets package (pip install websockets), which the app itself
+# doesn't use.
+#
+#   python benchmarks/ws_driver.py --url ws://127.0.0.1:8000 --users 500 --rooms 20
+import argparse
+import asyncio
+import os
+import sys
+from urllib.parse import urlsplit
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import workload
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+
+class Client:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def send(self, frame):
+        await self.connection.send(workload.json.dumps(frame))
+
+    async def receive(self):
+        try:
+            return workload.json.loads(await self.connection.recv())
+        except websockets.ConnectionClosed:
+            return None
+
+    async def close(self):
+        await self.connection.close()
+
+
+async def main(args, sessions, plan):
+    url = args.url.rstrip('/') + workload.STREAM_PATH
+    host = urlsplit(url)
+    origin = f"{'https' if host.scheme == 'wss' else 'http'}://{host.netloc}"
+
+    async def connect(username):
+        connection = await websockets.connect(
+            url,
+            origin=origin,
+            additional_headers={'Cookie': f'sessionid={sessions[username]}'},
+            open_timeout=args.timeout,
+            max_queue=None,
+        )
+        return Client(connection)
+
+    results = await workload.run_from(args, plan, connect)
+    results["benchmark"] = "ws_driver"
+    results["config"]["url"] = args.url
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    workload.add_arguments(parser)
+    parser.add_argument('--url', default='ws://127.0.0.1:8000', help="server the workload connects to")
+    args = parser.parse_args()
+
+    if websockets is None:
+        parser.error("the websockets package is required: pip install websockets")
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatApp.settings')
+    import django
+    django.setup()
+
+    plan = workload.plan_from(args)
+    sessions = workload.seed(plan)
+    workload.write(args, asyncio.run(main(args, sessions, plan)))
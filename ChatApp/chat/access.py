@@ -0,0 +1,144 @@
+# chat/access.py
+# Database access for the consumers, at most one database thread hop per
+# event. Each function does everything an event needs from the database in a
+# single database_sync_to_async call, after writing whatever the write-behind
+# queue holds when the event reads its own writes (see WriteBehindQueue.run).
+# Lookups that are usually cached, rooms and membership (rooms.py) and users
+# by name, are answered on the event loop without a hop at all.
+#
+# Hops are counted per event by instrumentation.py, under chat_event_db_hops_total.
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from . import archive
+from . import conversations
+from . import rooms
+from . import sequences
+from .auth import SLIM_FIELDS, SlimUser
+from .db import database_sync_to_async
+from .idempotency import stored_copy
+from .history import room_history, direct_history, room_entries, direct_entries, retention_cutoff
+from .hot_history import load_page, PER_ROOM
+from .models import Message, DirectMessage
+from .resume import delta
+from .writebehind import write_behind
+from users.models import User
+
+USER_CACHE_TTL = getattr(settings, 'CHAT_USER_CACHE_TTL', 30)
+MAX_USERS = 10000
+
+_users = OrderedDict()  # username -> (expires, SlimUser)
+
+
+async def room_for(room_name, user):
+    # The room if `user` may join it, None otherwise
+    room = rooms.cached_room(room_name, user)
+    if room is rooms.MISSING:
+        room = await database_sync_to_async(_room_for)(room_name, user)
+    return room
+
+
+def _room_for(room_name, user):
+    room = rooms.get_room(room_name)
+    if room is None or not rooms.is_member(room, user):
+        return None
+    return room
+
+
+async def user_named(username):
+    entry = _users.get(username)
+    if entry is not None and entry[0] >= time.monotonic():
+        return entry[1]
+    user = await database_sync_to_async(_user_named)(username)
+    if user is None:
+        _users.pop(username, None)
+        return None
+    _users[username] = (time.monotonic() + USER_CACHE_TTL, user)
+    _users.move_to_end(username)
+    if len(_users) > MAX_USERS:
+        _users.popitem(last=False)
+    return user
+
+
+def _user_named(username):
+    row = User.objects.filter(username=username).values_list(*SLIM_FIELDS).first()
+    return None if row is None else SlimUser(*row)
+
+
+def invalidate_user(user_id):
+    for username, (_, user) in list(_users.items()):
+        if user.id == user_id:
+            _users.pop(username, None)
+
+
+async def history(history_key, user, before=None, receiver=None):
+    """
+    A history page for `user`, from the hot buffer when it can be. The
+    buffer is seeded on a miss, after the queued messages are written.
+    """
+    kind, key = history_key
+
+    async def load_recent():
+        entries = room_entries if kind == 'room' else direct_entries
+        return await write_behind.run(numbered, history_key, lambda: entries(key, limit=PER_ROOM))
+
+    async def load_page_from_db():
+        if kind == 'room':
+            return await database_sync_to_async(numbered)(history_key, lambda: room_history(key, user, before))
+        return await database_sync_to_async(numbered)(history_key, lambda: direct_history(user, receiver, before))
+
+    return await load_page(history_key, retention_cutoff(user), before, load_recent, load_page_from_db)
+
+
+def numbered(history_key, read):
+    # read(), a page ending in has_more, read again if it reached rows saved before messages had numbers
+    page = read()
+    if not page[-1] and sequences.number_older_once(history_key):
+        page = read()
+    return page
+
+
+async def changes(history_key, resume, cutoff, entries=None):
+    # resume.delta(), which needs the queued messages written unless `entries` came from the hot buffer
+    if entries is None:
+        return await write_behind.run(delta, history_key, resume, cutoff)
+    return await database_sync_to_async(delta)(history_key, resume, cutoff, entries)
+
+
+async def save_once(obj):
+    """
+    Insert `obj`, a resent message with a client_id, now instead of queueing
+    it and return None, or return the copy its sender already stored, e.g.
+    through another worker process, without inserting it.
+    """
+    return await write_behind.run(_save_once, obj)
+
+
+def _save_once(obj):
+    try:
+        with transaction.atomic():
+            obj.save(force_insert=True)
+    except IntegrityError:
+        stored = stored_copy(obj)
+        if stored is None:
+            raise
+        return stored
+    return None
+
+
+async def delete_message(history_key, message_id):
+    # The message may still be queued, it is written first in the same hop
+    return await write_behind.run(_delete_message, history_key, message_id)
+
+
+def _delete_message(history_key, message_id):
+    kind, key = history_key
+    if kind == 'room':
+        return archive.delete(Message, message_id, room_id=key)
+    if not archive.delete(DirectMessage, message_id, conversation=key):
+        return False
+    conversations.message_deleted(key, message_id)
+    return True
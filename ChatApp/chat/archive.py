@@ -0,0 +1,79 @@
+# chat/archive.py
+# Moves messages older than CHAT_ARCHIVE_AFTER_DAYS out of the Message and
+# DirectMessage tables into ArchivedMessage/ArchivedDirectMessage, keeping
+# their ids. History reads fall through to the archive tables (see
+# history.paginate_archived), so pro users still see everything.
+import random
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Message, DirectMessage, ArchivedMessage, ArchivedDirectMessage, Tombstone
+from . import search
+
+ARCHIVE_AFTER_DAYS = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 30)
+ARCHIVE_BATCH_SIZE = getattr(settings, 'CHAT_ARCHIVE_BATCH_SIZE', 1000)
+TOMBSTONE_DAYS = getattr(settings, 'CHAT_TOMBSTONE_DAYS', 7)
+
+# hot model -> (archive model, columns copied)
+ARCHIVES = {
+    Message: (ArchivedMessage, ['id', 'room_id', 'username', 'message', 'timestamp', 'seq', 'client_id']),
+    DirectMessage: (
+        ArchivedDirectMessage, ['id', 'sender_id', 'receiver_id', 'message', 'timestamp', 'conversation', 'seq', 'client_id'],
+    ),
+}
+
+
+def horizon(days=None):
+    # Rows older than this may be in the archive tables
+    return timezone.now() - timezone.timedelta(days=ARCHIVE_AFTER_DAYS if days is None else days)
+
+
+def archive_batch(model, before, batch_size=None):
+    """
+    Move up to `batch_size` rows of `model` older than `before` to its archive
+    table in one short transaction and return how many were moved.
+    """
+    archive_model, fields = ARCHIVES[model]
+    with transaction.atomic():
+        # Walk the primary key, old rows sit at its low end, instead of
+        # scanning the whole table for the timestamp
+        rows = list(
+            model.objects.filter(timestamp__lt=before).order_by('id').values(*fields)[:batch_size or ARCHIVE_BATCH_SIZE]
+        )
+        if not rows:
+            return 0
+        archive_model.objects.bulk_create([archive_model(**row) for row in rows], ignore_conflicts=True)
+        model.objects.filter(id__in=[row['id'] for row in rows]).delete()
+    return len(rows)
+
+
+def archive(model, before, batch_size=None, pause=0, progress=None):
+    # Batches are separate transactions so writers get the database in between
+    total = 0
+    while True:
+        moved = archive_batch(model, before, batch_size)
+        if not moved:
+            return total
+        total += moved
+        if progress is not None:
+            progress(total)
+        if pause:
+            time.sleep(pause)
+
+
+def delete(model, message_id, **scope):
+    # A message may be in the hot table or, if it is old, in the archive
+    deleted, _ = model.objects.filter(id=message_id, **scope).delete()
+    if not deleted:
+        deleted, _ = ARCHIVES[model][0].objects.filter(id=message_id, **scope).delete()
+    if deleted:
+        search.remove(model, message_id)
+        # scope is room_id=<id> or conversation=<key>, the tombstone key is the read cursor's
+        kind = 'room' if model is Message else 'dm'
+        Tombstone.objects.create(key=f"{kind}:{next(iter(scope.values()))}", message_id=message_id)
+        if random.random() < 0.01:
+            Tombstone.objects.filter(deleted__lt=horizon(TOMBSTONE_DAYS)).delete()
+    return deleted > 0
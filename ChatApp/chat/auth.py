@@ -0,0 +1,113 @@
+# chat/auth.py
+# WebSocket authentication, in place of channels' AuthMiddlewareStack.
+#
+# Clients open a socket per page and reconnect whenever a tab comes back, and
+# AuthMiddlewareStack reads the session and then the user from the database
+# for every one of them. CachedAuthMiddleware remembers which user a session
+# key belongs to for CHAT_AUTH_CACHE_TTL seconds, so reconnects skip both
+# reads, and a miss does them in one database hop. scope['user'] is a
+# SlimUser, the id, username and user_type the consumers use, or
+# AnonymousUser.
+#
+# Entries are dropped when the session logs out and when the user is saved
+# with anything but a new last_login, e.g. a user_type or password change,
+# or deleted (see signals.py). Other worker processes don't see those
+# signals, their entries expire after the TTL.
+import time
+from collections import OrderedDict, namedtuple
+from importlib import import_module
+
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import AnonymousUser
+from django.http.cookie import parse_cookie
+from django.utils.crypto import constant_time_compare
+
+from .db import database_sync_to_async
+from users.models import User
+
+AUTH_CACHE_TTL = getattr(settings, 'CHAT_AUTH_CACHE_TTL', 10)
+MAX_SESSIONS = 100000
+
+SLIM_FIELDS = ('id', 'username', 'user_type')
+
+
+class SlimUser(namedtuple('SlimUser', SLIM_FIELDS)):
+    # Just what the consumers need from a user, without a model instance
+    __slots__ = ()
+    is_authenticated = True
+    is_anonymous = False
+
+    @property
+    def pk(self):
+        return self.id
+
+
+_sessions = OrderedDict()  # session key -> (expires, SlimUser)
+
+
+async def user_for_session(session_key):
+    if not session_key:
+        return AnonymousUser()
+    entry = _sessions.get(session_key)
+    if entry is not None and entry[0] >= time.monotonic():
+        return entry[1]
+    user = await database_sync_to_async(authenticate)(session_key)
+    if user is None:
+        _sessions.pop(session_key, None)
+        return AnonymousUser()
+    _sessions[session_key] = (time.monotonic() + AUTH_CACHE_TTL, user)
+    _sessions.move_to_end(session_key)
+    if len(_sessions) > MAX_SESSIONS:
+        _sessions.popitem(last=False)
+    return user
+
+
+def authenticate(session_key):
+    """
+    The SlimUser logged in with `session_key`, checked like
+    django.contrib.auth.get_user() does, or None.
+    """
+    session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    user_id = session.get(SESSION_KEY)
+    if user_id is None or session.get(BACKEND_SESSION_KEY) not in settings.AUTHENTICATION_BACKENDS:
+        return None
+    user = User.objects.only(*SLIM_FIELDS, 'password', 'is_active').filter(pk=user_id).first()
+    if user is None or not user.is_active:
+        return None
+    # A password change ends the sessions logged in with the old one
+    session_hash = session.get(HASH_SESSION_KEY)
+    hashes = [user.get_session_auth_hash(), *user.get_session_auth_fallback_hash()]
+    if not session_hash or not any(constant_time_compare(session_hash, known) for known in hashes):
+        return None
+    return SlimUser(user.id, user.username, user.user_type)
+
+
+def forget_session(session_key):
+    _sessions.pop(session_key, None)
+
+
+def invalidate_user(user_id):
+    for session_key, (_, user) in list(_sessions.items()):
+        if user.id == user_id:
+            _sessions.pop(session_key, None)
+
+
+class CachedAuthMiddleware(BaseMiddleware):
+    """
+    Sets scope['user'] from the session cookie, see the module comment.
+    Use instead of AuthMiddlewareStack, it needs no session or cookie
+    middleware in front of it.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        if 'user' not in scope:
+            cookies = {}
+            for name, value in scope.get('headers', ()):
+                if name == b'cookie':
+                    cookies = parse_cookie(value.decode('latin1'))
+                    break
+            scope['user'] = await user_for_session(cookies.get(settings.SESSION_COOKIE_NAME))
+        return await super().__call__(scope, receive, send)
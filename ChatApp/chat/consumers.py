@@ -1,245 +1,378 @@
 # chat/consumers.py
-import json
+import logging
+from collections import namedtuple
+from datetime import datetime
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.utils import timezone
-from .models import Room, Message, DirectMessage
-from users.models import User
-from django.db.models import Q
+from django.utils.text import capfirst
+from .models import Message, DirectMessage
+from .history import message_entry, parse_seq_cursor, retention_cutoff
+from .hot_history import hot_history
+from .writebehind import write_behind
+from .idempotency import clean, recent_keys
+from .sequences import sequences
+from . import access
+from .flow import FlowControlMixin
+from .instrumentation import InstrumentedMixin
+from .presence import presence
+from .reads import read_cursors, receipts
+from .resume import parse_resume
+from . import events
+from . import serialization
+
+logger = logging.getLogger(__name__)
+
+
+def room_stream(room_name):
+    return f'room:{room_name}'
+
+
+def direct_stream(conversation):
+    return f'dm:{conversation}'
+
+
+def read_report(data):
+    # {"type": "read", "message_id": <id>, "timestamp": <epoch ms>}, the newest message the client has shown
+    try:
+        message_id = int(data["message_id"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Message ID is missing for read request")
+    timestamp = data.get("timestamp")
+    return message_id, timestamp if isinstance(timestamp, (int, float)) else None
+
+
+async def send_once(consumer, user_key, history_key, client_id, create):
+    """
+    Await create(), which sends a message and returns the frame text it
+    broadcast, unless the client already sent `client_id`. A retry of a sent
+    message gets that frame back, one still being saved is dropped.
+    """
+    key = recent_keys.key(user_key, history_key, client_id)
+    if key is None:
+        await create()
+        return
+    sent = recent_keys.claim(key)
+    if sent is not None:
+        if sent:
+            await consumer.send(text_data=sent)
+        return
+    try:
+        recent_keys.sent(key, await create())
+    except BaseException:
+        recent_keys.release(key)
+        raise
+
+
+def room_group(room_name):
+    return f'chat_{room_name.replace(" ", "_")}'  # Replace spaces with underscores
+
+
+def direct_group(conversation):
+    # One group per conversation, so a socket only hears the DMs it shows
+    return f'direct_messages_{conversation}'
+
+
+Subscription = namedtuple('Subscription', 'group history_key room receiver')
+
+
+class MultiplexConsumer(InstrumentedMixin, FlowControlMixin, AsyncWebsocketConsumer):
+    """
+    One socket per user for all of their rooms and conversations.
+
+    Clients send {"type": "subscribe", "room": <name>} or {"type": "subscribe",
+    "dm": <username>} and get back a "subscribed" frame with the stream id,
+    followed by its history. Every later frame for that subscription carries
+    the stream id, and message/delete/load_older/unsubscribe requests name it.
+    After a reconnect, a "resume" in the subscribe frame gets only what
+    changed instead of the history (see chat/resume.py).
+    """
+
+    key_fields = ('stream', 'room', 'dm')
+    frame_types = {'subscribe', 'unsubscribe', 'message', 'delete', 'load_older', 'read', 'heartbeat', 'typing'}
 
-class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
-        self.room_group_name = f'chat_{self.room_name.replace(" ", "_")}'  # Replace spaces with underscores
+        self.user = self.scope['user']
+        self.streams = {}  # stream id -> Subscription
 
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        if not self.user.is_authenticated:
+            await self.close()
+            return
         await self.accept()
 
-        messages = await self.get_messages(self.room_name)
-        await self.send_messages(messages)
-
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        for stream in list(self.streams):
+            await self.unsubscribe(stream)
 
-    async def receive(self, text_data):
+    def rate_scope(self, data):
+        # Frames for a subscription are charged to its stream, subscribing to what is being subscribed to
+        if data.get("type") == "subscribe":
+            return ('subscribe', data.get("room"), data.get("dm"))
+        stream = data.get("stream")
+        return stream if stream in self.streams else None
+
+    async def receive_frame(self, data):
         try:
-            data = json.loads(text_data)
             message_type = data.get("type")
 
-            if message_type == "message":
-                await self.handle_message(data)
+            if message_type == "subscribe":
+                await self.handle_subscribe(data)
+                return
+            if message_type == "heartbeat" and "stream" not in data:
+                # One heartbeat for every subscription
+                for stream, subscription in self.streams.items():
+                    presence.heartbeat(subscription.history_key, subscription.group, stream, self.user.username)
+                return
+
+            stream = data.get("stream")
+            subscription = self.streams.get(stream)
+            if subscription is None:
+                await self.send_frame(events.error("Not subscribed", stream))
+            elif message_type == "unsubscribe":
+                await self.unsubscribe(stream)
+                await self.send_frame(events.unsubscribed(stream))
+            elif not await self.still_allowed(subscription):
+                # Removed from the room, or it was deleted, since subscribing
+                await self.unsubscribe(stream)
+                await self.send_frame(events.error("No such room", stream))
+                await self.send_frame(events.unsubscribed(stream))
+            elif message_type == "message":
+                await self.handle_message(stream, subscription, data)
             elif message_type == "delete":
-                await self.handle_delete(data)
+                await self.handle_delete(stream, subscription, data)
+            elif message_type == "load_older":
+                await self.handle_load_older(stream, subscription, data)
+            elif message_type == "read":
+                await self.handle_read(stream, subscription, data)
+            elif message_type in ("heartbeat", "typing"):
+                getattr(presence, message_type)(subscription.history_key, subscription.group, stream, self.user.username)
         except Exception as e:
-            print(f"Error in receive: {e}")
-
-    async def handle_message(self, data):
+            logger.exception("Could not handle a %r frame from %s", data.get("type"), self.channel_name)
+            # Requests rejected on purpose raise ValueError with a reason the client can show
+            reason = str(e) if isinstance(e, ValueError) else "Could not handle the frame"
+            stream = data.get("stream")
+            await self.send_frame(events.error(reason, stream if isinstance(stream, str) else None))
+
+    async def handle_subscribe(self, data):
+        if data.get("room"):
+            room = await access.room_for(data["room"], self.user)
+            if room is None:
+                await self.send_frame(events.error("No such room"))
+                return
+            stream, target = room_stream(room.name), {"room": room.name}
+            subscription = Subscription(room_group(room.name), ('room', room.id), room, None)
+        elif data.get("dm"):
+            receiver = await access.user_named(data["dm"])
+            if receiver is None:
+                await self.send_frame(events.error("No such user"))
+                return
+            conversation = DirectMessage.conversation_key(self.user, receiver)
+            stream, target = direct_stream(conversation), {"dm": receiver.username}
+            subscription = Subscription(direct_group(conversation), ('dm', conversation), None, receiver)
+        else:
+            raise ValueError("Room or dm is missing for subscribe request")
+
+        # Subscribing again just resends the history
+        if stream not in self.streams:
+            self.streams[stream] = subscription
+            await self.channel_layer.group_add(subscription.group, self.channel_name)
+            hot_history.attach(subscription.history_key)
+            presence.join(subscription.history_key, subscription.group, stream, self.user.username)
+
+        await self.send_frame(events.subscribed(stream, **target))
+        synced = serialization.epoch_ms(timezone.now())
+        resume = parse_resume(data.get("resume"))
+        if resume is not None:
+            changes = await self.get_changes(subscription, resume)
+            if changes is not None:
+                entries, deleted = changes
+                await self.send_frame(events.resumed([entry.message for entry in entries], deleted, synced, stream))
+                return
+        page = await self.get_history(subscription)
+        await self.send_frame(events.history(*page, stream=stream, synced=synced))
+
+    async def still_allowed(self, subscription):
+        # Membership is cached (see rooms.py), so this rarely costs a hop
+        if subscription.room is None:
+            return True
+        return await access.room_for(subscription.room.name, self.user) is not None
+
+    async def unsubscribe(self, stream):
+        subscription = self.streams.pop(stream, None)
+        if subscription is not None:
+            hot_history.detach(subscription.history_key)
+            presence.leave(subscription.history_key, self.user.username)
+            await self.channel_layer.group_discard(subscription.group, self.channel_name)
+
+    async def handle_message(self, stream, subscription, data):
         message = data.get("message")
-        username = data.get("username")
-
-        if not message or not username:
-            raise ValueError("Message or username is missing")
+        if not message:
+            raise ValueError("Message is missing")
+        client_id = clean(data.get("client_id"))
+        await send_once(
+            self, self.user.id, subscription.history_key, client_id,
+            lambda: self.create_message(stream, subscription, message, client_id, data.get("retry") is True),
+        )
 
-        chat_message = await self.save_message(self.room_name, username, message)
+    async def create_message(self, stream, subscription, message, client_id=None, retry=False):
+        presence.stopped_typing(subscription.history_key, self.user.username)
+        seq = await sequences.next(subscription.history_key)
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "message": message,
-                "username": username,
-                "message_id": chat_message.id
+        if subscription.room is not None:
+            model = Message
+            # Room messages keep the capitalised name the room page has always sent
+            username = capfirst(self.user.username)
+            fields = {"room_id": subscription.room.id, "username": username}
+            extra = {}
+        else:
+            model = DirectMessage
+            username = self.user.username
+            fields = {
+                "sender_id": self.user.id,
+                "receiver_id": subscription.receiver.id,
+                "conversation": subscription.history_key[1],
             }
-        )
-
-    async def handle_delete(self, data):
+            extra = {"receiver": subscription.receiver.username}
+        fields.update(message=message, seq=seq, client_id=client_id)
+
+        if retry and client_id is not None:
+            # The first try may have reached another worker process, see chat.idempotency
+            saved = model(**fields)
+            stored = await access.save_once(saved)
+            if stored is not None:
+                data = serialization.message(
+                    stored.id, username, stored.message, stored.timestamp, seq=stored.seq, client_id=client_id, **extra
+                )
+                text = serialization.dumps(events.message_created(data, stream))
+                await self.send(text_data=text)
+                return text
+        else:
+            saved = await write_behind.add(model, **fields)
+        data = serialization.message(saved.id, username, message, saved.timestamp, seq=seq, client_id=client_id, **extra)
+
+        # Encoded once here, recipients just write the text to their socket
+        text = serialization.dumps(events.message_created(data, stream))
+        await self.channel_layer.group_send(subscription.group, {
+            "type": "message_created",
+            "stream": stream,
+            "text": text,
+            "message": data,
+            "timestamp": saved.timestamp.isoformat(),
+        })
+        return text
+
+    async def handle_delete(self, stream, subscription, data):
         message_id = data.get("message_id")
         if not message_id:
             raise ValueError("Message ID is missing for delete request")
 
-        await self.delete_message(message_id)
-        messages = await self.get_messages(self.room_name)
-        await self.channel_layer.group_send(self.room_group_name, {"type": "chat_message", "messages": messages})
-
-    async def chat_message(self, event):
-        if 'messages' in event:
-            await self.send_messages(event['messages'])
-        else:
-            message = event["message"]
-            username = event["username"]
-            message_id = event['message_id']
-            timestamp = self.get_current_timestamp()
-
-            await self.send(text_data=json.dumps({
-                "message": message,
-                "username": username,
-                "timestamp": timestamp,
-                "message_id": message_id
-            }))
-
-    async def send_messages(self, messages):
-        await self.send(text_data=json.dumps({"messages": messages}))
-
-    @database_sync_to_async
-    def delete_message(self, message_id):
-        Message.objects.filter(id=message_id).delete()
-
-    @database_sync_to_async
-    def get_messages(self, room_name):
-        yesterday = timezone.now() - timezone.timedelta(days=1)
-        user = self.scope['user']
-
-        if user.is_anonymous:
-            return []
-
-        messages = Message.objects.filter(room__name=room_name)
-
-        if user.user_type == 'pro':
-            messages = messages.order_by('timestamp').values('id', 'username', 'message', 'timestamp')
-        else:
-            messages = messages.filter(timestamp__gte=yesterday).order_by('timestamp').values('id', 'username', 'message', 'timestamp')
-
-        return [
-            {
-                "username": msg['username'],
-                "message": msg['message'],
-                "timestamp": timezone.localtime(msg['timestamp']).strftime("%b %d, %Y %H:%M"),
-                "message_id": msg['id']
-            } for msg in messages
-        ]
-
-    @database_sync_to_async
-    def save_message(self, room_name, username, message):
-        room = Room.objects.get(name=room_name)
-        return Message.objects.create(room=room, username=username, message=message)
-
-    @staticmethod
-    def get_current_timestamp():
-        return timezone.localtime(timezone.now()).strftime("%b %d, %Y %H:%M")
+        if not await access.delete_message(subscription.history_key, message_id):
+            return
+
+        await self.channel_layer.group_send(subscription.group, {
+            "type": "message_deleted",
+            "stream": stream,
+            "text": serialization.dumps(events.message_deleted(message_id, stream)),
+            "message_id": message_id,
+        })
+
+    async def handle_load_older(self, stream, subscription, data):
+        before = parse_seq_cursor(data.get("before"))
+        if before is None:
+            raise ValueError("Cursor is missing or invalid for load_older request")
+
+        page = await self.get_history(subscription, before)
+        await self.send_frame(events.older_history(*page, stream=stream))
+
+    async def handle_read(self, stream, subscription, data):
+        message_id, timestamp = read_report(data)
+        if read_cursors.mark(self.user.id, subscription.history_key, message_id, timestamp):
+            receipts.announce(
+                self.channel_layer, subscription.group, subscription.history_key, stream, self.user.username, message_id
+            )
 
+    async def get_history(self, subscription, before=None):
+        return await access.history(subscription.history_key, self.user, before, subscription.receiver)
+
+    async def get_changes(self, subscription, resume):
+        cutoff = retention_cutoff(self.user)
+        entries = hot_history.since(subscription.history_key, resume.seq, cutoff)
+        return await access.changes(subscription.history_key, resume, cutoff, entries)
+
+    # Group events, routed to the subscription they belong to
+
+    async def message_created(self, event):
+        subscription = self.streams.get(event["stream"])
+        if subscription is None:
+            return  # unsubscribed while the event was in flight
+        message = event["message"]
+        if hot_history.wants(subscription.history_key, message["message_id"]):
+            timestamp = datetime.fromisoformat(event["timestamp"])
+            hot_history.append(subscription.history_key, message_entry(message, timestamp))
+        await self.send(text_data=event["text"])
+
+    async def message_deleted(self, event):
+        subscription = self.streams.get(event["stream"])
+        if subscription is None:
+            return
+        hot_history.remove(subscription.history_key, event["message_id"])
+        await self.send(text_data=event["text"])
+
+    async def read_receipts(self, event):
+        if event["stream"] in self.streams:
+            await self.send(text_data=event["text"])
+
+    async def presence(self, event):
+        subscription = self.streams.get(event["stream"])
+        if subscription is None:
+            return
+        if event["joined"] and event["origin"] != presence.origin:
+            presence.snapshot_soon(subscription.history_key)
+        await self.send(text_data=event["text"])
+
+
+class SingleStreamConsumer(MultiplexConsumer):
+    """
+    A MultiplexConsumer subscribed to one stream when it connects, for
+    clients of the ws/chat/<room>/ and ws/direct_messages/<user>/ routes
+    that came before ws/stream/. The connection is refused if the stream
+    can't be subscribed to. Frames don't need to name the stream, and
+    subscribe and unsubscribe are refused.
+    """
+
+    stream = None
+
+    async def target(self):
+        # The subscribe request for this socket's stream, or None to refuse the connection
+        raise NotImplementedError
 
-class DirectMessageConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope['user']
-        self.receiver_username = self.scope['url_route']['kwargs']['receiver']
-        self.receiver = await self.get_user(self.receiver_username)
-
-        if self.receiver:
-            self.room_group_name = f'direct_messages_{self.user.username}'
-            await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-            await self.accept()
-
-            messages = await self.get_direct_messages(self.user, self.receiver)
-            await self.send_messages(messages)
-        else:
+        self.streams = {}
+        request = await self.target() if self.user.is_authenticated else None
+        if request is None:
             await self.close()
+            return
+        await self.accept()
+        await self.handle_subscribe(request)
+        self.stream = next(iter(self.streams), None)
 
-    async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+    def rate_scope(self, data):
+        return self.stream
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_type = data.get("type")
+    async def receive_frame(self, data):
+        if data.get("type") in ("subscribe", "unsubscribe"):
+            await self.send_frame(events.error("This socket has a single stream, use ws/stream/", self.stream))
+            return
+        await super().receive_frame({**data, "stream": self.stream})
 
-        try:
-            if message_type == 'message':
-                await self.handle_direct_message(data)
-            elif message_type == 'delete':
-                await self.handle_direct_delete(data)
-        except Exception as e:
-            print(f"Error in receive: {e}")
-
-    async def handle_direct_message(self, data):
-        message = data['message']
-        receiver_username = data['receiver']
-
-        receiver = await self.get_user(receiver_username)
-        if receiver:
-            direct_message = await self.save_direct_message(self.user, receiver, message)
-
-            await self.channel_layer.group_send(
-                f'direct_messages_{receiver.username}',
-                {
-                    'type': 'send_direct_message',
-                    'message': message,
-                    'username': self.user.username,
-                    'message_id': direct_message.id
-                }
-            )
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'send_direct_message',
-                    'message': message,
-                    'username': self.user.username,
-                    'message_id': direct_message.id
-                }
-            )
 
-    async def handle_direct_delete(self, data):
-        message_id = data.get("message_id")
-        if message_id:
-            await self.delete_direct_message(message_id)
-            receiver = await self.get_user(self.receiver_username)
-            messages = await self.get_direct_messages(self.user, receiver)
-            await self.send(text_data=json.dumps({"messages": messages}))
-            await self.channel_layer.group_send(
-                f'direct_messages_{receiver.username}',
-                {
-                    'type': 'send_updated_messages',
-                    'messages': messages
-                }
-            )
+class ChatConsumer(SingleStreamConsumer):
+    async def target(self):
+        room = await access.room_for(self.scope["url_route"]["kwargs"]["room_name"], self.user)
+        return None if room is None else {"room": room.name}
 
-    async def send_updated_messages(self, event):
-        await self.send_messages(event['messages'])
-
-    async def send_direct_message(self, event):
-        await self.send(text_data=json.dumps({
-            "message": event["message"],
-            "username": event["username"],
-            "timestamp": self.get_current_timestamp(),
-            "message_id": event["message_id"]
-        }))
-    
-    async def send_messages(self, messages):
-        await self.send(text_data=json.dumps({"messages": messages}))
-
-    @database_sync_to_async
-    def delete_direct_message(self, message_id):
-        DirectMessage.objects.filter(id=message_id).delete()
-
-    @database_sync_to_async
-    def get_direct_messages(self, user, receiver=None):
-        now = timezone.now()
-        yesterday = now - timezone.timedelta(days=1)
-
-        filter_conditions = (
-            Q(sender=user) & Q(receiver=receiver) | Q(receiver=user) & Q(sender=receiver)
-        )
 
-        if user.user_type == 'pro':
-            messages = DirectMessage.objects.filter(filter_conditions).order_by('timestamp').values('sender__username', 'message', 'timestamp', 'id')
-        else:
-            messages = DirectMessage.objects.filter(filter_conditions, timestamp__gte=yesterday).order_by('timestamp').values('sender__username', 'message', 'timestamp', 'id')
-
-        return [
-            {
-                "username": msg['sender__username'],
-                "message": msg['message'],
-                "timestamp": timezone.localtime(msg['timestamp']).strftime("%b %d, %Y %H:%M"),
-                "message_id": msg['id'],
-            } for msg in messages
-        ]
-
-    @database_sync_to_async
-    def get_user(self, receiver_username):
-        return User.objects.filter(username=receiver_username).first()
-
-    @database_sync_to_async
-    def save_direct_message(self, sender, receiver, message):
-        return DirectMessage.objects.create(sender=sender, receiver=receiver, message=message)
-    
-    @staticmethod
-    def get_current_timestamp():
-        return timezone.localtime(timezone.now()).strftime("%b %d, %Y %H:%M")
+class DirectMessageConsumer(SingleStreamConsumer):
+    async def target(self):
+        receiver = await access.user_named(self.scope["url_route"]["kwargs"]["receiver"])
+        return None if receiver is None else {"dm": receiver.username}
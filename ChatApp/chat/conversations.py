@@ -0,0 +1,133 @@
+# chat/conversations.py
+# Keeps the Conversation summaries behind the DM sidebar current. record() is
+# called with every batch of direct messages the write-behind queue inserts
+# (see signals.py), in the same transaction.
+from django.conf import settings
+from django.db import transaction
+
+from .history import make_cursor, paginate
+from .models import Conversation, DirectMessage, ArchivedDirectMessage
+from . import serialization
+
+PREVIEW_LENGTH = 100
+CONVERSATION_PAGE_SIZE = getattr(settings, 'CHAT_CONVERSATION_PAGE_SIZE', 20)
+
+
+def preview(text):
+    return text if len(text) <= PREVIEW_LENGTH else text[:PREVIEW_LENGTH - 1] + '…'
+
+
+def _sort_key(message):
+    return message.timestamp, message.id
+
+
+@transaction.atomic
+def record(messages):
+    # One pass over the batch: newest message and unread count per conversation
+    latest = {}
+    unread = {}
+    for message in messages:
+        current = latest.get(message.conversation)
+        if current is None or _sort_key(message) > _sort_key(current):
+            latest[message.conversation] = message
+        if message.receiver_id != message.sender_id:
+            key = (message.receiver_id, message.conversation)
+            unread[key] = unread.get(key, 0) + 1
+
+    existing = {
+        (row.user_id, row.key): row
+        for row in Conversation.objects.select_for_update().filter(key__in=list(latest))
+    }
+    created, updated = [], []
+    for key, message in latest.items():
+        for user_id, peer_id in {(message.sender_id, message.receiver_id), (message.receiver_id, message.sender_id)}:
+            row = existing.get((user_id, key))
+            if row is None:
+                row = Conversation(user_id=user_id, peer_id=peer_id, key=key)
+                created.append(row)
+            else:
+                updated.append(row)
+
+            if row.last_message_id is not None and (row.last_activity, row.last_message_id) > _sort_key(message):
+                # An older batch arriving late only adds to the unread count
+                row.unread += unread.get((user_id, key), 0)
+                continue
+            row.last_message = preview(message.message)
+            row.last_sender_id = message.sender_id
+            row.last_message_id = message.id
+            row.last_activity = message.timestamp
+            # Sending a message means having read the conversation
+            row.unread = 0 if user_id == message.sender_id else row.unread + unread.get((user_id, key), 0)
+
+    Conversation.objects.bulk_create(created)
+    Conversation.objects.bulk_update(
+        updated, ['last_message', 'last_sender_id', 'last_message_id', 'last_activity', 'unread']
+    )
+
+
+def refresh(key):
+    # Recompute the last message of a conversation, after a delete
+    fields = ('id', 'sender_id', 'message', 'timestamp')
+    last = (
+        DirectMessage.objects.filter(conversation=key).order_by('-timestamp', '-id').values(*fields).first()
+        or ArchivedDirectMessage.objects.filter(conversation=key).order_by('-timestamp', '-id').values(*fields).first()
+    )
+    if last is None:
+        Conversation.objects.filter(key=key).update(last_message='', last_sender_id=None, last_message_id=None)
+    else:
+        Conversation.objects.filter(key=key).update(
+            last_message=preview(last['message']),
+            last_sender_id=last['sender_id'],
+            last_message_id=last['id'],
+            last_activity=last['timestamp'],
+        )
+
+
+def message_deleted(key, message_id):
+    if Conversation.objects.filter(key=key, last_message_id=message_id).exists():
+        refresh(key)
+
+
+def rebuild():
+    """
+    Create or refresh the summaries of every conversation from its newest
+    direct message, for messages written before summaries existed. Unread
+    counts of rebuilt rows start at zero.
+    """
+    keys = DirectMessage.objects.order_by().values_list('conversation', flat=True).distinct()
+    total = 0
+    for key in keys.iterator():
+        if not key:
+            continue
+        last = DirectMessage.objects.filter(conversation=key).order_by('-timestamp', '-id').first()
+        for user_id, peer_id in {(last.sender_id, last.receiver_id), (last.receiver_id, last.sender_id)}:
+            Conversation.objects.update_or_create(user_id=user_id, key=key, defaults={
+                'peer_id': peer_id,
+                'last_message': preview(last.message),
+                'last_sender_id': last.sender_id,
+                'last_message_id': last.id,
+                'last_activity': last.timestamp,
+            })
+        total += 1
+    return total
+
+
+def conversation_page(user, before=None, limit=None):
+    """
+    Return (conversations, cursor, has_more) for `user`, most recently
+    active first, as sent by the conversations endpoint.
+    """
+    limit = max(1, min(limit or CONVERSATION_PAGE_SIZE, 100))
+    queryset = Conversation.objects.filter(user=user).values(
+        'id', 'key', 'peer__username', 'last_message', 'last_sender__username', 'last_activity', 'unread'
+    )
+    rows, has_more = paginate(queryset, before=before, limit=limit, field='last_activity')
+    cursor = make_cursor(rows[0]['last_activity'], rows[0]['id']) if rows else None
+    rows.reverse()
+    return [{
+        "peer": row['peer__username'],
+        "last_message": row['last_message'],
+        "last_sender": row['last_sender__username'],
+        "last_activity": serialization.epoch_ms(row['last_activity']),
+        "unread": row['unread'],
+    } for row in rows], cursor, has_more
@@ -0,0 +1,33 @@
+# chat/db.py
+# database_sync_to_async for the consumers. Channels' version runs every call
+# on a single thread per process; this one uses a pool of CHAT_DB_THREADS
+# threads, each keeping its own connection (CONN_MAX_AGE in settings), so
+# queries from different sockets run side by side. Every call is counted as
+# a hop of the event being measured (see instrumentation.py).
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+from . import instrumentation
+from . import metrics
+
+DB_THREADS = getattr(settings, 'CHAT_DB_THREADS', 4)
+
+executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='chat-db')
+
+
+class CountedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    async def __call__(self, *args, **kwargs):
+        instrumentation.hop()
+        return await super().__call__(*args, **kwargs)
+
+
+def database_sync_to_async(func):
+    return CountedDatabaseSyncToAsync(func, thread_sensitive=False, executor=executor)
+
+
+metrics.registry.callback(
+    'gauge', 'chat_db_queue_depth', "database_sync_to_async calls waiting for a thread.",
+    lambda: {(): executor._work_queue.qsize()},
+)
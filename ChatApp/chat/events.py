@@ -0,0 +1,63 @@
+# chat/events.py
+# Frames sent to WebSocket clients. Every frame carries a "type" so clients can
+# apply it to the DOM in place instead of re-rendering the whole history.
+# Frames for a subscription on the multiplexed socket also carry its "stream".
+
+HISTORY = 'history'
+OLDER_HISTORY = 'older_history'
+RESUMED = 'resumed'
+MESSAGE_CREATED = 'message_created'
+MESSAGE_DELETED = 'message_deleted'
+READ_RECEIPTS = 'read_receipts'
+SUBSCRIBED = 'subscribed'
+UNSUBSCRIBED = 'unsubscribed'
+ERROR = 'error'
+
+
+def _frame(frame, stream):
+    if stream is not None:
+        frame["stream"] = stream
+    return frame
+
+
+def history(messages, cursor=None, has_more=False, stream=None, synced=None):
+    frame = {"type": HISTORY, "messages": messages, "cursor": cursor, "has_more": has_more}
+    if synced is not None:
+        # Server time (epoch ms) the page was read at, clients resume from it
+        frame["synced"] = synced
+    return _frame(frame, stream)
+
+
+def resumed(messages, deleted, synced, stream=None):
+    # What changed since the client's resume point: new messages and the ids of deleted ones
+    return _frame({"type": RESUMED, "messages": messages, "deleted": deleted, "synced": synced}, stream)
+
+
+def older_history(messages, cursor=None, has_more=False, stream=None):
+    return _frame({"type": OLDER_HISTORY, "messages": messages, "cursor": cursor, "has_more": has_more}, stream)
+
+
+def message_created(message, stream=None):
+    return _frame({"type": MESSAGE_CREATED, "message": message}, stream)
+
+
+def message_deleted(message_id, stream=None):
+    return _frame({"type": MESSAGE_DELETED, "message_id": message_id}, stream)
+
+
+def read_receipts(readers, stream=None):
+    # readers maps usernames to the newest message id they have read
+    return _frame({"type": READ_RECEIPTS, "readers": readers}, stream)
+
+
+def subscribed(stream, **target):
+    # target is room=<name> or dm=<username>, as the client asked for it
+    return {"type": SUBSCRIBED, "stream": stream, **target}
+
+
+def unsubscribed(stream):
+    return {"type": UNSUBSCRIBED, "stream": stream}
+
+
+def error(reason, stream=None):
+    return _frame({"type": ERROR, "error": reason}, stream)
@@ -0,0 +1,238 @@
+# chat/flow.py
+# Flow control shared by the WebSocket consumers.
+#
+# Inbound, frames over CHAT_MAX_FRAME_BYTES are rejected and every frame that
+# starts database work or a fan-out takes a token from a bucket per user and
+# room/conversation, refilled at CHAT_RATE_LIMIT frames a second up to
+# CHAT_RATE_BURST. Outbound, frames go through a queue per connection of at
+# most CHAT_SEND_QUEUE_SIZE frames. A client that lets it fill up is
+# disconnected with CLOSE_TOO_SLOW instead of buffering without bound.
+#
+# Daphne's send never waits for the client, so that queue always drains and
+# the frames pile up in the Twisted transport instead. Under daphne the bytes
+# the transport still holds are checked too, against CHAT_SEND_BUFFER_BYTES.
+#
+# Everything refused is counted in `drops`, per reason, for this process,
+# and exported as chat_dropped_frames_total.
+import asyncio
+import json
+import logging
+import time
+from collections import Counter, OrderedDict, deque
+
+from django.conf import settings
+
+from . import events
+from . import instrumentation
+from . import metrics
+from . import serialization
+
+logger = logging.getLogger(__name__)
+
+MAX_FRAME_BYTES = getattr(settings, 'CHAT_MAX_FRAME_BYTES', 8192)
+RATE_LIMIT = getattr(settings, 'CHAT_RATE_LIMIT', 5)
+RATE_BURST = getattr(settings, 'CHAT_RATE_BURST', 20)
+SEND_QUEUE_SIZE = getattr(settings, 'CHAT_SEND_QUEUE_SIZE', 256)
+SEND_BUFFER_BYTES = getattr(settings, 'CHAT_SEND_BUFFER_BYTES', 1024 * 1024)
+MAX_BUCKETS = 100000
+
+# WebSocket close codes sent to a client that stopped reading its frames, and
+# when its frames can't be written
+CLOSE_TOO_SLOW = 4008
+CLOSE_INTERNAL_ERROR = 1011
+
+# Frame types that don't cost a token, they are cheap or coalesced later
+FREE_FRAMES = {'read', 'unsubscribe', 'heartbeat', 'typing'}
+
+drops = Counter()  # reason -> frames refused or dropped
+metrics.registry.callback(
+    'counter', 'chat_dropped_frames_total', "Frames refused or dropped by flow control.",
+    lambda: {(reason,): count for reason, count in drops.items()}, ['reason'],
+)
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst):
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, rate, burst):
+        now = time.monotonic()
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def too_large(frame):
+    if isinstance(frame, str):
+        # Up to 4 bytes a character in UTF-8, only encode when that could go over
+        return len(frame) * 4 > MAX_FRAME_BYTES and len(frame.encode()) > MAX_FRAME_BYTES
+    return len(frame) > MAX_FRAME_BYTES
+
+
+# Private attributes of Twisted's FileDescriptor that unsent_bytes() reads
+TRANSPORT_BUFFER_ATTRIBUTES = ('dataBuffer', 'offset', '_tempDataLen')
+
+
+def transport_of(send):
+    # Daphne passes consumers send=partial(server.handle_reply, protocol), the
+    # protocol's Twisted transport holds what the client hasn't read yet. None
+    # if it doesn't look like one, then only the queue length is checked
+    protocol = next(iter(getattr(send, 'args', ())), None)
+    transport = getattr(protocol, 'transport', None)
+    if transport is None or not all(hasattr(transport, name) for name in TRANSPORT_BUFFER_ATTRIBUTES):
+        return None
+    return transport
+
+
+def unsent_bytes(transport):
+    return len(transport.dataBuffer) - transport.offset + transport._tempDataLen
+
+
+_buckets = OrderedDict()  # (user, scope) -> TokenBucket, shared by the user's sockets in this process
+
+
+def allow(user_key, scope, rate=None, burst=None):
+    rate = RATE_LIMIT if rate is None else rate
+    burst = RATE_BURST if burst is None else burst
+    key = (user_key, scope)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = _buckets[key] = TokenBucket(burst)
+        if len(_buckets) > MAX_BUCKETS:
+            _buckets.popitem(last=False)
+    else:
+        _buckets.move_to_end(key)
+    return bucket.take(rate, burst)
+
+
+class FlowControlMixin:
+    """
+    Mixin for AsyncWebsocketConsumer subclasses. Incoming frames are
+    checked, decoded and passed to receive_frame(data); send() queues and
+    send_frame(frame) encodes and queues. Connections that negotiated the
+    MessagePack subprotocol send and receive binary frames, everything sent
+    as text is converted. Subclasses can override rate_scope(data) to choose
+    the bucket a frame is charged to, by default the connection's history_key,
+    and list in key_fields the frame fields they use as keys: frames where
+    those aren't strings are refused as malformed. Frames are measured under
+    their type when it is in frame_types (see instrumentation.frame_decoded).
+    """
+
+    key_fields = ()
+    frame_types = frozenset()
+    outbox = None
+    writer = None
+    transport = None
+    evicted = False
+    binary = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None and serialization.MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', ()):
+            subprotocol = serialization.MSGPACK_SUBPROTOCOL
+        self.binary = subprotocol == serialization.MSGPACK_SUBPROTOCOL
+        self.transport = transport_of(self.base_send)
+        await super().accept(subprotocol=subprotocol, headers=headers)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # MessagePack connections may still send text frames, as JSON
+        frame = text_data if text_data is not None else bytes_data if self.binary else None
+        if frame is None:
+            drops['unsupported'] += 1
+            await self.send_frame(events.error(f"Binary frames need the {serialization.MSGPACK_SUBPROTOCOL} subprotocol"))
+            return
+        if too_large(frame):
+            drops['too_large'] += 1
+            await self.send_frame(events.error("Frame too large"))
+            return
+        try:
+            data = json.loads(frame) if isinstance(frame, str) else serialization.unpack(frame)
+        except (ValueError, TypeError):
+            drops['malformed'] += 1
+            logger.exception("Could not decode a frame from %s", self.channel_name)
+            await self.send_frame(events.error("Malformed frame"))
+            return
+        if not isinstance(data, dict) or any(
+            data.get(field) is not None and not isinstance(data[field], str) for field in ('type', *self.key_fields)
+        ):
+            drops['malformed'] += 1
+            await self.send_frame(events.error("Malformed frame"))
+            return
+        instrumentation.frame_decoded(self, data)
+
+        if data.get("type") not in FREE_FRAMES:
+            user = self.scope.get('user')
+            user_key = user.id if user is not None and user.is_authenticated else self.channel_name
+            if not allow(user_key, self.rate_scope(data)):
+                drops['rate_limited'] += 1
+                await self.send_frame(events.error("Rate limit exceeded", data.get("stream")))
+                return
+
+        await self.receive_frame(data)
+
+    def rate_scope(self, data):
+        return getattr(self, 'history_key', None)
+
+    async def send_frame(self, frame):
+        if self.binary:
+            await self.send(bytes_data=serialization.pack(frame))
+        else:
+            await self.send(text_data=serialization.dumps(frame))
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if self.binary and text_data is not None:
+            # Frames encoded once for every recipient, e.g. live events
+            text_data, bytes_data = None, serialization.pack_text(text_data)
+        if close:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        if self.evicted:
+            drops['after_eviction'] += 1
+            return
+
+        if self.outbox is None:
+            self.outbox = deque()
+            self.ready = asyncio.Event()
+        if len(self.outbox) >= SEND_QUEUE_SIZE or (
+            self.transport is not None and unsent_bytes(self.transport) > SEND_BUFFER_BYTES
+        ):
+            await self.evict()
+            return
+        self.outbox.append((text_data, bytes_data))
+        self.ready.set()
+        if self.writer is None:
+            self.writer = asyncio.ensure_future(self.write_outbox())
+
+    async def write_outbox(self):
+        # The one task writing to the socket, so frames keep their order
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.outbox and not self.evicted:
+                    text_data, bytes_data = self.outbox.popleft()
+                    await super().send(text_data=text_data, bytes_data=bytes_data)
+        except Exception:
+            # Frames queued after this one could only arrive out of order, give up on the socket
+            logger.exception("Writing to %s failed, closing it", self.channel_name)
+            drops['write_failed'] += 1
+            self.evicted = True
+            self.outbox.clear()
+            await self.close(code=CLOSE_INTERNAL_ERROR)
+
+    async def evict(self):
+        self.evicted = True
+        drops['evicted'] += 1
+        drops['queued_at_eviction'] += len(self.outbox)
+        self.outbox.clear()
+        await self.close(code=CLOSE_TOO_SLOW)
+
+    async def websocket_disconnect(self, message):
+        if self.writer is not None:
+            self.writer.cancel()
+        await super().websocket_disconnect(message)
@@ -0,0 +1,177 @@
+# chat/history.py
+from collections import namedtuple
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q, Subquery
+from django.utils import timezone
+
+from .models import Message, DirectMessage, ArchivedMessage, ArchivedDirectMessage
+from . import archive
+from . import serialization
+
+HISTORY_PAGE_SIZE = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+BASIC_RETENTION = timezone.timedelta(days=1)
+
+# A history row with its sequence number, the order used for paging, and the dict sent to clients
+Entry = namedtuple('Entry', 'seq id timestamp message')
+
+
+def retention_cutoff(user):
+    # Basic users only see the last 24 hours, pro users see everything
+    if user.user_type == 'pro':
+        return None
+    return timezone.now() - BASIC_RETENTION
+
+
+def parse_cursor(data):
+    # A cursor is the (timestamp, id) of the oldest message the client holds
+    if not isinstance(data, dict):
+        return None
+    try:
+        timestamp = datetime.fromisoformat(data['timestamp'])
+        message_id = int(data['message_id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    return timestamp, message_id
+
+
+def make_cursor(timestamp, message_id):
+    return {"timestamp": timestamp.isoformat(), "message_id": message_id}
+
+
+def parse_seq_cursor(data):
+    # A history cursor is the sequence number of the oldest message the client holds
+    if not isinstance(data, dict):
+        return None
+    try:
+        return int(data['seq'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def paginate(queryset, cutoff=None, before=None, limit=None, field='timestamp'):
+    """
+    Return the newest `limit` rows of `queryset` newer than `cutoff` and older
+    than the `before` cursor, oldest first, as (rows, has_more). Rows are
+    ordered by (`field`, id).
+    """
+    limit = limit or HISTORY_PAGE_SIZE
+
+    if cutoff is not None:
+        queryset = queryset.filter(**{f'{field}__gte': cutoff})
+
+    if before is not None:
+        timestamp, row_id = before
+        queryset = queryset.filter(Q(**{f'{field}__lt': timestamp}) | Q(**{field: timestamp, 'id__lt': row_id}))
+
+    rows = list(queryset.order_by(f'-{field}', '-id')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more
+
+
+def paginate_seq(queryset, cutoff=None, before=None, limit=None):
+    """
+    Like paginate() for messages, ordered by their sequence number and with
+    `before` a sequence number. Rows without a number are left out until
+    sequences.number_older() has numbered them.
+    """
+    limit = limit or HISTORY_PAGE_SIZE
+    queryset = queryset.filter(seq__isnull=False)
+
+    if cutoff is not None:
+        # Start the seq range at the first message of the retention window,
+        # one lookup on the timestamp index, instead of checking the timestamp
+        # of every row walked on the seq index. The timestamp filter still
+        # drops the odd older row numbered after that first one
+        first = queryset.filter(timestamp__gte=cutoff).order_by('timestamp', 'id').values('seq')[:1]
+        queryset = queryset.filter(seq__gte=Subquery(first), timestamp__gte=cutoff)
+    if before is not None:
+        queryset = queryset.filter(seq__lt=before)
+
+    rows = list(queryset.order_by('-seq')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more
+
+
+def paginate_archived(queryset, archived, cutoff=None, before=None, limit=None):
+    """
+    paginate_seq() over the hot table, continued into the `archived` queryset
+    when the page reaches back to where rows may have been archived.
+    """
+    limit = limit or HISTORY_PAGE_SIZE
+    rows, has_more = paginate_seq(queryset, cutoff, before, limit)
+
+    horizon = archive.horizon()
+    if cutoff is not None and cutoff >= horizon:
+        return rows, has_more
+    if has_more and rows[0]['timestamp'] >= horizon:
+        return rows, has_more
+
+    # Archiving runs in batches, so old rows can be in either table until it finishes
+    older, older_more = paginate_seq(archived, cutoff, before, limit)
+    rows = sorted(rows + older, key=lambda row: row['seq'])
+    return rows[-limit:], has_more or older_more or len(rows) > limit
+
+
+def to_page(entries, has_more):
+    # Entries -> the (messages, cursor, has_more) sent to clients
+    cursor = {"seq": entries[0].seq} if entries else None
+    return [entry.message for entry in entries], cursor, has_more
+
+
+# Columns read for room_entry() and direct_entry()
+ROOM_FIELDS = ('id', 'username', 'message', 'timestamp', 'seq', 'client_id')
+DIRECT_FIELDS = ('sender__username', 'message', 'timestamp', 'id', 'seq', 'client_id')
+
+
+def room_entry(row):
+    # The client_id lets a reconnecting client see which of its unconfirmed messages were stored
+    return Entry(row['seq'], row['id'], row['timestamp'], serialization.message(
+        row['id'], row['username'], row['message'], row['timestamp'], seq=row['seq'], client_id=row['client_id']
+    ))
+
+
+def direct_entry(row):
+    return Entry(row['seq'], row['id'], row['timestamp'], serialization.message(
+        row['id'], row['sender__username'], row['message'], row['timestamp'], seq=row['seq'],
+        client_id=row['client_id'],
+    ))
+
+
+def message_entry(message, timestamp):
+    # An entry for a message dict from a live event, e.g. to add to hot history
+    return Entry(message['seq'], message['message_id'], timestamp, message)
+
+
+def room_entries(room_id, cutoff=None, before=None, limit=None):
+    rows, has_more = paginate_archived(
+        Message.objects.filter(room_id=room_id).values(*ROOM_FIELDS),
+        ArchivedMessage.objects.filter(room_id=room_id).values(*ROOM_FIELDS),
+        cutoff, before, limit,
+    )
+    return [room_entry(row) for row in rows], has_more
+
+
+def direct_entries(conversation, cutoff=None, before=None, limit=None):
+    rows, has_more = paginate_archived(
+        DirectMessage.objects.filter(conversation=conversation).values(*DIRECT_FIELDS),
+        ArchivedDirectMessage.objects.filter(conversation=conversation).values(*DIRECT_FIELDS),
+        cutoff, before, limit,
+    )
+    return [direct_entry(row) for row in rows], has_more
+
+
+def room_history(room_id, user, before=None, limit=None):
+    return to_page(*room_entries(room_id, retention_cutoff(user), before, limit))
+
+
+def direct_history(user, receiver, before=None, limit=None):
+    conversation = DirectMessage.conversation_key(user, receiver)
+    return to_page(*direct_entries(conversation, retention_cutoff(user), before, limit))
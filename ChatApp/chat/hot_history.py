@@ -0,0 +1,197 @@
+# chat/hot_history.py
+import bisect
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics
+from .history import HISTORY_PAGE_SIZE, to_page
+
+PER_ROOM = getattr(settings, 'CHAT_HOT_HISTORY_PER_ROOM', 200)
+MAX_MESSAGES = getattr(settings, 'CHAT_HOT_HISTORY_MAX_MESSAGES', 50000)
+
+
+def sort_key(entry):
+    return entry.seq
+
+
+class Buffer:
+    __slots__ = ('entries', 'ids', 'complete')
+
+    def __init__(self, entries, complete):
+        self.entries = entries      # history entries sorted by seq
+        self.ids = {entry.id for entry in entries}
+        self.complete = complete    # nothing older than entries[0] exists
+
+
+class HotHistory:
+    """
+    Newest messages of each room or conversation with a subscriber in this
+    process, kept in the form they are sent to clients.
+
+    Buffers are seeded from the database on a miss and then kept current
+    from the message_created/message_deleted events consumers receive. A
+    process only sees those events while it has a subscriber, so a buffer is
+    dropped when its last local subscriber leaves. Buffers are evicted least
+    recently used first once more than `max_messages` are held in total.
+    """
+
+    def __init__(self, per_room=PER_ROOM, max_messages=MAX_MESSAGES):
+        self.per_room = per_room
+        self.max_messages = max_messages
+        self.buffers = OrderedDict()
+        self.subscribers = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def attach(self, key):
+        self.subscribers[key] = self.subscribers.get(key, 0) + 1
+
+    def detach(self, key):
+        count = self.subscribers.pop(key, 0) - 1
+        if count > 0:
+            self.subscribers[key] = count
+        else:
+            self._drop(key)
+
+    def page(self, key, cutoff=None, before=None, limit=None):
+        """
+        Return (messages, cursor, has_more) like history.room_history, or None
+        if the buffer can't answer and the database has to.
+        """
+        limit = limit or HISTORY_PAGE_SIZE
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            self.misses += 1
+            return None
+
+        entries = buffer.entries
+        end = len(entries) if before is None else bisect.bisect_left(entries, before, key=sort_key)
+        start = max(0, end - limit)
+        if cutoff is not None:
+            # Timestamps follow seq closely enough for the retention cutoff
+            start = max(start, bisect.bisect_left(entries, cutoff, 0, end, key=lambda entry: entry.timestamp))
+
+        if start > 0:
+            # Stopped at the page size or at the retention cutoff within the buffer
+            has_more = end - start == limit and (cutoff is None or entries[start - 1].timestamp >= cutoff)
+        elif buffer.complete:
+            has_more = False
+        elif end - start == limit:
+            has_more = True
+        else:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.buffers.move_to_end(key)
+        return to_page(entries[start:end], has_more)
+
+    def since(self, key, seq, cutoff=None):
+        """
+        Entries after `seq`, for resuming a client that holds messages up to
+        it. None if the buffer may not hold them all.
+        """
+        buffer = self.buffers.get(key)
+        if buffer is None or not (buffer.complete or (buffer.entries and buffer.entries[0].seq <= seq + 1)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        start = bisect.bisect_right(buffer.entries, seq, key=sort_key)
+        return [entry for entry in buffer.entries[start:] if cutoff is None or entry.timestamp >= cutoff]
+
+    def seed(self, key, entries, complete):
+        # Only buffer what we will hear about, see detach()
+        if key not in self.subscribers:
+            return
+        self._drop(key)
+        if len(entries) > self.per_room:
+            entries, complete = entries[-self.per_room:], False
+        self.buffers[key] = Buffer(list(entries), complete)
+        self.size += len(entries)
+        self._evict()
+
+    def holds(self, key, message_id):
+        buffer = self.buffers.get(key)
+        return buffer is not None and message_id in buffer.ids
+
+    def wants(self, key, message_id):
+        # Cheap check before building an entry, most events are already buffered
+        buffer = self.buffers.get(key)
+        return buffer is not None and message_id not in buffer.ids
+
+    def append(self, key, entry):
+        buffer = self.buffers.get(key)
+        # Every local subscriber sees the same event, only the first one counts
+        if buffer is None or entry.id in buffer.ids:
+            return
+
+        entries = buffer.entries
+        if not entries or sort_key(entry) >= sort_key(entries[-1]):
+            entries.append(entry)
+        else:
+            bisect.insort(entries, entry, key=sort_key)
+        buffer.ids.add(entry.id)
+        self.size += 1
+
+        if len(entries) > self.per_room:
+            buffer.ids.discard(entries.pop(0).id)
+            buffer.complete = False
+            self.size -= 1
+        self._evict()
+
+    def remove(self, key, message_id):
+        buffer = self.buffers.get(key)
+        if buffer is None or message_id not in buffer.ids:
+            return
+        buffer.ids.discard(message_id)
+        buffer.entries = [entry for entry in buffer.entries if entry.id != message_id]
+        self.size -= 1
+
+    def _drop(self, key):
+        buffer = self.buffers.pop(key, None)
+        if buffer is not None:
+            self.size -= len(buffer.entries)
+
+    def _evict(self):
+        while self.size > self.max_messages and self.buffers:
+            _, buffer = self.buffers.popitem(last=False)
+            self.size -= len(buffer.entries)
+
+
+hot_history = HotHistory()
+
+
+def _subscribers():
+    # Sockets per room in this process; conversations have two members at most, so they are summed
+    counts = {}
+    for (kind, key), count in hot_history.subscribers.items():
+        label = (str(key),) if kind == 'room' else ('dm',)
+        counts[label] = counts.get(label, 0) + count
+    return counts
+
+
+metrics.registry.callback(
+    'gauge', 'chat_room_sockets', "Sockets subscribed to each room, by room id.", _subscribers, ['room'],
+)
+metrics.registry.callback(
+    'counter', 'chat_hot_history_total', "History pages answered from memory (hit) or the database (miss).",
+    lambda: {('hit',): hot_history.hits, ('miss',): hot_history.misses}, ['result'],
+)
+
+
+async def load_page(key, cutoff, before, load_recent, load_page_from_db):
+    """
+    Serve a history page from the hot buffer, seeding the buffer from
+    `load_recent()` on an initial-page miss, and fall back to
+    `load_page_from_db()` for pages older than the buffer holds.
+    """
+    page = hot_history.page(key, cutoff, before)
+    if page is None and before is None:
+        entries, has_more = await load_recent()
+        hot_history.seed(key, entries, complete=not has_more)
+        page = hot_history.page(key, cutoff, before)
+    if page is None:
+        page = await load_page_from_db()
+    return page
@@ -0,0 +1,81 @@
+# chat/idempotency.py
+# Drops client retries of a message that was already sent.
+#
+# Message frames may carry a "client_id" the client picks once per message
+# and repeats when it resends it, e.g. after a reconnect. The most recent
+# CHAT_RECENT_CLIENT_IDS ids are remembered per process with the frame that
+# was broadcast for them: a retry gets that frame back instead of storing
+# the message twice.
+#
+# A reconnect can reach another worker process, which hasn't seen the id.
+# Messages store their client_id, unique per sender in a room or
+# conversation, so history tells the client which of its messages arrived,
+# and a resend ("retry": true) that misses here is written at once instead
+# of queued: if the insert hits the unique constraint the message is a
+# duplicate, and its sender gets the stored copy instead of a broadcast.
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import Message, DirectMessage
+
+RECENT_CLIENT_IDS = getattr(settings, 'CHAT_RECENT_CLIENT_IDS', 10000)
+MAX_CLIENT_ID_LENGTH = 64
+
+# Stands for a message still being saved, its retry is just dropped
+PENDING = ''
+
+# Besides the client_id, the fields of each model's unique constraint on it
+SENDER_FIELDS = {Message: ('room_id', 'username'), DirectMessage: ('conversation', 'sender_id')}
+
+
+def clean(client_id):
+    # The client_id as stored, None if the frame has no usable one
+    if client_id is None or not isinstance(client_id, (str, int)):
+        return None
+    return str(client_id)[:MAX_CLIENT_ID_LENGTH]
+
+
+def stored_copy(obj):
+    # The other row stored with the same sender and client_id as `obj`, or None
+    if obj.client_id is None:
+        return None
+    model = type(obj)
+    scope = {field: getattr(obj, field) for field in SENDER_FIELDS[model]}
+    return model.objects.filter(client_id=obj.client_id, **scope).exclude(id=obj.id).first()
+
+
+class RecentKeys:
+    def __init__(self, size=RECENT_CLIENT_IDS):
+        self.size = size
+        self.keys = OrderedDict()  # (user, history key, client id) -> encoded frame, or PENDING
+
+    def key(self, user_key, history_key, client_id):
+        client_id = clean(client_id)
+        if client_id is None:
+            return None
+        return user_key, history_key, client_id
+
+    def claim(self, key):
+        """
+        Return None if `key` is new, after marking it as being sent, or what
+        was sent for it before: the frame text, or PENDING.
+        """
+        sent = self.keys.get(key)
+        if sent is not None:
+            self.keys.move_to_end(key)
+            return sent
+        self.keys[key] = PENDING
+        if len(self.keys) > self.size:
+            self.keys.popitem(last=False)
+        return None
+
+    def sent(self, key, text):
+        self.keys[key] = text
+
+    def release(self, key):
+        # The message wasn't sent, a retry should go through
+        self.keys.pop(key, None)
+
+
+recent_keys = RecentKeys()
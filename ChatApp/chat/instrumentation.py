@@ -0,0 +1,219 @@
+# chat/instrumentation.py
+# Query count, database time, wall time and database thread hops per HTTP
+# view and WebSocket event.
+#
+# QueryBudgetMiddleware measures requests and InstrumentedMixin measures
+# everything a consumer dispatches (connect, each frame type, group events).
+# Queries are counted by an execute wrapper installed on every connection
+# (see signals.py); the measurement in progress travels in a context
+# variable, which sync_to_async copies into the database threads. Hops are
+# calls made through db.database_sync_to_async, each a trip through the
+# database thread pool's queue. Batched work an event only triggers, like
+# write-behind flushes and sequence reservations, starts in an empty context
+# and isn't charged to it.
+#
+# Totals per name are kept in `stats`. A measurement over its budget, from
+# CHAT_BUDGETS by name or CHAT_BUDGET otherwise, is logged as a warning.
+# Tests can wrap code in assert_budget() to fail when it costs more.
+# Every measurement also goes to the metrics registry (see metrics.py).
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = {'queries': 20, 'db_ms': 100, 'wall_ms': 500, 'hops': 3}
+BUDGET = {**DEFAULT_BUDGET, **getattr(settings, 'CHAT_BUDGET', {})}
+BUDGETS = getattr(settings, 'CHAT_BUDGETS', {})  # name -> budget overriding some of BUDGET
+
+current = contextvars.ContextVar('chat_measurement', default=None)
+stats = {}       # name -> Stat
+listeners = []   # callables given every finished Measurement
+
+
+class Measurement:
+    __slots__ = ('name', 'queries', 'hops', 'db_time', 'wall_time', 'started', 'open')
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = self.hops = 0
+        self.db_time = 0.0
+        self.wall_time = 0.0
+        self.started = time.perf_counter()
+        self.open = True
+
+    def over(self, budget):
+        # The parts of `budget` this measurement exceeded, as readable strings
+        exceeded = []
+        if budget.get('queries') is not None and self.queries > budget['queries']:
+            exceeded.append(f"{self.queries} queries > {budget['queries']}")
+        if budget.get('db_ms') is not None and self.db_time * 1000 > budget['db_ms']:
+            exceeded.append(f"{self.db_time * 1000:.1f} ms db > {budget['db_ms']}")
+        if budget.get('wall_ms') is not None and self.wall_time * 1000 > budget['wall_ms']:
+            exceeded.append(f"{self.wall_time * 1000:.1f} ms wall > {budget['wall_ms']}")
+        if budget.get('hops') is not None and self.hops > budget['hops']:
+            exceeded.append(f"{self.hops} hops > {budget['hops']}")
+        return exceeded
+
+
+class Stat:
+    __slots__ = ('count', 'queries', 'hops', 'db_time', 'wall_time', 'max_wall_time', 'over_budget')
+
+    def __init__(self):
+        self.count = self.queries = self.hops = self.over_budget = 0
+        self.db_time = self.wall_time = self.max_wall_time = 0.0
+
+    def add(self, measurement, over):
+        self.count += 1
+        self.queries += measurement.queries
+        self.hops += measurement.hops
+        self.db_time += measurement.db_time
+        self.wall_time += measurement.wall_time
+        self.max_wall_time = max(self.max_wall_time, measurement.wall_time)
+        self.over_budget += bool(over)
+
+
+def budget_for(name):
+    return {**BUDGET, **BUDGETS.get(name, {})}
+
+
+@contextmanager
+def measure(name):
+    measurement = Measurement(name)
+    token = current.set(measurement)
+    try:
+        yield measurement
+    finally:
+        current.reset(token)
+        finish(measurement)
+
+
+def rename(name):
+    # Called once a measurement knows what it is, e.g. after decoding a frame
+    measurement = current.get()
+    if measurement is not None:
+        measurement.name = name
+
+
+def finish(measurement):
+    # Work started by the event but running after it, like write-behind flushes, isn't counted
+    measurement.open = False
+    measurement.wall_time = time.perf_counter() - measurement.started
+    over = measurement.over(budget_for(measurement.name))
+    stats.setdefault(measurement.name, Stat()).add(measurement, over)
+    metrics.event_seconds.labels(measurement.name).observe(measurement.wall_time)
+    metrics.event_queries.labels(measurement.name).inc(measurement.queries)
+    metrics.event_hops.labels(measurement.name).inc(measurement.hops)
+    if over:
+        logger.warning("%s over budget: %s", measurement.name, ", ".join(over))
+    for listener in listeners:
+        listener(measurement)
+
+
+def record_query(execute, sql, params, many, context):
+    measurement = current.get()
+    if measurement is None or not measurement.open:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        measurement.queries += 1
+        measurement.db_time += time.perf_counter() - started
+
+
+def hop():
+    measurement = current.get()
+    if measurement is not None and measurement.open:
+        measurement.hops += 1
+
+
+def install(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with measure(f"http {request.method} {request.path}") as measurement:
+            response = self.get_response(request)
+            match = getattr(request, 'resolver_match', None)
+            if match is not None:
+                # One name per view rather than per URL
+                measurement.name = f"http {request.method} {match.view_name}"
+        return response
+
+
+def frame_decoded(consumer, data):
+    # Frames are measured under their own type rather than websocket.receive,
+    # types the consumer doesn't handle under one name so `stats` stays bounded
+    frame_type = data.get('type')
+    if frame_type not in consumer.frame_types:
+        frame_type = 'unknown'
+    rename(f"ws {type(consumer).__name__} {frame_type}")
+
+
+class InstrumentedMixin:
+    """
+    Mixin for consumers, measuring every message dispatch under
+    "ws <Consumer> <message type>". With flow.FlowControlMixin, client
+    frames are measured under their frame type instead. Open sockets and
+    the latency of group events go to the metrics registry.
+    """
+
+    accepted = False
+
+    async def dispatch(self, message):
+        sent_at = message.get("sent_at")
+        if sent_at is not None:
+            metrics.fanout_latency.labels(message['type']).observe(time.time() - sent_at)
+        with measure(f"ws {type(self).__name__} {message['type']}"):
+            await super().dispatch(message)
+
+    async def accept(self, *args, **kwargs):
+        await super().accept(*args, **kwargs)
+        self.accepted = True
+        metrics.sockets.labels(type(self).__name__).inc()
+        metrics.registry.start_publishing()
+
+    async def websocket_disconnect(self, message):
+        if self.accepted:
+            self.accepted = False
+            metrics.sockets.labels(type(self).__name__).dec()
+        await super().websocket_disconnect(message)
+
+
+@contextmanager
+def assert_budget(name=None, queries=None, db_ms=None, wall_ms=None, hops=None):
+    """
+    Fail with AssertionError if anything measured inside the block whose
+    name starts with `name` exceeded the given limits, e.g.
+
+        with assert_budget("http GET chat:room", queries=6):
+            client.get(...)
+
+    Yields the list of measurements seen, for further checks.
+    """
+    seen = []
+    listeners.append(seen.append)
+    try:
+        yield seen
+    finally:
+        listeners.remove(seen.append)
+    budget = {'queries': queries, 'db_ms': db_ms, 'wall_ms': wall_ms, 'hops': hops}
+    failures = [
+        f"{measurement.name}: {', '.join(over)}"
+        for measurement in seen
+        if name is None or measurement.name.startswith(name)
+        for over in [measurement.over(budget)] if over
+    ]
+    if failures:
+        raise AssertionError("Over budget:\n" + "\n".join(failures))
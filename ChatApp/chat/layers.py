@@ -0,0 +1,339 @@
+# chat/layers.py
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import string
+import struct
+import tempfile
+import threading
+import time
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+FRAME_HEADER = struct.Struct('!I')
+
+logger = logging.getLogger(__name__)
+
+# Seconds a registry write keeps retrying while another worker holds the lock
+WRITE_TIMEOUT = 30
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """
+    Channel layer for several worker processes on one host, with no broker.
+
+    Group membership lives in a small SQLite file shared by the workers. Every
+    worker listens on its own Unix-domain socket in `path`, and its channel
+    names embed the worker's id, so a group_send writes one frame per worker
+    process that has members in the group. Messages are queued in memory in
+    the receiving worker, bounded by `capacity` like InMemoryChannelLayer.
+
+    Only process-specific channels ("prefix!suffix", which is what consumers
+    use) are delivered across processes; plain channel names stay local.
+
+    group_send stamps each message with "sent_at" (time.time()), so the
+    receiving consumer can tell how long the fan-out took.
+
+    Registry writes run in a thread and back off while another worker holds
+    the write lock. Reads use their own connections, one per thread, which
+    WAL mode never makes wait on a writer, so group_send reads on the event
+    loop and only falls back to a thread if SQLite reports it busy anyway.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        path=None,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        **kwargs,
+    ):
+        super().__init__(
+            expiry=expiry,
+            capacity=capacity,
+            channel_capacity=channel_capacity,
+            **kwargs,
+        )
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.group_expiry = group_expiry
+        self.path = str(path or os.path.join(tempfile.gettempdir(), 'chatapp-channels'))
+        self.worker = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(12))
+        self.channels = {}
+        self.peers = {}
+        self.dropped = 0  # messages dropped on full channels in this process
+        self.group_sends = 0
+        self.fanout = 0  # channels group_send delivered to, in any process
+        self.server = None
+        self._registry = None
+        self._registry_lock = threading.Lock()
+        self._readers = threading.local()
+        self._server_lock = None
+
+    # Shared group registry
+
+    def _open(self, timeout, check_same_thread=True):
+        return sqlite3.connect(
+            os.path.join(self.path, 'groups.sqlite3'), timeout=timeout, isolation_level=None,
+            check_same_thread=check_same_thread,
+        )
+
+    def _connect_registry(self):
+        if self._registry is None:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            # Each attempt waits briefly, _write backs off between attempts without holding the lock
+            db = self._open(timeout=0.5, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS groups ("
+                "name TEXT NOT NULL, channel TEXT NOT NULL, worker TEXT NOT NULL, joined REAL NOT NULL, "
+                "PRIMARY KEY (name, channel))"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS groups_worker ON groups (worker)")
+            self._registry = db
+        return self._registry
+
+    def _execute(self, sql, params=()):
+        with self._registry_lock:
+            return self._connect_registry().execute(sql, params).fetchall()
+
+    def _ensure_registry(self):
+        if self._registry is None:
+            with self._registry_lock:
+                self._connect_registry()
+
+    async def _write(self, sql, params=()):
+        # Writes can wait on another worker's lock, keep them off the event loop
+        deadline = time.monotonic() + WRITE_TIMEOUT
+        delay = 0.01
+        while True:
+            try:
+                return await asyncio.to_thread(self._execute, sql, params)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e) or time.monotonic() > deadline:
+                    raise
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, 1.0)
+
+    async def _cleanup(self, sql, params=()):
+        # Writes that can be skipped, expired rows are filtered out of reads and deleted later
+        try:
+            await self._write(sql, params)
+        except sqlite3.OperationalError:
+            logger.warning("Group registry busy, skipped: %s", sql)
+
+    def _read(self, sql, params=()):
+        # Callers make sure the table exists with _ensure_registry() first
+        reader = getattr(self._readers, 'db', None)
+        if reader is None:
+            # The event loop's reader never waits, see group_send
+            reader = self._readers.db = self._open(timeout=0 if self._on_loop() else 5)
+        return reader.execute(sql, params).fetchall()
+
+    def _on_loop(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return True
+
+    # Local queues
+
+    def _queue(self, channel):
+        return self.channels.setdefault(channel, asyncio.Queue(maxsize=self.get_capacity(channel)))
+
+    def _deliver(self, channel, message):
+        try:
+            self._queue(channel).put_nowait((time.time() + self.expiry, message))
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+
+    def _clean_expired(self):
+        now = time.time()
+        for channel, queue in list(self.channels.items()):
+            while not queue.empty() and queue._queue[0][0] < now:
+                queue.get_nowait()
+            if queue.empty() and not queue._getters:
+                self.channels.pop(channel, None)
+
+    @property
+    def queued(self):
+        return sum(queue.qsize() for queue in self.channels.values())
+
+    def _worker_of(self, channel):
+        # Channel names look like "specific.<worker>!<suffix>"
+        if '!' not in channel:
+            return self.worker
+        return channel.split('!', 1)[0].rsplit('.', 1)[-1]
+
+    # Cross-process transport
+
+    def _socket_path(self, worker):
+        return os.path.join(self.path, f'{worker}.sock')
+
+    async def _ensure_server(self):
+        if self.server is not None:
+            return
+        if self._server_lock is None:
+            self._server_lock = asyncio.Lock()
+        async with self._server_lock:
+            if self.server is None:
+                os.makedirs(self.path, mode=0o700, exist_ok=True)
+                self.server = await asyncio.start_unix_server(self._serve_peer, path=self._socket_path(self.worker))
+
+    async def _serve_peer(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                channels, message = msgpack.unpackb(
+                    await reader.readexactly(FRAME_HEADER.unpack(header)[0]), raw=False
+                )
+                for channel in channels:
+                    try:
+                        self._deliver(channel, message)
+                    except ChannelFull:
+                        # Same as a local group_send, a full channel drops the message
+                        self.dropped += 1
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _send_to_worker(self, worker, channels, message):
+        payload = msgpack.packb([channels, message], use_bin_type=True)
+        for attempt in range(2):
+            writer = self.peers.get(worker)
+            try:
+                if writer is None or writer.is_closing():
+                    _, writer = await asyncio.open_unix_connection(self._socket_path(worker))
+                    self.peers[worker] = writer
+                writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+                await writer.drain()
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The worker has exited, forget its group memberships
+                self.peers.pop(worker, None)
+                await self._cleanup("DELETE FROM groups WHERE worker = ?", (worker,))
+                try:
+                    os.unlink(self._socket_path(worker))
+                except FileNotFoundError:
+                    pass
+                return
+            except ConnectionError:
+                # Stale connection to a restarted peer, reconnect once
+                self.peers.pop(worker, None)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+
+        worker = self._worker_of(channel)
+        if worker == self.worker:
+            self._deliver(channel, msgpack.unpackb(msgpack.packb(message, use_bin_type=True), raw=False))
+        else:
+            await self._send_to_worker(worker, [channel], message)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        self._clean_expired()
+
+        queue = self._queue(channel)
+        try:
+            _, message = await queue.get()
+        finally:
+            if queue.empty() and not queue._getters:
+                self.channels.pop(channel, None)
+        return message
+
+    async def new_channel(self, prefix="specific"):
+        await self._ensure_server()
+        suffix = ''.join(random.choice(string.ascii_letters) for _ in range(12))
+        return f"{prefix}.{self.worker}!{suffix}"
+
+    async def flush(self):
+        self.channels = {}
+        await self._write("DELETE FROM groups")
+
+    async def close(self):
+        for writer in self.peers.values():
+            writer.close()
+        self.peers = {}
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            try:
+                os.unlink(self._socket_path(self.worker))
+            except FileNotFoundError:
+                pass
+        if self._registry is not None:
+            await self._cleanup("DELETE FROM groups WHERE worker = ?", (self.worker,))
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._write(
+            "INSERT OR REPLACE INTO groups (name, channel, worker, joined) VALUES (?, ?, ?, ?)",
+            (group, channel, self._worker_of(channel), time.time()),
+        )
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        # A membership left behind expires after group_expiry, or when its worker exits
+        await self._cleanup("DELETE FROM groups WHERE name = ? AND channel = ?", (group, channel))
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        self._clean_expired()
+
+        query = "SELECT channel, worker FROM groups WHERE name = ? AND joined > ?"
+        params = (group, time.time() - self.group_expiry)
+        if self._registry is None:
+            await asyncio.to_thread(self._ensure_registry)
+        try:
+            members = self._read(query, params)
+        except sqlite3.OperationalError:
+            members = await asyncio.to_thread(self._read, query, params)
+
+        self.group_sends += 1
+        self.fanout += len(members)
+        message = {**message, "sent_at": time.time()}
+
+        by_worker = {}
+        for channel, worker in members:
+            by_worker.setdefault(worker, []).append(channel)
+
+        local = by_worker.pop(self.worker, [])
+        if local:
+            copy = msgpack.unpackb(msgpack.packb(message, use_bin_type=True), raw=False)
+            for channel in local:
+                try:
+                    self._deliver(channel, copy)
+                except ChannelFull:
+                    self.dropped += 1
+
+        await asyncio.gather(*(self._send_to_worker(worker, channels, message) for worker, channels in by_worker.items()))
+
+        # Expired memberships are filtered out above, purge them now and then
+        if random.random() < 0.01:
+            await self._cleanup("DELETE FROM groups WHERE joined <= ?", (time.time() - self.group_expiry,))
+
+    def group_sizes(self):
+        # {group: channels} across all workers, for metrics
+        self._ensure_registry()
+        return dict(self._read(
+            "SELECT name, COUNT(*) FROM groups WHERE joined > ? GROUP BY name", (time.time() - self.group_expiry,)
+        ))
@@ -0,0 +1,33 @@
+# chat/management/commands/archive_messages.py
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import archive
+from chat.history import BASIC_RETENTION
+from chat.models import Message, DirectMessage
+
+
+class Command(BaseCommand):
+    help = "Move room and direct messages older than CHAT_ARCHIVE_AFTER_DAYS into the archive tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=archive.ARCHIVE_AFTER_DAYS,
+                            help="archive messages older than this many days")
+        parser.add_argument('--batch-size', type=int, default=archive.ARCHIVE_BATCH_SIZE)
+        parser.add_argument('--pause', type=float, default=0.05,
+                            help="seconds to sleep between batches so other writers get the database")
+
+    def handle(self, *args, **options):
+        # Basic users' history is read from the hot tables only
+        if timedelta(days=options['days']) < BASIC_RETENTION:
+            raise CommandError(f"--days must cover the basic user window of {BASIC_RETENTION}.")
+
+        before = archive.horizon(options['days'])
+        for model in (Message, DirectMessage):
+            name = model._meta.verbose_name_plural
+            total = archive.archive(
+                model, before, options['batch_size'], options['pause'],
+                progress=lambda total: self.stdout.write(f"Archived {total} {name}"),
+            )
+            self.stdout.write(self.style.SUCCESS(f"Done, {total} {name} archived."))
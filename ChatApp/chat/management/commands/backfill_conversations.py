@@ -0,0 +1,42 @@
+# chat/management/commands/backfill_conversations.py
+from django.core.management.base import BaseCommand
+from django.db.models import Case, CharField, F, Value, When
+from django.db.models.functions import Cast, Concat
+
+from chat import conversations
+from chat.models import DirectMessage
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill in DirectMessage.conversation for rows written before the column existed "
+        "and build the Conversation summaries of existing conversations."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        sender = Cast('sender_id', CharField())
+        receiver = Cast('receiver_id', CharField())
+        key = Case(
+            When(sender_id__lte=F('receiver_id'), then=Concat(sender, Value('_'), receiver)),
+            default=Concat(receiver, Value('_'), sender),
+        )
+
+        total = 0
+        while True:
+            # Update in short id-ranged batches so writers are not locked out for long
+            ids = list(
+                DirectMessage.objects.filter(conversation='').order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            total += DirectMessage.objects.filter(id__gte=ids[0], id__lte=ids[-1], conversation='').update(conversation=key)
+            self.stdout.write(f"Backfilled {total} direct messages")
+
+        self.stdout.write(self.style.SUCCESS(f"Done, {total} direct messages updated."))
+
+        summaries = conversations.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the summaries of {summaries} conversations."))
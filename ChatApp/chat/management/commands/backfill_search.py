@@ -0,0 +1,52 @@
+# chat/management/commands/backfill_search.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from chat import search
+from chat.archive import ARCHIVES
+
+
+class Command(BaseCommand):
+    help = (
+        "Add existing room and direct messages, including archived ones, to the search index. "
+        "Safe to re-run, indexed rows are replaced."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--pause', type=float, default=0, help="seconds to sleep between batches")
+        parser.add_argument('--rebuild', action='store_true', help="empty the index first")
+
+    def handle(self, *args, **options):
+        if not search.available():
+            raise CommandError("Search needs an SQLite database with FTS5, run `manage.py prepare_sqlite` first.")
+
+        if options['rebuild']:
+            search.clear()
+            self.stdout.write("Emptied the search index")
+
+        for kind, (model, scope, _) in search.KINDS.items():
+            for table in (model, ARCHIVES[model][0]):
+                total = self.backfill(kind, table, scope, options['batch_size'], options['pause'])
+                self.stdout.write(self.style.SUCCESS(f"Indexed {total} {table.__name__} rows."))
+
+    def backfill(self, kind, table, scope, batch_size, pause):
+        total = 0
+        last_id = 0
+        while True:
+            # Walk the primary key in short transactions so writers get the database in between
+            rows = list(
+                table.objects.filter(id__gt=last_id).order_by('id')
+                .values_list('id', scope, 'message', 'timestamp')[:batch_size]
+            )
+            if not rows:
+                return total
+            with transaction.atomic():
+                search.index(kind, rows)
+            total += len(rows)
+            last_id = rows[-1][0]
+            self.stdout.write(f"Indexed {total} {table.__name__} rows")
+            if pause:
+                time.sleep(pause)
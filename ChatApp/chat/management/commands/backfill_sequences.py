@@ -0,0 +1,27 @@
+# chat/management/commands/backfill_sequences.py
+from django.core.management.base import BaseCommand
+
+from chat.archive import ARCHIVES
+from chat.reads import SCOPES
+from chat.sequences import number_older
+
+
+class Command(BaseCommand):
+    help = (
+        "Number room and direct messages, including archived ones, saved before they got a seq. "
+        "History pages number them when they reach them, this does it for every room and conversation "
+        "at once. Safe to run while the chat is live and to re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        for kind, (model, scope) in SCOPES.items():
+            keys = set()
+            for table in (model, ARCHIVES[model][0]):
+                keys.update(table.objects.filter(seq__isnull=True).values_list(scope, flat=True).distinct())
+            total = 0
+            for key in keys:
+                total += number_older((kind, key), options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Numbered {total} {model.__name__} rows in {len(keys)} scopes."))
@@ -0,0 +1,31 @@
+# chat/management/commands/prepare_sqlite.py
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from chat import search
+
+
+class Command(BaseCommand):
+    help = (
+        "Switch the SQLite databases to CHAT_SQLITE_JOURNAL_MODE and create the message search table. "
+        "Both are stored in the database file, run it once after migrate. Safe to re-run."
+    )
+
+    def handle(self, *args, **options):
+        journal_mode = getattr(settings, 'CHAT_SQLITE_JOURNAL_MODE', 'WAL')
+        for alias in settings.DATABASES:
+            connection = connections[alias]
+            if connection.vendor != 'sqlite':
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute(f"PRAGMA journal_mode = {journal_mode}")
+                mode = cursor.fetchone()[0]
+            self.stdout.write(f"{alias}: journal mode {mode}")
+
+        connection = connections['default']
+        if connection.vendor == 'sqlite':
+            search.create_index(connection)
+            self.stdout.write(self.style.SUCCESS(
+                "Created the search table, `manage.py backfill_search` indexes the messages already stored."
+            ))
@@ -0,0 +1,53 @@
+# chat/management/commands/runworkers.py
+import os
+import signal
+import socket
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Run several daphne worker processes sharing one listening socket."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--bind', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8000)
+
+    def handle(self, *args, **options):
+        application = settings.ASGI_APPLICATION.rsplit('.', 1)
+        application = f"{application[0]}:{application[1]}"
+
+        # Every worker accepts connections on the same inherited socket, the
+        # channel layer takes care of group fan-out between them
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((options['bind'], options['port']))
+        listener.listen(1024)
+        listener.set_inheritable(True)
+
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'ChatApp.settings'))
+        command = [sys.executable, '-m', 'daphne', '--fd', str(listener.fileno()), application]
+        workers = [
+            subprocess.Popen(command, env=env, pass_fds=(listener.fileno(),))
+            for _ in range(options['workers'])
+        ]
+        self.stdout.write(f"Started {len(workers)} workers on http://{options['bind']}:{options['port']}/")
+
+        def stop(signum, frame):
+            for worker in workers:
+                worker.terminate()
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            for worker in workers:
+                worker.wait()
+        except KeyboardInterrupt:
+            stop(None, None)
+            for worker in workers:
+                worker.wait()
+        finally:
+            listener.close()
@@ -0,0 +1,340 @@
+# chat/metrics.py
+# In-process metrics registry with a Prometheus text exposition.
+#
+# Counters, gauges and histograms are plain Python numbers updated from the
+# event loop, with no locks, so they are cheap enough for the hot path.
+# Each worker process writes a snapshot of its registry to
+# CHAT_METRICS_DIR every CHAT_METRICS_INTERVAL seconds; the metrics view
+# merges the snapshots of all live workers (counters, gauges and histogram
+# buckets are summed) with its own current values.
+#
+# Other modules register what they own, either updating a metric as things
+# happen or with a callback read at collection time, e.g. queue lengths.
+import atexit
+import asyncio
+import bisect
+import json
+import math
+import os
+import tempfile
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+METRICS_DIR = getattr(settings, 'CHAT_METRICS_DIR', None) or os.path.join(tempfile.gettempdir(), 'chatapp-metrics')
+METRICS_INTERVAL = getattr(settings, 'CHAT_METRICS_INTERVAL', 5)
+
+MAX_SERIES = 1000  # label combinations per metric, later ones are folded into "other"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}  # label values -> child
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None and len(self.children) >= MAX_SERIES:
+            values = ('other',) * len(values)
+            child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def samples(self):
+        return {values: child.value() for values, child in self.children.items()}
+
+
+class CounterChild:
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 0
+
+    def inc(self, amount=1):
+        self.count += amount
+
+    def value(self):
+        return self.count
+
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.count -= amount
+
+    def set(self, value):
+        self.count = value
+
+
+class HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, amount):
+        self.counts[bisect.bisect_left(self.bounds, amount)] += 1
+        self.sum += amount
+
+    def value(self):
+        return [list(self.counts), self.sum]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def new_child(self):
+        return GaugeChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, amount):
+        self._default.observe(amount)
+
+
+class Callback(Metric):
+    """A counter or gauge read from elsewhere when collected. `read()` returns {label values: value}."""
+
+    def __init__(self, kind, name, help, labelnames, read):
+        self.kind = kind
+        self.read = read
+        super().__init__(name, help, labelnames)
+
+    def new_child(self):
+        return None
+
+    def samples(self):
+        return self.read()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._task = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, kind, name, help, read, labelnames=()):
+        return self.register(Callback(kind, name, help, labelnames, read))
+
+    def snapshot(self):
+        # JSON-friendly {name: [kind, help, labelnames, buckets, [[label values, value], ...]]}
+        return {
+            metric.name: [
+                metric.kind, metric.help, list(metric.labelnames), list(getattr(metric, 'buckets', ())),
+                [[list(values), value] for values, value in metric.samples().items()],
+            ]
+            for metric in self.metrics.values()
+        }
+
+    # Sharing between worker processes
+
+    def _path(self, pid=None):
+        return os.path.join(METRICS_DIR, f'{pid or os.getpid()}.json')
+
+    def start_publishing(self):
+        # Called from the event loop, e.g. when a socket connects
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._publish())
+            atexit.register(self._unpublish)
+
+    async def _publish(self):
+        while True:
+            self.publish()
+            await asyncio.sleep(METRICS_INTERVAL)
+
+    def publish(self):
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        temporary = self._path() + '.tmp'
+        with open(temporary, 'w') as output:
+            json.dump({"time": time.time(), "metrics": self.snapshot()}, output)
+        os.replace(temporary, self._path())
+
+    def _unpublish(self):
+        try:
+            os.unlink(self._path())
+        except FileNotFoundError:
+            pass
+
+    def collect(self):
+        """This process's snapshot merged with the published snapshots of the other live workers."""
+        merged = self.snapshot()
+        try:
+            names = os.listdir(METRICS_DIR)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if not name.endswith('.json') or name == os.path.basename(self._path()):
+                continue
+            path = os.path.join(METRICS_DIR, name)
+            try:
+                with open(path) as source:
+                    published = json.load(source)
+            except (OSError, ValueError):
+                continue
+            if published["time"] < time.time() - 3 * METRICS_INTERVAL:
+                # The worker has exited
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            merge(merged, published["metrics"])
+        return merged
+
+
+def merge(into, snapshot):
+    for name, (kind, help, labelnames, buckets, samples) in snapshot.items():
+        if name not in into:
+            into[name] = [kind, help, labelnames, buckets, []]
+        existing = {tuple(values): sample for sample in into[name][4] for values in [sample[0]]}
+        for values, value in samples:
+            sample = existing.get(tuple(values))
+            if sample is None:
+                into[name][4].append([values, value])
+                existing[tuple(values)] = into[name][4][-1]
+            elif kind == 'histogram':
+                sample[1] = [[a + b for a, b in zip(sample[1][0], value[0])], sample[1][1] + value[1]]
+            else:
+                sample[1] += value
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render(snapshot):
+    # Prometheus text exposition format, version 0.0.4
+    lines = []
+    for name, (kind, help, labelnames, buckets, samples) in sorted(snapshot.items()):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        for values, value in samples:
+            if kind == 'histogram':
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(list(buckets) + [math.inf], counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labelnames, values, [("le", _number(float(bound)))])} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labelnames, values)} {_number(total)}')
+                lines.append(f'{name}_count{_labels(labelnames, values)} {cumulative}')
+            else:
+                lines.append(f'{name}{_labels(labelnames, values)} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# Fed by the consumers and instrumentation.py; other modules register their own
+sockets = registry.gauge('chat_sockets', "Open WebSocket connections.", ['consumer'])
+messages = registry.counter('chat_messages_total', "Messages sent by clients.", ['model'])
+fanout_latency = registry.histogram(
+    'chat_fanout_latency_seconds', "Time from a group_send to the consumer handling the event.", ['event'],
+)
+event_seconds = registry.histogram('chat_event_seconds', "Wall time of views and socket events.", ['name'])
+event_queries = registry.counter('chat_event_queries_total', "Queries run by views and socket events.", ['name'])
+event_hops = registry.counter(
+    'chat_event_db_hops_total', "Calls handed to the database threads by views and socket events.", ['name'],
+)
+
+
+def _layer_stat(name):
+    def read():
+        layer = get_channel_layer()
+        return {(): getattr(layer, name)} if hasattr(layer, name) else {}
+    return read
+
+
+registry.callback('counter', 'chat_layer_dropped_total', "Messages dropped on full channels.", _layer_stat('dropped'))
+registry.callback('counter', 'chat_layer_group_sends_total', "group_send calls.", _layer_stat('group_sends'))
+registry.callback(
+    'counter', 'chat_layer_fanout_total', "Channels messages were delivered to by group_send.", _layer_stat('fanout'),
+)
+registry.callback('gauge', 'chat_layer_queued', "Messages waiting in channel queues.", _layer_stat('queued'))
+
+
+def shared():
+    """
+    Metrics every worker sees the same way, read once by the metrics view
+    instead of being published per worker: group sizes from the channel
+    layer's shared registry.
+    """
+    layer = get_channel_layer()
+    if not hasattr(layer, 'group_sizes'):
+        return {}
+    rooms, direct = [], []
+    for group, size in layer.group_sizes().items():
+        # Per group for rooms; conversations are too many to label each
+        if group.startswith('chat_'):
+            rooms.append([[group], size])
+        else:
+            direct.append(size)
+    return {
+        'chat_group_members': ['gauge', "Channels in each room's group, across all workers.", ['group'], [], rooms],
+        'chat_direct_groups': ['gauge', "Conversation groups with at least one channel.", [], [], [[[], len(direct)]]],
+        'chat_direct_group_members': [
+            'gauge', "Channels in conversation groups, across all workers.", [], [], [[[], sum(direct)]],
+        ],
+    }
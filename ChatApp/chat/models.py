@@ -1,6 +1,7 @@
 # chat/models.py
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from users.models import User
 
 class Room(models.Model):
@@ -23,7 +24,24 @@ class Message(models.Model):
     room = models.ForeignKey(Room, related_name='messages', on_delete=models.CASCADE)
     username = models.CharField(max_length=100)
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the message is queued, not when the write-behind flush inserts it
+    timestamp = models.DateTimeField(default=timezone.now)
+    # Position in the room, from chat.sequences; `manage.py backfill_sequences` numbers older rows
+    seq = models.BigIntegerField(null=True)
+    # Picked by the sending client and repeated when it resends, see chat.idempotency
+    client_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # A resent message can't be stored twice, whichever worker process it reaches
+            models.UniqueConstraint(fields=['room', 'username', 'client_id'], name='chat_message_client_id'),
+        ]
+        indexes = [
+            # Serves the newest-first history pages of a room as one index range scan
+            models.Index(fields=['room', 'seq'], name='chat_message_room_seq_idx'),
+            # Finds where a basic user's retention window starts, see history.paginate_seq
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_message_room_ts_idx'),
+        ]
 
     def __str__(self):
         return f"{self.username}: {self.message[:20]} at {self.timestamp}" 
@@ -33,7 +51,146 @@ class DirectMessage(models.Model):
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='sent_messages', on_delete=models.CASCADE)
     receiver = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='received_messages', on_delete=models.CASCADE)
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True, auto_now=False)  # Recommended
+    timestamp = models.DateTimeField(default=timezone.now)
+    # Ordered user-pair id, the same for both directions of a conversation
+    conversation = models.CharField(max_length=41, editable=False, default='')
+    seq = models.BigIntegerField(null=True)  # position in the conversation, see Message.seq
+    client_id = models.CharField(max_length=64, null=True, blank=True)  # see Message.client_id
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'sender', 'client_id'], name='chat_dm_client_id'),
+        ]
+        indexes = [
+            models.Index(fields=['conversation', 'seq'], name='chat_dm_conversation_seq_idx'),
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='chat_dm_conversation_ts_idx'),
+        ]
+
+    @staticmethod
+    def conversation_key(user_a, user_b):
+        # Accepts users or user ids
+        low, high = sorted((getattr(user_a, 'pk', user_a), getattr(user_b, 'pk', user_b)))
+        return f"{low}_{high}"
+
+    def save(self, *args, **kwargs):
+        if not self.conversation:
+            self.conversation = self.conversation_key(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"From {self.sender.username} to {self.receiver.username}: {self.message[:20]} at {self.timestamp}"
+
+
+class Conversation(models.Model):
+    """
+    Direct message summary for the sidebar, one row per participant so a
+    user's conversations are one index range in last_activity order. Kept up
+    to date by chat.conversations whenever direct messages are written.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='conversations', on_delete=models.CASCADE)
+    peer = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE)
+    key = models.CharField(max_length=41)  # DirectMessage.conversation
+    last_message = models.CharField(max_length=100, blank=True)
+    last_sender = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', null=True, on_delete=models.SET_NULL)
+    last_message_id = models.BigIntegerField(null=True)
+    last_activity = models.DateTimeField(default=timezone.now)
+    unread = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='chat_conversation_user_key'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'last_activity', 'id'], name='chat_conversation_user_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} for {self.user_id}: {self.unread} unread"
+
+
+class ReadCursor(models.Model):
+    # How far a user has read a room ("room:<room id>") or conversation ("dm:<key>")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='read_cursors', on_delete=models.CASCADE)
+    key = models.CharField(max_length=50)
+    message_id = models.BigIntegerField()
+    timestamp = models.DateTimeField()  # of the message, cursors only move forward in (timestamp, id)
+    updated = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='chat_readcursor_user_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read {self.key} up to {self.message_id}"
+
+
+class Tombstone(models.Model):
+    # A deleted message, kept for CHAT_TOMBSTONE_DAYS so resuming clients can drop it too (see chat.resume)
+    key = models.CharField(max_length=50)  # like ReadCursor.key
+    message_id = models.BigIntegerField()
+    deleted = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['key', 'deleted'], name='chat_tombstone_key_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} deleted {self.message_id}"
+
+
+class ArchivedMessage(models.Model):
+    # Room messages moved out of Message by `manage.py archive_messages`, ids are kept
+    id = models.BigIntegerField(primary_key=True)
+    room = models.ForeignKey(Room, related_name='archived_messages', on_delete=models.CASCADE)
+    username = models.CharField(max_length=100)
+    message = models.TextField()
+    timestamp = models.DateTimeField()
+    seq = models.BigIntegerField(null=True)
+    client_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'seq'], name='chat_archmsg_room_seq_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.username}: {self.message[:20]} at {self.timestamp}"
+
+
+class ArchivedDirectMessage(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE)
+    receiver = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE)
+    message = models.TextField()
+    timestamp = models.DateTimeField()
+    conversation = models.CharField(max_length=41)
+    seq = models.BigIntegerField(null=True)
+    client_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'seq'], name='chat_archdm_conv_seq_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.conversation}: {self.message[:20]} at {self.timestamp}"
+
+
+class Sequence(models.Model):
+    # Last sequence number handed out per room ("room:<room id>") or conversation ("dm:<key>"), by chat.sequences
+    key = models.CharField(max_length=50, primary_key=True)
+    last = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.key}: {self.last}"
+
+
+class IdBlock(models.Model):
+    # Next free primary key per model, handed out in blocks by chat.writebehind
+    name = models.CharField(max_length=100, primary_key=True)
+    next_id = models.BigIntegerField(default=1)
+
+    def __str__(self):
+        return f"{self.name}: {self.next_id}"
@@ -0,0 +1,185 @@
+# chat/presence.py
+# Who is online and who is typing, per room or conversation.
+#
+# Each process only tracks its own connections. Changes are not broadcast as
+# they happen: once per CHAT_PRESENCE_TICK the process sends each group with
+# changes a single "presence" frame listing who came online, went offline,
+# started or stopped typing. Every CHAT_PRESENCE_SNAPSHOT_INTERVAL seconds,
+# and on the tick after someone joins anywhere, it also sends a snapshot of
+# everyone it has there. Clients expire names after `ttl` seconds unless a
+# later frame repeats them, so state held by other processes, or by a process
+# that died, converges without any shared store.
+#
+# Users that stop sending heartbeats are dropped after CHAT_PRESENCE_TTL
+# seconds, typing after CHAT_TYPING_TTL seconds without a "typing" frame.
+import asyncio
+import random
+import string
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import serialization
+
+PRESENCE_TICK = getattr(settings, 'CHAT_PRESENCE_TICK', 1.0)
+PRESENCE_TTL = getattr(settings, 'CHAT_PRESENCE_TTL', 60)
+TYPING_TTL = getattr(settings, 'CHAT_TYPING_TTL', 5)
+SNAPSHOT_INTERVAL = getattr(settings, 'CHAT_PRESENCE_SNAPSHOT_INTERVAL', 20)
+
+
+class Member:
+    __slots__ = ('connections', 'seen', 'typing_until')
+
+    def __init__(self, now):
+        self.connections = 0
+        self.seen = now
+        self.typing_until = 0
+
+
+class Place:
+    """Local members of one room or conversation and what changed since the last tick."""
+
+    __slots__ = ('group', 'stream', 'members', 'online', 'offline', 'typing', 'idle', 'snapshot_at')
+
+    def __init__(self, group, stream, now):
+        self.group = group
+        self.stream = stream
+        self.members = {}  # username -> Member
+        self.online, self.offline, self.typing, self.idle = set(), set(), set(), set()
+        self.snapshot_at = now + SNAPSHOT_INTERVAL
+
+    def changed(self):
+        return self.online or self.offline or self.typing or self.idle
+
+
+class Presence:
+    def __init__(self, tick=PRESENCE_TICK, ttl=PRESENCE_TTL, typing_ttl=TYPING_TTL):
+        self.tick = tick
+        self.ttl = ttl
+        self.typing_ttl = typing_ttl
+        # Tells this process's frames apart from other processes'
+        self.origin = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(12))
+        self.places = {}  # history key -> Place
+        self._task = None
+
+    def join(self, key, group, stream, username):
+        now = time.monotonic()
+        place = self.places.get(key)
+        if place is None:
+            place = self.places[key] = Place(group, stream, now)
+        member = place.members.get(username)
+        if member is None:
+            member = place.members[username] = Member(now)
+            place.online.add(username)
+            place.offline.discard(username)
+        member.connections += 1
+        member.seen = now
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    def leave(self, key, username):
+        place = self.places.get(key)
+        member = place.members.get(username) if place else None
+        if member is None:
+            return
+        member.connections -= 1
+        if member.connections <= 0:
+            self._remove(place, username)
+
+    def heartbeat(self, key, group, stream, username):
+        member = self._member(key, username)
+        if member is None:
+            # Expired while still connected, e.g. a throttled background tab
+            self.join(key, group, stream, username)
+        else:
+            member.seen = time.monotonic()
+
+    def typing(self, key, group, stream, username):
+        self.heartbeat(key, group, stream, username)
+        member = self._member(key, username)
+        now = time.monotonic()
+        if member.typing_until <= now:
+            # Only the start of typing is news, repeats just extend it
+            self.places[key].typing.add(username)
+            self.places[key].idle.discard(username)
+        member.typing_until = now + self.typing_ttl
+
+    def stopped_typing(self, key, username):
+        member = self._member(key, username)
+        if member is not None and member.typing_until:
+            member.typing_until = 0
+            self.places[key].typing.discard(username)
+            self.places[key].idle.add(username)
+
+    def snapshot_soon(self, key):
+        place = self.places.get(key)
+        if place is not None:
+            place.snapshot_at = 0
+
+    def _member(self, key, username):
+        place = self.places.get(key)
+        return place.members.get(username) if place else None
+
+    def _remove(self, place, username):
+        place.members.pop(username, None)
+        place.online.discard(username)
+        place.typing.discard(username)
+        place.idle.discard(username)
+        place.offline.add(username)
+
+    async def run(self):
+        channel_layer = get_channel_layer()
+        while self.places:
+            await asyncio.sleep(self.tick)
+            for key, place in list(self.places.items()):
+                joined = bool(place.online)
+                frame = self._frame(place, time.monotonic())
+                if frame is not None:
+                    # Other processes answer a join with a snapshot, so the newcomer sees everyone
+                    await channel_layer.group_send(place.group, {
+                        "type": "presence",
+                        "stream": place.stream,
+                        "origin": self.origin,
+                        "joined": joined,
+                        "text": serialization.dumps(frame),
+                    })
+                if not place.members:
+                    self.places.pop(key, None)
+
+    def _frame(self, place, now):
+        # One frame with everything that changed in `place` since the last tick, or None
+        for username, member in list(place.members.items()):
+            if member.seen < now - self.ttl:
+                self._remove(place, username)
+            elif member.typing_until and member.typing_until <= now:
+                member.typing_until = 0
+                place.typing.discard(username)
+                place.idle.add(username)
+
+        snapshot = place.snapshot_at <= now and bool(place.members)
+        if not snapshot and not place.changed():
+            return None
+        if snapshot:
+            place.snapshot_at = now + SNAPSHOT_INTERVAL
+            online = sorted(place.members)
+            typing = sorted(name for name, member in place.members.items() if member.typing_until > now)
+        else:
+            online, typing = sorted(place.online), sorted(place.typing)
+
+        frame = {
+            "type": "presence",
+            "stream": place.stream,
+            "snapshot": snapshot,
+            "online": online,
+            "offline": sorted(place.offline),
+            "typing": typing,
+            "idle": sorted(place.idle),
+            "ttl": self.ttl,
+            "typing_ttl": self.typing_ttl,
+        }
+        place.online, place.offline, place.typing, place.idle = set(), set(), set(), set()
+        return frame
+
+
+presence = Presence()
@@ -0,0 +1,215 @@
+# chat/reads.py
+# Read cursors and read receipts.
+#
+# Clients report the newest message they have seen with a "read" frame.
+# read_cursors keeps only the newest report per user and room/conversation in
+# memory and writes them in one transaction every CHAT_READ_FLUSH_INTERVAL
+# seconds. receipts batches the broadcasts, so each group gets at most one
+# read_receipts frame per CHAT_READ_RECEIPT_INTERVAL from this process, and
+# only names messages that belong to the room or conversation.
+import asyncio
+import contextvars
+import atexit
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .db import database_sync_to_async
+from .hot_history import hot_history
+from .models import Message, DirectMessage, Conversation, ReadCursor
+from .writebehind import write_behind
+from . import archive
+from . import events
+from . import serialization
+
+logger = logging.getLogger(__name__)
+
+READ_FLUSH_INTERVAL = getattr(settings, 'CHAT_READ_FLUSH_INTERVAL', 1.0)
+READ_RECEIPT_INTERVAL = getattr(settings, 'CHAT_READ_RECEIPT_INTERVAL', 2.0)
+
+# history key kind -> (model, column that scopes a message to the key)
+SCOPES = {'room': (Message, 'room_id'), 'dm': (DirectMessage, 'conversation')}
+
+
+def cursor_key(history_key):
+    kind, key = history_key
+    return f"{kind}:{key}"
+
+
+def messages_in(history_key, message_ids):
+    # The ids among `message_ids` of messages in the room or conversation
+    kind, key = history_key
+    model, scope = SCOPES[kind]
+    found = set()
+    for table in (model, archive.ARCHIVES[model][0]):
+        missing = set(message_ids) - found
+        if not missing:
+            break
+        found.update(table.objects.filter(id__in=missing, **{scope: key}).values_list('id', flat=True))
+    return found
+
+
+class ReadCursors:
+    def __init__(self, remembered=10000):
+        self.pending = {}  # (user id, history key) -> (client timestamp, message id)
+        self.latest = OrderedDict()  # the same, kept across flushes for the most recent reporters
+        self.remembered = remembered
+        self._timer = None
+        self._lock = None
+        atexit.register(self.flush_sync)
+
+    def mark(self, user_id, history_key, message_id, timestamp=None):
+        """
+        Record a read report and return True if it moved the reader forward,
+        i.e. whether it is worth a receipt. The client's epoch-ms timestamp
+        only orders reports in memory, the database keeps its own.
+        """
+        report = (timestamp or 0, message_id)
+        key = (user_id, history_key)
+        current = self.latest.get(key)
+        if current is not None and report <= current:
+            return False
+        self.latest[key] = self.pending[key] = report
+        self.latest.move_to_end(key)
+        if len(self.latest) > self.remembered:
+            self.latest.popitem(last=False)
+
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                READ_FLUSH_INTERVAL, lambda: asyncio.ensure_future(self.flush()), context=contextvars.Context()
+            )
+        return True
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch, self.pending = self.pending, {}
+            if batch:
+                # Reports can name messages still waiting in the write-behind queue
+                await write_behind.flush()
+                await database_sync_to_async(self._write)(batch)
+
+    def flush_sync(self):
+        batch, self.pending = self.pending, {}
+        if batch:
+            self._write(batch)
+
+    def _resolve(self, batch):
+        # (kind, message id) -> (scope, timestamp) with one query per table
+        found = {}
+        for kind, (model, scope) in SCOPES.items():
+            wanted = {message_id for (_, (k, _)), (_, message_id) in batch.items() if k == kind}
+            for table in (model, archive.ARCHIVES[model][0]):
+                missing = wanted - {message_id for k, message_id in found if k == kind}
+                if not missing:
+                    break
+                for message_id, key, timestamp in table.objects.filter(id__in=missing).values_list('id', scope, 'timestamp'):
+                    found[(kind, message_id)] = (key, timestamp)
+        return found
+
+    def _write(self, batch):
+        try:
+            with transaction.atomic():
+                self._advance(batch)
+        except Exception:
+            logger.exception("Dropped %d read cursor updates", len(batch))
+
+    def _advance(self, batch):
+        messages = self._resolve(batch)
+        wanted = {}
+        for (user_id, (kind, key)), (_, message_id) in batch.items():
+            scope, timestamp = messages.get((kind, message_id), (None, None))
+            if scope != key:
+                continue  # deleted, or not a message of that room/conversation
+            wanted[(user_id, cursor_key((kind, key)))] = (timestamp, message_id)
+        if not wanted:
+            return
+
+        existing = {
+            (cursor.user_id, cursor.key): cursor
+            for cursor in ReadCursor.objects.select_for_update().filter(
+                user_id__in={user_id for user_id, _ in wanted}, key__in={key for _, key in wanted}
+            )
+        }
+        now = timezone.now()
+        created, updated, advanced = [], [], []
+        for (user_id, key), (timestamp, message_id) in wanted.items():
+            cursor = existing.get((user_id, key))
+            if cursor is None:
+                created.append(ReadCursor(
+                    user_id=user_id, key=key, message_id=message_id, timestamp=timestamp, updated=now
+                ))
+            elif (timestamp, message_id) > (cursor.timestamp, cursor.message_id):
+                cursor.message_id, cursor.timestamp, cursor.updated = message_id, timestamp, now
+                updated.append(cursor)
+            else:
+                continue
+            advanced.append((user_id, key, timestamp, message_id))
+
+        ReadCursor.objects.bulk_create(created)
+        ReadCursor.objects.bulk_update(updated, ['message_id', 'timestamp', 'updated'])
+
+        # Unread counts in the DM sidebar are what arrived after the cursor
+        for user_id, key, timestamp, message_id in advanced:
+            kind, conversation = key.split(':', 1)
+            if kind != 'dm':
+                continue
+            unread = DirectMessage.objects.filter(conversation=conversation, receiver_id=user_id).filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+            ).count()
+            Conversation.objects.filter(user_id=user_id, key=conversation).update(unread=unread)
+
+
+class Receipts:
+    def __init__(self, interval=READ_RECEIPT_INTERVAL):
+        self.interval = interval
+        self.pending = {}  # group -> (history key, stream, {username: message id})
+        self.timers = {}   # group -> its next send, while it has sent within the interval
+
+    def announce(self, channel_layer, group, history_key, stream, username, message_id):
+        self.pending.setdefault(group, (history_key, stream, {}))[2][username] = message_id
+        if group not in self.timers:
+            self._schedule(channel_layer, group, 0)
+
+    def _schedule(self, channel_layer, group, delay):
+        # Outside the caller's measurement, a frame covers every report since the last one
+        self.timers[group] = asyncio.get_running_loop().call_later(
+            delay, lambda: asyncio.ensure_future(self._send(channel_layer, group)), context=contextvars.Context()
+        )
+
+    async def _send(self, channel_layer, group):
+        history_key, stream, readers = self.pending.pop(group, (None, None, None))
+        if not readers:
+            # A quiet interval, the next report is sent at once. Groups keep no state past this
+            self.timers.pop(group, None)
+            return
+        self._schedule(channel_layer, group, self.interval)
+
+        readers = await self._valid(history_key, readers)
+        if readers:
+            await channel_layer.group_send(group, {
+                "type": "read_receipts",
+                "stream": stream,
+                "text": serialization.dumps(events.read_receipts(readers, stream)),
+            })
+
+    async def _valid(self, history_key, readers):
+        # Clients can name any id, only messages of the room/conversation get a receipt
+        unknown = {message_id for message_id in readers.values() if not hot_history.holds(history_key, message_id)}
+        if unknown:
+            # They may still be queued for writing
+            found = await write_behind.run(messages_in, history_key, unknown)
+            unknown -= found
+        return {username: message_id for username, message_id in readers.items() if message_id not in unknown}
+
+
+read_cursors = ReadCursors()
+receipts = Receipts()
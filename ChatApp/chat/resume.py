@@ -0,0 +1,77 @@
+# chat/resume.py
+# Resuming a subscription after a reconnect.
+#
+# A client that already shows a stream subscribes again with
+#
+#     "resume": {"seq": <seq of the newest message shown>,
+#                "synced": <"synced" of the last history or resumed frame>}
+#
+# and gets a "resumed" frame with only the messages after that one and the
+# ids deleted since `synced`, read from the tombstones archive.delete leaves.
+# It gets a history page as usual when more than CHAT_RESUME_MAX_MESSAGES
+# messages are new, or when `synced` is older than the tombstones kept
+# (CHAT_TOMBSTONE_DAYS) or than the archive horizon.
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+
+from .history import room_entry, direct_entry, ROOM_FIELDS, DIRECT_FIELDS, HISTORY_PAGE_SIZE
+from .models import Message, DirectMessage, Tombstone
+from .reads import cursor_key
+from . import archive
+from . import serialization
+
+RESUME_MAX_MESSAGES = getattr(settings, 'CHAT_RESUME_MAX_MESSAGES', HISTORY_PAGE_SIZE)
+
+# Deletes committed around the time a page was read may not be in it
+CLOCK_SLACK = timedelta(seconds=2)
+
+Resume = namedtuple('Resume', 'seq synced')
+
+
+def parse_resume(data):
+    if not isinstance(data, dict):
+        return None
+    try:
+        resume = Resume(int(data['seq']), serialization.from_epoch_ms(data['synced']))
+    except (KeyError, TypeError, ValueError, OverflowError, OSError):
+        return None
+    # Tombstones from before `synced` may be gone, and messages sent since may be archived
+    if resume.synced < archive.horizon(min(archive.TOMBSTONE_DAYS, archive.ARCHIVE_AFTER_DAYS)):
+        return None
+    return resume
+
+
+def newer_entries(history_key, seq, cutoff=None, limit=None):
+    # History entries after `seq`, oldest first. Only the hot table, see parse_resume()
+    kind, key = history_key
+    if kind == 'room':
+        rows = Message.objects.filter(room_id=key, seq__gt=seq).values(*ROOM_FIELDS)
+        entry = room_entry
+    else:
+        rows = DirectMessage.objects.filter(conversation=key, seq__gt=seq).values(*DIRECT_FIELDS)
+        entry = direct_entry
+    if cutoff is not None:
+        rows = rows.filter(timestamp__gte=cutoff)
+    return [entry(row) for row in rows.order_by('seq')[:limit or RESUME_MAX_MESSAGES + 1]]
+
+
+def deleted_since(history_key, since):
+    return list(
+        Tombstone.objects.filter(key=cursor_key(history_key), deleted__gte=since - CLOCK_SLACK)
+        .values_list('message_id', flat=True)
+    )
+
+
+def delta(history_key, resume, cutoff=None, entries=None):
+    """
+    Return (new entries, deleted ids) since `resume`, or None if the client
+    should get a history page instead. `entries` are the new entries when
+    hot history had them, otherwise they are read here.
+    """
+    if entries is None:
+        entries = newer_entries(history_key, resume.seq, cutoff)
+    if len(entries) > RESUME_MAX_MESSAGES:
+        return None
+    return entries, deleted_since(history_key, resume.synced)
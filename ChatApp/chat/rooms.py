@@ -0,0 +1,78 @@
+# chat/rooms.py
+# Cached room lookups and membership checks shared by the views and consumers.
+# Entries are dropped by the signal handlers in chat/signals.py when a room's
+# members change or the room is deleted. Other worker processes don't see
+# those signals, so entries also expire after CHAT_ROOM_CACHE_TTL seconds.
+import time
+
+from django.conf import settings
+
+from .models import Room
+
+ROOM_CACHE_TTL = getattr(settings, 'CHAT_ROOM_CACHE_TTL', 30)
+
+_rooms = {}    # room name -> (expires, room id)
+_members = {}  # room id -> (expires, set of user ids)
+
+MISSING = object()
+
+
+def get_room(room_name):
+    """
+    Return a Room holding only its id and name, or None if no room has that
+    name. That is all the m2m managers, delete() and filters need.
+    """
+    entry = _rooms.get(room_name)
+    if entry is None or entry[0] < time.monotonic():
+        room_id = Room.objects.filter(name=room_name).values_list('id', flat=True).first()
+        if room_id is None:
+            _rooms.pop(room_name, None)
+            return None
+        entry = _rooms[room_name] = (time.monotonic() + ROOM_CACHE_TTL, room_id)
+    return Room.from_db(Room.objects.db, ['id', 'name'], [entry[1], room_name])
+
+
+def member_ids(room_id):
+    entry = _members.get(room_id)
+    if entry is None or entry[0] < time.monotonic():
+        users = frozenset(Room.users.through.objects.filter(room_id=room_id).values_list('user_id', flat=True))
+        entry = _members[room_id] = (time.monotonic() + ROOM_CACHE_TTL, users)
+    return entry[1]
+
+
+def is_member(room, user):
+    if not user.is_authenticated:
+        return False
+    return user.id in member_ids(room.id)
+
+
+def cached_room(room_name, user):
+    """
+    get_room() and is_member() answered from the cache alone: the room if
+    `user` may join it, None if not, or MISSING if either isn't cached.
+    """
+    now = time.monotonic()
+    entry = _rooms.get(room_name)
+    if entry is None or entry[0] < now:
+        return MISSING
+    members = _members.get(entry[1])
+    if members is None or members[0] < now:
+        return MISSING
+    if not user.is_authenticated or user.id not in members[1]:
+        return None
+    return Room.from_db(Room.objects.db, ['id', 'name'], [entry[1], room_name])
+
+
+def invalidate_members(room_id):
+    _members.pop(room_id, None)
+
+
+def invalidate_all_members():
+    _members.clear()
+
+
+def invalidate_room(room_id):
+    _members.pop(room_id, None)
+    for name, (_, cached_id) in list(_rooms.items()):
+        if cached_id == room_id:
+            _rooms.pop(name, None)
@@ -0,0 +1,31 @@
+# chat/routers.py
+# Puts the Sequence counters in the "sequences" database when settings define
+# one (the SQLite profile does, see settings.py), everything else stays in
+# "default".
+from django.conf import settings
+
+SEQUENCES = 'sequences'
+
+
+def _is_sequence(app_label, model_name):
+    return app_label == 'chat' and model_name == 'sequence'
+
+
+class SequenceRouter:
+    def _db_for(self, model):
+        if SEQUENCES in settings.DATABASES and _is_sequence(model._meta.app_label, model._meta.model_name):
+            return SEQUENCES
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._db_for(model)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for(model)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == SEQUENCES:
+            return _is_sequence(app_label, model_name)
+        if SEQUENCES in settings.DATABASES and _is_sequence(app_label, model_name):
+            return False
+        return None
@@ -0,0 +1,243 @@
+# chat/search.py
+# Full-text search over room and direct messages, backed by an SQLite FTS5
+# table. Rows are indexed in the transaction that inserts the messages (see
+# signals.py) and removed when a message is deleted. Archiving moves rows
+# between tables but keeps their ids, so the index doesn't change.
+#
+# Each index row holds the message text, its kind ("room" or "dm"), scope
+# (room id or conversation key) and epoch-ms timestamp. The rowid is derived
+# from the message id, which the Message and DirectMessage tables share.
+# Other databases have no FTS5: indexing is skipped and search is unavailable.
+# So is it until `manage.py prepare_sqlite` has created the table.
+import html
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connection
+
+from .models import Message, DirectMessage, Room, Conversation
+from . import archive
+from . import serialization
+
+logger = logging.getLogger(__name__)
+
+TABLE = 'chat_search'
+SEARCH_PAGE_SIZE = getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', 20)
+SNIPPET_TOKENS = 16
+
+# Seconds before a process looks again for a search table that was missing
+RECHECK_INTERVAL = 60
+
+KINDS = {'room': (Message, 'room_id', 0), 'dm': (DirectMessage, 'conversation', 1)}
+
+# Match markers for snippet(), swapped for <mark> after escaping the text
+MARK_START, MARK_END = '\x02', '\x03'
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def rowid(kind, message_id):
+    return message_id * 2 + KINDS[kind][2]
+
+
+_found = {}  # database alias -> (when it was checked, whether the table exists)
+
+
+def available(conn=None):
+    conn = conn or connection
+    if conn.vendor != 'sqlite':
+        return False
+    checked, exists = _found.get(conn.alias, (None, False))
+    if exists:
+        return True
+    if checked is None or time.monotonic() - checked > RECHECK_INTERVAL:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [TABLE])
+            exists = cursor.fetchone() is not None
+        _found[conn.alias] = (time.monotonic(), exists)
+    return exists
+
+
+def create_index(conn):
+    # A no-op once the table exists, see `manage.py prepare_sqlite`
+    _found.pop(conn.alias, None)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5("
+                "body, kind UNINDEXED, scope UNINDEXED, timestamp UNINDEXED, "
+                "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+            )
+    except OperationalError:
+        logger.exception("Could not create the %s table, is SQLite built with FTS5?", TABLE)
+
+
+def index(kind, rows):
+    """
+    Add or replace (message id, scope, text, timestamp) rows of one kind.
+    Call it inside the transaction that writes the messages.
+    """
+    if not rows or not available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT OR REPLACE INTO {TABLE} (rowid, body, kind, scope, timestamp) VALUES (%s, %s, %s, %s, %s)",
+            [
+                (rowid(kind, message_id), text, kind, str(scope), serialization.epoch_ms(timestamp))
+                for message_id, scope, text, timestamp in rows
+            ],
+        )
+
+
+def index_messages(objs):
+    # Message or DirectMessage instances, as passed to rows_written
+    for kind, (model, scope, _) in KINDS.items():
+        index(kind, [(obj.id, getattr(obj, scope), obj.message, obj.timestamp) for obj in objs if type(obj) is model])
+
+
+def remove(model, message_id):
+    kind = next(kind for kind, (kind_model, _, _) in KINDS.items() if kind_model is model)
+    if available():
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE} WHERE rowid = %s", [rowid(kind, message_id)])
+
+
+def remove_scope(kind, scope):
+    # Unindexed columns are scanned, fine for the rare room deletion
+    if available():
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TABLE} WHERE kind = %s AND scope = %s", [kind, str(scope)])
+
+
+def clear():
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE}")
+
+
+def parse_query(text):
+    """
+    Turn what the user typed into an FTS5 query: every word must match, the
+    last one as a prefix. Quoting each word keeps FTS5 syntax out of it.
+    """
+    words = TOKEN.findall(text or '')
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def parse_cursor(value):
+    # "<score>,<rowid>" of the last result of the previous page
+    try:
+        score, last = value.split(',')
+        return float(score), int(last)
+    except (AttributeError, ValueError):
+        return None
+
+
+def highlight(snippet):
+    return html.escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def search(user, text, room=None, conversation=None, cutoff=None, after=None, limit=None):
+    """
+    Search the rooms and conversations `user` belongs to, narrowed to one
+    `room` or `conversation` key if given. Returns (results, cursor,
+    has_more), best matches first.
+    """
+    query = parse_query(text)
+    if query is None:
+        return [], None, False
+    limit = max(1, min(limit or SEARCH_PAGE_SIZE, 100))
+
+    members = Room.users.through._meta.db_table
+    conversations = Conversation._meta.db_table
+    sql = [
+        f"SELECT rowid, kind, scope, bm25({TABLE}) AS score FROM {TABLE} WHERE {TABLE} MATCH %s",
+        f"AND ((kind = 'room' AND scope IN (SELECT CAST(room_id AS TEXT) FROM {members} WHERE user_id = %s))"
+        f" OR (kind = 'dm' AND scope IN (SELECT key FROM {conversations} WHERE user_id = %s)))",
+    ]
+    params = [query, user.id, user.id]
+    if room is not None:
+        sql.append("AND kind = 'room' AND scope = %s")
+        params.append(str(room.id))
+    if conversation is not None:
+        sql.append("AND kind = 'dm' AND scope = %s")
+        params.append(conversation)
+    if cutoff is not None:
+        sql.append("AND timestamp >= %s")
+        params.append(serialization.epoch_ms(cutoff))
+    if after is not None:
+        # bm25 scores are negative, lower is better
+        sql.append("AND (score > %s OR (score = %s AND rowid > %s))")
+        params.extend([after[0], after[0], after[1]])
+    sql.append("ORDER BY score, rowid LIMIT %s")
+    params.append(limit + 1)
+
+    with connection.cursor() as cursor:
+        cursor.execute(' '.join(sql), params)
+        hits = cursor.fetchall()
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+        if not hits:
+            return [], None, False
+
+        # Snippets only for the page, not for every match
+        cursor.execute(
+            f"SELECT rowid, snippet({TABLE}, 0, %s, %s, '…', %s) FROM {TABLE} WHERE {TABLE} MATCH %s "
+            f"AND rowid IN ({', '.join(['%s'] * len(hits))})",
+            [MARK_START, MARK_END, SNIPPET_TOKENS, query] + [hit[0] for hit in hits],
+        )
+        snippets = dict(cursor.fetchall())
+
+    messages = _load(user, hits)
+    results = []
+    for row, kind, scope, score in hits:
+        message = messages.get((kind, row // 2))
+        if message is None:
+            continue  # deleted without going through remove()
+        results.append(dict(message, snippet=highlight(snippets.get(row, '')), score=score))
+    last = hits[-1]
+    return results, f"{last[3]!r},{last[0]}", has_more
+
+
+def _load(user, hits):
+    # (kind, message id) -> result without the snippet, one query per table
+    wanted = {'room': set(), 'dm': set()}
+    for row, kind, _, _ in hits:
+        wanted[kind].add(row // 2)
+
+    rows = {}
+    for message_id, room_id, username, timestamp in _rows(
+        Message, wanted['room'], ('id', 'room_id', 'username', 'timestamp')
+    ):
+        rows[('room', message_id)] = (room_id, username, timestamp)
+    for message_id, key, username, timestamp in _rows(
+        DirectMessage, wanted['dm'], ('id', 'conversation', 'sender__username', 'timestamp')
+    ):
+        rows[('dm', message_id)] = (key, username, timestamp)
+
+    scopes = {kind: {scope for (k, _), (scope, _, _) in rows.items() if k == kind} for kind in wanted}
+    room_names = dict(Room.objects.filter(id__in=scopes['room']).values_list('id', 'name'))
+    peers = dict(Conversation.objects.filter(user=user, key__in=scopes['dm']).values_list('key', 'peer__username'))
+
+    messages = {}
+    for (kind, message_id), (scope, username, timestamp) in rows.items():
+        message = {"message_id": message_id, "username": username, "timestamp": serialization.epoch_ms(timestamp)}
+        if kind == 'room':
+            message.update(stream=f"room:{room_names.get(scope)}", room=room_names.get(scope))
+        else:
+            message.update(stream=f"dm:{scope}", peer=peers.get(scope))
+        messages[(kind, message_id)] = message
+    return messages
+
+
+def _rows(model, ids, fields):
+    # Old messages live in the archive table under the same id
+    found = list(model.objects.filter(id__in=ids).values_list(*fields)) if ids else []
+    missing = ids - {row[0] for row in found}
+    if missing:
+        found += archive.ARCHIVES[model][0].objects.filter(id__in=missing).values_list(*fields)
+    return found
@@ -0,0 +1,179 @@
+# chat/sequences.py
+# Per room and per conversation sequence numbers.
+#
+# A message gets the next number of its room or conversation when it is
+# sent, before it is broadcast, from a counter row (Sequence) bumped inside a
+# transaction, so numbers are increasing across all worker processes. History
+# pages, cursors and resumes are ordered by them instead of timestamps, which
+# tie within a millisecond. Numbers can be skipped, e.g. by a message that
+# failed to save, so a gap is a reason to check rather than proof of a loss.
+#
+# Numbers have to be dense and ordered across processes for clients to spot
+# a missing message, so they can't be handed out in per-process blocks like
+# primary keys: every message costs a counter update before its broadcast.
+# To keep that cheap, requests made while a reservation is running are
+# reserved together in the next one, one transaction for all of them, and
+# on SQLite the counters live in their own database (see routers.py) where
+# they don't queue for the write lock behind message inserts. Rows saved one
+# at a time without a seq, e.g. from the admin, are numbered by a pre_save
+# handler (see signals.py). Rows saved before messages had numbers are
+# numbered below the first numbered one by number_older(): for a room or
+# conversation when its history is first read down to them (see access.py),
+# or for all of them by `manage.py backfill_sequences`.
+import asyncio
+import contextvars
+from collections import OrderedDict
+
+from django.db import router, transaction
+from django.db.models import F, Max, Min
+
+from .archive import ARCHIVES
+from .db import database_sync_to_async
+from .models import Message, Sequence
+from .reads import SCOPES, cursor_key
+
+
+def highest(history_key):
+    # Largest number already used by the room or conversation, 0 if none
+    kind, key = history_key
+    model, scope = SCOPES[kind]
+    return max(
+        table.objects.filter(**{scope: key}).aggregate(highest=Max('seq'))['highest'] or 0
+        for table in (model, ARCHIVES[model][0])
+    )
+
+
+def reserve(counts):
+    """
+    Reserve counts[history_key] consecutive numbers for each history key and
+    return {history_key: range}.
+    """
+    reserved = {}
+    with transaction.atomic(using=router.db_for_write(Sequence)):
+        for history_key, count in counts.items():
+            key = cursor_key(history_key)
+            # The UPDATE takes the write lock before the counter is read back
+            if not Sequence.objects.filter(key=key).update(last=F('last') + count):
+                Sequence.objects.get_or_create(key=key, defaults={'last': highest(history_key)})
+                Sequence.objects.filter(key=key).update(last=F('last') + count)
+            last = Sequence.objects.values_list('last', flat=True).get(key=key)
+            reserved[history_key] = range(last - count + 1, last + 1)
+    return reserved
+
+
+def number(obj):
+    # The next number for an unsaved Message or DirectMessage
+    history_key = ('room', obj.room_id) if isinstance(obj, Message) else ('dm', obj.conversation)
+    return reserve({history_key: 1})[history_key][0]
+
+
+# History keys checked for unnumbered rows in this process. New rows always
+# get a number, so a key only needs checking once
+MAX_CHECKED = 100000
+_checked = OrderedDict()
+
+
+def number_older_once(history_key):
+    """
+    number_older() unless this process already checked `history_key`.
+    Returns whether any rows were numbered.
+    """
+    if history_key in _checked:
+        return False
+    kind, key = history_key
+    model, scope = SCOPES[kind]
+    found = any(
+        table.objects.filter(**{scope: key, 'seq__isnull': True}).exists() for table in (model, ARCHIVES[model][0])
+    )
+    numbered = found and number_older(history_key) > 0
+    _checked[history_key] = True
+    if len(_checked) > MAX_CHECKED:
+        _checked.popitem(last=False)
+    return numbered
+
+
+def number_older(history_key, batch_size=2000):
+    """
+    Number the rows of a room or conversation, including archived ones,
+    saved before messages had numbers, oldest first and below the numbers
+    already used. Returns how many rows were numbered.
+    """
+    kind, key = history_key
+    model, scope = SCOPES[kind]
+    tables = (model, ARCHIVES[model][0])
+    with transaction.atomic():
+        rows = sorted(
+            (timestamp, row_id, table)
+            for table in tables
+            for row_id, timestamp in table.objects.filter(**{scope: key, 'seq__isnull': True})
+            .values_list('id', 'timestamp')
+        )
+        if not rows:
+            return 0
+        numbered = [
+            table.objects.filter(**{scope: key, 'seq__isnull': False}).aggregate(lowest=Min('seq'))['lowest']
+            for table in tables
+        ]
+        numbered = [seq for seq in numbered if seq is not None]
+        if numbered:
+            # Messages sent since seqs were introduced keep theirs, older ones go below them
+            first = min(numbered) - len(rows)
+        else:
+            # Nothing numbered yet, start at 1 unless a writer got in first
+            first = 1
+            _, created = Sequence.objects.get_or_create(key=cursor_key(history_key), defaults={'last': len(rows)})
+            if not created:
+                first = 1 - len(rows)
+
+        updates = {table: [] for table in tables}
+        for seq, (_, row_id, table) in enumerate(rows, start=first):
+            updates[table].append(table(id=row_id, seq=seq))
+        for table, objs in updates.items():
+            table.objects.bulk_update(objs, ['seq'], batch_size=batch_size)
+    return len(rows)
+
+
+class SequenceAllocator:
+    def __init__(self):
+        self.waiting = {}  # history key -> futures, in the order they asked
+        self._scheduled = False
+
+    async def next(self, history_key):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(history_key, []).append(future)
+        if not self._scheduled:
+            self._scheduled = True
+            # Outside the caller's measurement, the reservation is for everyone waiting
+            asyncio.get_running_loop().call_soon(
+                lambda: asyncio.ensure_future(self.allocate()), context=contextvars.Context()
+            )
+        return await future
+
+    async def allocate(self):
+        # One reservation at a time: requests made while it runs wait for the
+        # next one, so under load each transaction numbers a bigger batch
+        try:
+            while self.waiting:
+                batch, self.waiting = self.waiting, {}
+                await self._allocate(batch)
+        finally:
+            self._scheduled = False
+
+    async def _allocate(self, batch):
+        try:
+            reserved = await database_sync_to_async(reserve)(
+                {history_key: len(futures) for history_key, futures in batch.items()}
+            )
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for history_key, futures in batch.items():
+            for future, seq in zip(futures, reserved[history_key]):
+                if not future.done():
+                    future.set_result(seq)
+
+
+sequences = SequenceAllocator()
@@ -0,0 +1,79 @@
+# chat/serialization.py
+# Turns messages into the frames sent to clients. Live events are encoded
+# once by the sending consumer and the encoded text is fanned out through the
+# channel layer, so each recipient only writes it to its socket. Timestamps
+# are sent as epoch milliseconds and formatted by the browser.
+#
+# Clients that offer the MSGPACK_SUBPROTOCOL WebSocket subprotocol get the
+# same frames as binary MessagePack instead (see flow.FlowControlMixin), with
+# the messages of history pages sent as columns: {"columns": {"message_id":
+# [...], "username": [...], ...}} in place of "messages", one array per key
+# rather than every key repeated in every message.
+import json
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import msgpack
+
+try:
+    import orjson
+except ImportError:  # optional, speeds up encoding large history pages
+    orjson = None
+
+MSGPACK_SUBPROTOCOL = 'chat.msgpack'
+
+# Frames whose "messages" are sent as columns over MessagePack
+COLUMNAR_FRAMES = {'history', 'older_history', 'resumed'}
+
+PACKED_TEXTS = 256
+
+
+def dumps(frame):
+    if orjson is not None:
+        return orjson.dumps(frame).decode()
+    return json.dumps(frame, ensure_ascii=False, separators=(',', ':'))
+
+
+def epoch_ms(timestamp):
+    return int(timestamp.timestamp() * 1000)
+
+
+def from_epoch_ms(ms):
+    return datetime.fromtimestamp(int(ms) / 1000, tz=timezone.utc)
+
+
+def message(message_id, username, text, timestamp, **extra):
+    data = {"username": username, "message": text, "timestamp": epoch_ms(timestamp), "message_id": message_id}
+    data.update((key, value) for key, value in extra.items() if value is not None)
+    return data
+
+
+def columns(messages):
+    # [{"message_id": 1, ...}, ...] -> {"message_id": [1, ...], ...}, None where a message lacks a key
+    keys = dict.fromkeys(key for data in messages for key in data)
+    return {key: [data.get(key) for data in messages] for key in keys}
+
+
+def pack(frame):
+    if frame.get("type") in COLUMNAR_FRAMES and "messages" in frame:
+        frame = dict(frame)
+        frame["columns"] = columns(frame.pop("messages"))
+    return msgpack.packb(frame, use_bin_type=True)
+
+
+def unpack(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+_packed = OrderedDict()  # JSON text -> its MessagePack
+
+
+def pack_text(text):
+    # Live events reach every local recipient as the same encoded text,
+    # convert it once for all of them
+    packed = _packed.get(text)
+    if packed is None:
+        packed = _packed[text] = pack(json.loads(text))
+        if len(_packed) > PACKED_TEXTS:
+            _packed.popitem(last=False)
+    return packed
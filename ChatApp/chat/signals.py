@@ -0,0 +1,105 @@
+# chat/signals.py
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import access
+from . import auth
+from . import conversations
+from . import instrumentation
+from . import rooms
+from . import search
+from . import sequences
+from .models import Message, DirectMessage, Room
+from .writebehind import rows_written
+from users.models import User
+
+
+@receiver(m2m_changed, sender=Room.users.through)
+def room_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        rooms.invalidate_members(instance.pk)
+    elif pk_set:
+        # user.rooms.add(...) and friends: pk_set holds the room ids
+        for room_id in pk_set:
+            rooms.invalidate_members(room_id)
+    else:
+        # user.rooms.clear() doesn't say which rooms were affected
+        rooms.invalidate_all_members()
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def room_changed(sender, instance, **kwargs):
+    rooms.invalidate_room(instance.pk)
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    search.remove_scope('room', instance.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    # Logins save last_login only, nothing cached depends on it
+    if update_fields is None or set(update_fields) - {'last_login'}:
+        access.invalidate_user(instance.pk)
+        auth.invalidate_user(instance.pk)
+
+
+@receiver(user_logged_out)
+def logged_out(sender, request, **kwargs):
+    auth.forget_session(request.session.session_key)
+
+
+@receiver(rows_written, sender=DirectMessage)
+def direct_messages_written(sender, objs, **kwargs):
+    conversations.record(objs)
+
+
+@receiver(post_save, sender=DirectMessage)
+def direct_message_saved(sender, instance, created, **kwargs):
+    if created:
+        conversations.record([instance])
+
+
+@receiver(pre_save, sender=Message)
+@receiver(pre_save, sender=DirectMessage)
+def number_message(sender, instance, raw, **kwargs):
+    # The consumers number messages before sending them, this covers other writers
+    if instance.seq is None and not raw:
+        instance.seq = sequences.number(instance)
+
+
+@receiver(rows_written, sender=Message)
+@receiver(rows_written, sender=DirectMessage)
+def messages_written(sender, objs, **kwargs):
+    search.index_messages(objs)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_save, sender=DirectMessage)
+def message_saved(sender, instance, created, **kwargs):
+    if created:
+        search.index_messages([instance])
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    instrumentation.install(connection)
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    # Only per-connection settings: the journal mode and the search table
+    # belong to the file, `manage.py prepare_sqlite` sets them up once
+    with connection.cursor() as cursor:
+        for pragma, value in getattr(settings, 'CHAT_SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
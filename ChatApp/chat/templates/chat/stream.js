@@ -0,0 +1,320 @@
+{# chat/templates/chat/stream.js #}
+{# Socket client shared by the room and direct message pages, included inside their <script>. #}
+{# The page defines messageLog, loadOlderButton, target (what to subscribe to, e.g. { room }) and renderMessage(message). #}
+    let chatSocket = null;  // Store the WebSocket connection reference
+    let stream = null;  // id of this page's subscription on the shared socket
+    let oldestCursor = null;  // {seq} of the oldest message shown
+    let hasMore = false;
+    let loadingOlder = false;
+
+    // Fill a <datalist> with usernames starting with what has been typed
+    function autocompleteUsernames(input, list) {
+        let timer = null;
+        input.addEventListener('input', () => {
+            clearTimeout(timer);
+            timer = setTimeout(() => {
+                const query = input.value.trim();
+                if (!query) {
+                    list.replaceChildren();
+                    return;
+                }
+                fetch(`{% url 'users:autocomplete' %}?q=${encodeURIComponent(query)}`)
+                    .then(response => response.json())
+                    .then(data => list.replaceChildren(...data.users.map(username => new Option(username))));
+            }, 150);
+        });
+    }
+
+    window.addEventListener('beforeunload', () => {
+        if (chatSocket) {
+            chatSocket.close();
+        }
+    });
+
+    function connectToWebSocket() {
+        if (!chatSocket) {
+            chatSocket = new WebSocket(`ws://${window.location.host}/ws/stream/`);
+
+            chatSocket.onopen = () => chatSocket.send(JSON.stringify({ type: 'subscribe', ...target, resume: resumePoint() }));
+            chatSocket.onmessage = handleSocketMessage;
+            chatSocket.onclose = handleSocketClose;
+        }
+    }
+
+    // The newest message shown and when the server last synced us, so a reconnect only fetches what changed
+    let newest = null;
+    let synced = null;
+    let gapTimer = null;
+    const unconfirmed = new Map();  // client_id -> message frame, resent after a reconnect until it comes back
+
+    function resumePoint() {
+        return newest && synced ? { seq: newest.seq, synced } : undefined;
+    }
+
+    function watchGap(seq) {
+        // A skipped seq is usually a message still on its way from another server process, resync if it doesn't come
+        if (gapTimer) {
+            return;
+        }
+        gapTimer = setTimeout(() => {
+            gapTimer = null;
+            if (!messageLog.querySelector(`[data-seq="${seq + 1}"]`) && chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+                chatSocket.send(JSON.stringify({ type: 'subscribe', ...target, resume: { seq, synced } }));
+            }
+        }, 1000);
+    }
+
+    function sendMessage(text) {
+        // The client_id lets the server drop the copy if this is sent again after a reconnect
+        const frame = { type: 'message', message: text, client_id: `${Date.now()}-${Math.random().toString(36).slice(2)}` };
+        unconfirmed.set(frame.client_id, frame);
+        if (stream && chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+            chatSocket.send(JSON.stringify({ ...frame, stream }));
+        }
+    }
+
+    function resendUnconfirmed() {
+        // Marked as a retry so the server checks whether another of its processes stored it already
+        unconfirmed.forEach(frame => chatSocket.send(JSON.stringify({ ...frame, stream, retry: true })));
+    }
+
+    function confirmSent(message) {
+        if (message.client_id) {
+            unconfirmed.delete(message.client_id);
+        }
+    }
+
+    function handleSocketClose(event) {
+        if (event.code !== 1000) {  // 1000 indicates a normal closure
+            console.error('Chat socket closed unexpectedly. Reconnecting...');
+            chatSocket = null;
+            setTimeout(connectToWebSocket, 2000);
+        }
+    }
+
+    document.addEventListener('visibilitychange', () => {
+        if (document.visibilityState === 'hidden') {
+            // Pause WebSocket or other activities
+            if (chatSocket) {
+                chatSocket.close();
+            }
+        } else {
+            // Resume WebSocket or other activities
+            connectToWebSocket();
+        }
+    });
+
+    function handleSocketMessage(e) {
+        const data = JSON.parse(e.data);
+        if (data.type === 'subscribed' && Object.keys(target).every(key => data[key] === target[key])) {
+            stream = data.stream;
+            return;
+        }
+        if (data.stream !== stream) {
+            return;
+        }
+        switch (data.type) {
+            case 'history':
+                updateChatLog(data.messages);
+                updatePaging(data);
+                synced = data.synced;
+                data.messages.forEach(confirmSent);
+                resendUnconfirmed();
+                markRead(data.messages[data.messages.length - 1]);
+                break;
+            case 'resumed':
+                data.deleted.forEach(removeMessage);
+                data.messages.forEach(appendMessage);
+                synced = data.synced;
+                data.messages.forEach(confirmSent);
+                resendUnconfirmed();
+                markRead(data.messages[data.messages.length - 1]);
+                updateReceipts({});
+                break;
+            case 'older_history':
+                prependMessages(data.messages);
+                updatePaging(data);
+                break;
+            case 'message_created':
+                if (newest && data.message.seq > newest.seq + 1) {
+                    watchGap(newest.seq);
+                }
+                confirmSent(data.message);
+                appendMessage(data.message);
+                markRead(data.message);
+                updateReceipts({});
+                break;
+            case 'read_receipts':
+                updateReceipts(data.readers);
+                break;
+            case 'presence':
+                updatePresence(data);
+                break;
+            case 'message_deleted':
+                removeMessage(data.message_id);
+                break;
+        }
+    }
+
+    // The socket is only open while the page is visible, so what it shows has been read
+    const receiptsLine = document.getElementById('read-receipts');
+    let readers = {};  // username -> newest message id they have read
+
+    function markRead(message) {
+        if (message && stream && chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+            chatSocket.send(JSON.stringify({ type: 'read', stream, message_id: message.message_id, timestamp: message.timestamp }));
+        }
+    }
+
+    function updateReceipts(update) {
+        Object.assign(readers, update);
+        const last = messageLog.lastElementChild;
+        const lastId = last ? Number(last.id.replace('message-', '')) : null;
+        const names = Object.keys(readers).filter(name => name !== '{{ user.username }}' && readers[name] === lastId);
+        receiptsLine.textContent = names.length ? `Read by ${names.join(', ')}` : '';
+    }
+
+    const presenceLine = document.getElementById('presence');
+    const online = {};  // username -> when their presence expires (ms)
+    const typing = {};  // username -> when their typing indicator expires (ms)
+    let lastTyping = 0;
+
+    function updatePresence(data) {
+        // Frames from each server process only add to what the others said, names expire unless repeated
+        const now = Date.now();
+        data.online.forEach(name => online[name] = now + data.ttl * 1000);
+        data.offline.forEach(name => delete online[name]);
+        data.typing.forEach(name => typing[name] = now + data.typing_ttl * 1000);
+        data.idle.forEach(name => delete typing[name]);
+        renderPresence();
+    }
+
+    function renderPresence() {
+        if (!presenceLine) {
+            return;
+        }
+        const now = Date.now();
+        const active = names => Object.keys(names)
+            .filter(name => names[name] > now && name !== '{{ user.username }}')
+            .map(name => name.charAt(0).toUpperCase() + name.slice(1));
+        const here = active(online);
+        const writing = active(typing);
+        presenceLine.textContent = [
+            here.length ? `Online: ${here.join(', ')}` : '',
+            writing.length ? `${writing.join(', ')} ${writing.length === 1 ? 'is' : 'are'} typing…` : '',
+        ].filter(Boolean).join(' · ');
+    }
+
+    function sendTyping() {
+        // One frame every 2 seconds keeps the indicator up, keystrokes in between aren't sent
+        if (stream && chatSocket && chatSocket.readyState === WebSocket.OPEN && Date.now() - lastTyping > 2000) {
+            lastTyping = Date.now();
+            chatSocket.send(JSON.stringify({ type: 'typing', stream }));
+        }
+    }
+
+    setInterval(renderPresence, 1000);
+    setInterval(() => {
+        if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+            chatSocket.send(JSON.stringify({ type: 'heartbeat' }));
+        }
+    }, 20000);
+
+    function removeMessage(messageId) {
+        const element = document.getElementById(`message-${messageId}`);
+        if (element) {
+            element.remove();
+        }
+    }
+
+    function updateChatLog(messages) {
+        messageLog.innerHTML = '';  // Clear existing messages
+        newest = null;
+        messages.forEach(appendMessage);
+    }
+
+    function updatePaging({ cursor, has_more }) {
+        if (cursor) {
+            oldestCursor = cursor;
+        }
+        hasMore = has_more;
+        loadingOlder = false;
+        loadOlderButton.style.display = hasMore ? '' : 'none';
+    }
+
+    function loadOlderMessages() {
+        if (hasMore && !loadingOlder && oldestCursor && chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+            loadingOlder = true;
+            chatSocket.send(JSON.stringify({ type: 'load_older', stream, before: oldestCursor }));
+        }
+    }
+
+    function prependMessages(messages) {
+        // Keep the current view in place while older messages are inserted above it
+        const previousHeight = messageLog.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        messages.forEach(message => fragment.appendChild(renderMessage(message)));
+        messageLog.insertBefore(fragment, messageLog.firstChild);
+        messageLog.scrollTop += messageLog.scrollHeight - previousHeight;
+    }
+
+    if (messageLog) {
+        loadOlderButton.addEventListener('click', loadOlderMessages);
+        messageLog.addEventListener('scroll', () => {
+            if (messageLog.scrollTop === 0) {
+                loadOlderMessages();
+            }
+        });
+    }
+
+    function appendMessage({ username = "Unknown User", message = "No message", timestamp = "Unknown time", message_id, seq }) {
+        if (document.getElementById(`message-${message_id}`)) {
+            return;  // already shown, e.g. a retry or a resume sent it again
+        }
+        const element = renderMessage({ username, message, timestamp, message_id, seq });
+        if (newest && seq < newest.seq) {
+            // Messages sent through other server processes can arrive out of order
+            const later = Array.from(messageLog.children).find(child => Number(child.dataset.seq) > seq);
+            messageLog.insertBefore(element, later || null);
+        } else {
+            messageLog.appendChild(element);
+            newest = { seq };
+        }
+        scrollToBottom();
+        showNotification(username, message);
+    }
+
+    // Timestamps arrive as epoch milliseconds, shown in the browser's time zone
+    function formatTimestamp(ms) {
+        if (typeof ms !== 'number') return ms;
+        const date = new Date(ms);
+        const month = date.toLocaleString('en-US', { month: 'short' });
+        const pad = (n) => String(n).padStart(2, '0');
+        return `${month} ${pad(date.getDate())}, ${date.getFullYear()} ${pad(date.getHours())}:${pad(date.getMinutes())}`;
+    }
+
+    function showNotification(username, message) {
+        if (Notification.permission === 'granted') {
+            if(username) //  show notification only if username is present
+                new Notification(`New message from ${username}`, { body: message });
+        }
+    }
+
+    // Request notification permission
+    if (Notification.permission === 'default') {
+        Notification.requestPermission().then(permission => {
+            if (permission === 'granted') {
+                console.log('Notification permission granted.');
+            }
+        });
+    }
+
+    function scrollToBottom() {
+        messageLog.scrollTop = messageLog.scrollHeight;
+    }
+
+    function handleDeleteMessage(messageId) {
+        if (confirm("Are you sure you want to delete this message?")) {
+            chatSocket.send(JSON.stringify({ type: 'delete', stream, message_id: messageId }));
+        }
+    }
@@ -1,3 +1,1040 @@
-from django.test import TestCase
+# chat/tests.py
+# Budget tests: each page, endpoint and socket event below must stay within
+# the queries and database hops it costs today (see instrumentation.py). The
+# behavior tests cover membership checks, client_id dedup and seq numbers,
+# session invalidation, conversation summaries, read receipts, archiving,
+# metrics, MessagePack frames, resume, the write-behind queue and the
+# Unix-socket channel layer.
+#
+# Consumer tests run under TransactionTestCase, the consumers query the
+# database from the chat.db thread pool, which doesn't see uncommitted rows.
+import asyncio
+import os
+import tempfile
+import time
+from datetime import timedelta
+from functools import partial
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    access, archive, auth, conversations, flow, history, instrumentation, metrics, rooms, search, sequences,
+    serialization,
+)
+from .conversations import conversation_page
+from .db import database_sync_to_async
+from .hot_history import hot_history
+from .idempotency import recent_keys
+from .instrumentation import assert_budget
+from .layers import UnixSocketChannelLayer
+from .models import ArchivedMessage, Conversation, DirectMessage, Message, ReadCursor, Room, Tombstone
+from .presence import PRESENCE_TICK, Presence, presence
+from .reads import read_cursors, receipts
+from .routing import websocket_urlpatterns
+from .writebehind import reserve_ids, write_behind
+from users.models import User
+
+IN_MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def database(func):
+    # func() on a database thread, like the consumers run their queries
+    return database_sync_to_async(func)()
+
+
+def reset_caches():
+    # Process-wide state outlives the rows each test rolls back or flushes
+    rooms._rooms.clear()
+    rooms._members.clear()
+    access._users.clear()
+    auth._sessions.clear()
+    search._found.clear()
+    recent_keys.keys.clear()
+    hot_history.__init__()
+    presence.places.clear()
+    presence._task = None
+    read_cursors.__init__()
+    receipts.__init__()
+    sequences.sequences.__init__()
+    sequences._checked.clear()
+    write_behind.pending, write_behind.failed, write_behind.blocks = [], [], {}
+    write_behind._timer = write_behind._retry = write_behind._lock = None
+
+
+class ChatTestCase(TestCase):
+    databases = {'default', 'sequences'}
+
+    def setUp(self):
+        reset_caches()
+        self.alice = User.objects.create_user('alice', password='secret', user_type='pro')
+        self.bob = User.objects.create_user('bob', password='secret', user_type='basic')
+        self.room = Room.objects.create(name='General')
+        self.room.users.add(self.alice, self.bob)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class ConsumerTestCase(TransactionTestCase):
+    databases = {'default', 'sequences'}
+
+    def setUp(self):
+        reset_caches()
+        self.alice = User.objects.create_user('alice', password='secret', user_type='pro')
+        self.bob = User.objects.create_user('bob', password='secret', user_type='basic')
+        self.carol = User.objects.create_user('carol', password='secret', user_type='basic')
+        self.room = Room.objects.create(name='General')
+        self.room.users.add(self.alice, self.bob)
+
+    async def connect(self, user, path='/ws/stream/', refused=False):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertEqual(connected, not refused)
+        return communicator
+
+    async def receive(self, communicator, *types):
+        # The next frame of one of `types`, skipping presence and the like
+        while True:
+            frame = await communicator.receive_json_from(timeout=5)
+            if frame['type'] in types:
+                return frame
+
+    async def subscribe(self, communicator, **target):
+        await communicator.send_json_to({'type': 'subscribe', **target})
+        frame = await self.receive(communicator, 'subscribed', 'error')
+        if frame['type'] == 'error':
+            return frame, None
+        return frame, await self.receive(communicator, 'history', 'resumed')
+
+    async def send_message(self, communicator, stream, text, **extra):
+        await communicator.send_json_to({'type': 'message', 'stream': stream, 'message': text, **extra})
+        return (await self.receive(communicator, 'message_created'))['message']
+
+    async def close(self, *communicators):
+        for communicator in communicators:
+            await communicator.disconnect()
+        await write_behind.flush()
+
+
+class HttpBudgetTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(60):
+            Message.objects.create(room=self.room, username='Alice', message=f'hello {i}')
+        self.client.force_login(self.alice)
+
+    def test_room_page(self):
+        with assert_budget('http GET chat:room', queries=8) as seen:
+            response = self.client.get(reverse('chat:room'), {'room_name': 'General'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(any(m.name == 'http GET chat:room' for m in seen))
+
+    def test_conversations(self):
+        for i in range(30):
+            DirectMessage.objects.create(sender=self.alice, receiver=self.bob, message=f'hi {i}')
+        with assert_budget('http GET chat:conversations', queries=6):
+            response = self.client.get(reverse('chat:conversations'))
+        self.assertEqual([c['peer'] for c in response.json()['conversations']], ['bob'])
+
+    def test_search(self):
+        search.create_index(connection)
+        Message.objects.create(room=self.room, username='Bob', message='find the needle')
+        with assert_budget('http GET chat:search', queries=8):
+            response = self.client.get(reverse('chat:search'), {'q': 'needle', 'room': 'General'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 1)
+
+
+class MembershipTests(ChatTestCase):
+    def test_room_page_needs_membership(self):
+        carol = User.objects.create_user('carol', password='secret')
+        self.client.force_login(carol)
+        url = reverse('chat:room')
+        self.assertRedirects(self.client.get(url, {'room_name': 'General'}), reverse('chat:index'))
+
+        self.room.users.add(carol)
+        self.assertEqual(self.client.get(url, {'room_name': 'General'}).status_code, 200)
+
+        self.room.users.remove(carol)
+        self.assertRedirects(self.client.get(url, {'room_name': 'General'}), reverse('chat:index'))
+
+    def test_cached_membership_follows_changes(self):
+        carol = User.objects.create_user('carol', password='secret')
+        room = rooms.get_room('General')
+        self.assertFalse(rooms.is_member(room, carol))
+        self.assertIsNone(rooms.cached_room('General', carol))
+
+        carol.rooms.add(self.room)
+        self.assertIs(rooms.cached_room('General', carol), rooms.MISSING)
+        self.assertTrue(rooms.is_member(room, carol))
+
+        self.room.delete()
+        self.assertIsNone(rooms.get_room('General'))
+
+    def test_search_needs_membership(self):
+        search.create_index(connection)
+        carol = User.objects.create_user('carol', password='secret')
+        self.client.force_login(carol)
+        response = self.client.get(reverse('chat:search'), {'q': 'hello', 'room': 'General'})
+        self.assertEqual(response.status_code, 404)
+
+
+class SessionTests(ChatTestCase):
+    def login(self, user):
+        self.client.force_login(user)
+        return self.client.session.session_key
+
+    def test_authenticate(self):
+        key = self.login(self.alice)
+        self.assertEqual(auth.authenticate(key), auth.SlimUser(self.alice.id, 'alice', 'pro'))
+        self.assertIsNone(auth.authenticate('no-such-session'))
+
+    def test_logout_forgets_session(self):
+        key = self.login(self.alice)
+        auth._sessions[key] = (float('inf'), auth.authenticate(key))
+        self.client.logout()
+        self.assertNotIn(key, auth._sessions)
+        self.assertIsNone(auth.authenticate(key))
+
+    def test_password_change_ends_sessions(self):
+        key = self.login(self.alice)
+        auth._sessions[key] = (float('inf'), auth.authenticate(key))
+        self.alice.set_password('changed')
+        self.alice.save()
+        self.assertNotIn(key, auth._sessions)
+        self.assertIsNone(auth.authenticate(key))
+
+    def test_login_keeps_cached_sessions(self):
+        key = self.login(self.alice)
+        auth._sessions[key] = (float('inf'), auth.authenticate(key))
+        self.alice.save(update_fields=['last_login'])
+        self.assertIn(key, auth._sessions)
+
+    def test_user_type_change_drops_cached_user(self):
+        key = self.login(self.bob)
+        auth._sessions[key] = (float('inf'), auth.authenticate(key))
+        self.bob.user_type = 'pro'
+        self.bob.save()
+        self.assertNotIn(key, auth._sessions)
+        self.assertEqual(auth.authenticate(key).user_type, 'pro')
+
+
+class WriteBehindTests(ChatTestCase):
+    def test_reserved_ids_are_skipped_by_create(self):
+        block = reserve_ids(Message, 10)
+        message = Message.objects.create(room=self.room, username='Alice', message='direct insert')
+        self.assertGreaterEqual(message.id, block.stop)
+        self.assertGreaterEqual(reserve_ids(Message, 10).start, message.id + 1)
+
+    def test_blocks_start_above_existing_rows(self):
+        message = Message.objects.create(room=self.room, username='Alice', message='first')
+        self.assertGreater(reserve_ids(Message, 5).start, message.id)
+
+
+class ConversationTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.carol = User.objects.create_user('carol', password='secret')
+        for i in range(3):
+            DirectMessage.objects.create(sender=self.alice, receiver=self.bob, message=f'hi {i}')
+        self.reply = DirectMessage.objects.create(sender=self.bob, receiver=self.alice, message='hello')
+        for i in range(2):
+            DirectMessage.objects.create(sender=self.carol, receiver=self.bob, message='x' * 200)
+
+    def test_unread_counts(self):
+        # Replying reads the conversation, for the sender only
+        page, _, _ = conversation_page(self.bob)
+        self.assertEqual([(c['peer'], c['unread'], c['last_sender']) for c in page], [
+            ('carol', 2, 'carol'), ('alice', 0, 'bob'),
+        ])
+        self.assertEqual(len(page[0]['last_message']), conversations.PREVIEW_LENGTH)
+        page, _, _ = conversation_page(self.alice)
+        self.assertEqual([(c['peer'], c['unread'], c['last_message']) for c in page], [('bob', 1, 'hello')])
+
+    def test_pages_follow_the_cursor(self):
+        self.client.force_login(self.bob)
+        first = self.client.get(reverse('chat:conversations'), {'limit': 1}).json()
+        self.assertEqual([c['peer'] for c in first['conversations']], ['carol'])
+        self.assertTrue(first['has_more'])
+        cursor = first['cursor']
+        second = self.client.get(reverse('chat:conversations'), {
+            'limit': 1, 'before': cursor['timestamp'], 'before_id': cursor['message_id'],
+        }).json()
+        self.assertEqual([c['peer'] for c in second['conversations']], ['alice'])
+        self.assertFalse(second['has_more'])
+
+    def test_late_batch_only_adds_unread(self):
+        late = DirectMessage(
+            sender=self.alice, receiver=self.bob, message='sent earlier', conversation=self.reply.conversation,
+            timestamp=self.reply.timestamp - timedelta(minutes=1),
+        )
+        conversations.record([late])
+        row = Conversation.objects.get(user=self.bob, key=self.reply.conversation)
+        self.assertEqual((row.last_message, row.unread), ('hello', 1))
+
+    def test_delete_refreshes_the_last_message(self):
+        reply_id = self.reply.id
+        self.reply.delete()
+        conversations.message_deleted(self.reply.conversation, reply_id)
+        page, _, _ = conversation_page(self.alice)
+        self.assertEqual((page[0]['last_message'], page[0]['last_sender']), ('hi 2', 'alice'))
+
+
+class ArchiveTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        old = timezone.now() - timedelta(days=archive.ARCHIVE_AFTER_DAYS + 1)
+        self.old = [
+            Message.objects.create(room=self.room, username='Alice', message=f'old {i}', timestamp=old) for i in range(5)
+        ]
+        self.new = [Message.objects.create(room=self.room, username='Bob', message=f'new {i}') for i in range(3)]
+
+    def test_command_moves_old_rows(self):
+        out = StringIO()
+        call_command('archive_messages', batch_size=2, pause=0, stdout=out)
+        self.assertIn("Done, 5 messages archived.", out.getvalue())
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [m.id for m in self.new])
+        self.assertEqual(
+            list(ArchivedMessage.objects.order_by('id').values_list('id', 'seq')), [(m.id, m.seq) for m in self.old],
+        )
+        with self.assertRaises(CommandError):
+            call_command('archive_messages', days=0.5, stdout=out)
+
+    def test_history_falls_through_to_the_archive(self):
+        # Half done, as if archiving was interrupted: old rows are in both tables
+        archive.archive_batch(Message, archive.horizon(), batch_size=3)
+        messages, cursor, has_more = history.room_history(self.room.id, self.alice, limit=4)
+        self.assertEqual([m['message'] for m in messages], ['old 4', 'new 0', 'new 1', 'new 2'])
+        self.assertTrue(has_more)
+        messages, cursor, has_more = history.room_history(self.room.id, self.alice, before=cursor['seq'], limit=4)
+        self.assertEqual([m['message'] for m in messages], ['old 0', 'old 1', 'old 2', 'old 3'])
+        self.assertFalse(has_more)
+
+        # Basic users only read the hot rows of the retention window
+        messages, _, _ = history.room_history(self.room.id, self.bob)
+        self.assertEqual([m['message'] for m in messages], ['new 0', 'new 1', 'new 2'])
+
+    def test_delete_reaches_archived_rows(self):
+        archive.archive(Message, archive.horizon())
+        self.assertTrue(archive.delete(Message, self.old[0].id, room_id=self.room.id))
+        self.assertFalse(ArchivedMessage.objects.filter(id=self.old[0].id).exists())
+        self.assertTrue(Tombstone.objects.filter(key=f'room:{self.room.id}', message_id=self.old[0].id).exists())
+        self.assertFalse(archive.delete(Message, self.old[0].id, room_id=self.room.id))
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(metrics, 'METRICS_DIR', directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.registry = metrics.Registry()
+        self.sent = self.registry.counter('chat_test_sent_total', "Sent.", ['model'])
+        self.latency = self.registry.histogram('chat_test_seconds', "Latency.", buckets=(0.1, 1))
+
+    def test_render(self):
+        self.sent.labels('Message').inc(2)
+        self.latency.observe(0.05)
+        self.latency.observe(5)
+        self.assertEqual(metrics.render(self.registry.snapshot()), '\n'.join([
+            '# HELP chat_test_seconds Latency.',
+            '# TYPE chat_test_seconds histogram',
+            'chat_test_seconds_bucket{le="0.1"} 1',
+            'chat_test_seconds_bucket{le="1.0"} 1',
+            'chat_test_seconds_bucket{le="+Inf"} 2',
+            'chat_test_seconds_sum 5.05',
+            'chat_test_seconds_count 2',
+            '# HELP chat_test_sent_total Sent.',
+            '# TYPE chat_test_sent_total counter',
+            'chat_test_sent_total{model="Message"} 2',
+        ]) + '\n')
+
+    def test_labels_are_capped(self):
+        with mock.patch.object(metrics, 'MAX_SERIES', 2):
+            for model in ('a', 'b', 'c', 'd'):
+                self.sent.labels(model).inc()
+        self.assertEqual(self.sent.samples(), {('a',): 1, ('b',): 1, ('other',): 2})
+
+    def test_collect_merges_live_workers(self):
+        self.sent.labels('Message').inc()
+        self.latency.observe(0.5)
+        other = metrics.Registry()
+        other.counter('chat_test_sent_total', "Sent.", ['model']).labels('Message').inc(3)
+        other.histogram('chat_test_seconds', "Latency.", buckets=(0.1, 1)).observe(0.5)
+        with mock.patch('os.getpid', return_value=1):
+            other.publish()
+        # A worker that stopped publishing has exited, its snapshot is dropped
+        with mock.patch('os.getpid', return_value=2), mock.patch('time.time', return_value=0):
+            other.publish()
+
+        merged = self.registry.collect()
+        self.assertEqual(merged['chat_test_sent_total'][4], [[['Message'], 4]])
+        self.assertEqual(merged['chat_test_seconds'][4], [[[], [[0, 2, 0], 1.0]]])
+        self.assertEqual(sorted(os.listdir(metrics.METRICS_DIR)), ['1.json'])
+
+
+class MetricsViewTests(ChatTestCase):
+    def test_staff_or_token_only(self):
+        url = reverse('chat:metrics')
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        with override_settings(CHAT_METRICS_TOKEN='scrape'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            response = self.client.get(url, HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE chat_sockets gauge', response.content)
+
+        self.alice.is_staff = True
+        self.alice.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class SocketBudgetTests(ConsumerTestCase):
+    @async_to_sync
+    async def test_subscribe_and_send(self):
+        alice, bob = await self.connect(self.alice), await self.connect(self.bob)
+        with assert_budget('ws MultiplexConsumer subscribe', queries=10, hops=2):
+            subscribed, history = await self.subscribe(alice, room='General')
+        await self.subscribe(bob, room='General')
+        stream = subscribed['stream']
+        # The first message reserves an id block and starts the room's sequence
+        await self.send_message(alice, stream, 'warm up')
+        await self.receive(bob, 'message_created')
+
+        with assert_budget('ws MultiplexConsumer message', queries=4, hops=1):
+            sent = await self.send_message(alice, stream, 'hello')
+        with assert_budget('ws MultiplexConsumer message_created', queries=0, hops=0):
+            received = (await self.receive(bob, 'message_created'))['message']
+        self.assertEqual(received['message_id'], sent['message_id'])
+
+        # A second subscriber is served from the hot history, no hop for the page
+        carol = await self.connect(self.bob)
+        with assert_budget('ws MultiplexConsumer subscribe', queries=0, hops=0):
+            _, history = await self.subscribe(carol, room='General')
+        self.assertEqual([m['message'] for m in history['messages']], ['warm up', 'hello'])
+        await self.close(alice, bob, carol)
+
+
+class BatchBudgetTests(ConsumerTestCase):
+    @async_to_sync
+    async def test_batched_work_is_not_charged_to_one_sender(self):
+        sockets = [await self.connect(user) for user in (self.alice, self.bob) for _ in range(5)]
+        streams = [(await self.subscribe(socket, room='General'))[0]['stream'] for socket in sockets]
+        await self.send_message(sockets[0], streams[0], 'warm up')
+
+        # Sent together, so one reservation numbers them all and one flush writes them
+        with assert_budget('ws MultiplexConsumer message', queries=4, hops=1) as seen:
+            for socket, stream in zip(sockets, streams):
+                await socket.send_json_to({'type': 'message', 'stream': stream, 'message': 'together'})
+            for socket in sockets:
+                while (await self.receive(socket, 'message_created'))['message']['message'] != 'together':
+                    pass
+            await write_behind.flush()
+        self.assertEqual(len([m for m in seen if m.name == 'ws MultiplexConsumer message']), len(sockets))
+        await self.close(*sockets)
+
+    @async_to_sync
+    async def test_unknown_frame_types_share_a_name(self):
+        alice = await self.connect(self.alice)
+        for i in range(30):
+            await alice.send_json_to({'type': f'junk {i}'})
+        await alice.send_json_to({'type': 'heartbeat'})
+        # Frames are handled in order, so the junk is measured once this is answered
+        await alice.send_json_to({'type': 'subscribe', 'room': 'General'})
+        await self.receive(alice, 'subscribed')
+        names = [name for name in instrumentation.stats if name.startswith('ws MultiplexConsumer')]
+        self.assertIn('ws MultiplexConsumer unknown', names)
+        self.assertIn('ws MultiplexConsumer heartbeat', names)
+        self.assertFalse([name for name in names if 'junk' in name])
+        await self.close(alice)
+
+
+class SubscribeTests(ConsumerTestCase):
+    @async_to_sync
+    async def test_non_member_cannot_subscribe(self):
+        carol = await self.connect(self.carol)
+        error, _ = await self.subscribe(carol, room='General')
+        self.assertEqual(error, {'type': 'error', 'error': 'No such room'})
+        error, _ = await self.subscribe(carol, room='Nowhere')
+        self.assertEqual(error['error'], 'No such room')
+
+        # Frames for a stream that wasn't subscribed to are refused
+        await carol.send_json_to({'type': 'message', 'stream': 'room:General', 'message': 'let me in'})
+        self.assertEqual((await self.receive(carol, 'error'))['error'], 'Not subscribed')
+        await self.close(carol)
+
+    @async_to_sync
+    async def test_invite_and_remove(self):
+        carol = await self.connect(self.carol)
+        await self.subscribe(carol, room='General')
+        await database(lambda: self.room.users.add(self.carol))
+        subscribed, _ = await self.subscribe(carol, room='General')
+        self.assertEqual(subscribed['stream'], 'room:General')
+
+        await database(lambda: self.room.users.remove(self.carol))
+        other = await self.connect(self.carol)
+        error, _ = await self.subscribe(other, room='General')
+        self.assertEqual(error['error'], 'No such room')
+        await self.close(carol, other)
+
+    @async_to_sync
+    async def test_removed_member_loses_the_stream(self):
+        alice, bob = await self.connect(self.alice), await self.connect(self.bob)
+        stream = (await self.subscribe(alice, room='General'))[0]['stream']
+        await self.subscribe(bob, room='General')
+        sent = await self.send_message(bob, stream, 'before')
+
+        await database(lambda: self.room.users.remove(self.bob))
+        await bob.send_json_to({'type': 'message', 'stream': stream, 'message': 'after'})
+        self.assertEqual(await self.receive(bob, 'error'), {'type': 'error', 'error': 'No such room', 'stream': stream})
+        self.assertEqual(await self.receive(bob, 'unsubscribed'), {'type': 'unsubscribed', 'stream': stream})
+        await bob.send_json_to({'type': 'delete', 'stream': stream, 'message_id': sent['message_id']})
+        self.assertEqual((await self.receive(bob, 'error'))['error'], 'Not subscribed')
+        # Alice saw neither the message nor the delete
+        self.assertEqual([m['message'] for m in (await self.subscribe(alice, room='General'))[1]['messages']], ['before'])
+        await self.close(alice, bob)
+
+    @async_to_sync
+    async def test_unknown_user(self):
+        alice = await self.connect(self.alice)
+        error, _ = await self.subscribe(alice, dm='nobody')
+        self.assertEqual(error['error'], 'No such user')
+        await self.close(alice)
+
+
+class SingleStreamTests(ConsumerTestCase):
+    @async_to_sync
+    async def test_room_route(self):
+        await self.connect(self.carol, '/ws/chat/General/', refused=True)
+        await self.connect(self.alice, '/ws/chat/Nowhere/', refused=True)
+
+        alice = await self.connect(self.alice, '/ws/chat/General/')
+        history = await self.receive(alice, 'history')
+        self.assertEqual((history['stream'], history['messages']), ('room:General', []))
+        # Frames don't name the stream, events for it still arrive on the socket
+        bob = await self.connect(self.bob)
+        stream = (await self.subscribe(bob, room='General'))[0]['stream']
+        await alice.send_json_to({'type': 'message', 'message': 'hello', 'username': 'alice'})
+        sent = (await self.receive(alice, 'message_created'))['message']
+        self.assertEqual((await self.receive(bob, 'message_created'))['message'], sent)
+        await self.send_message(bob, stream, 'hi back')
+        self.assertEqual((await self.receive(alice, 'message_created'))['message']['message'], 'hi back')
+
+        await alice.send_json_to({'type': 'subscribe', 'room': 'Other'})
+        self.assertEqual((await self.receive(alice, 'error'))['stream'], 'room:General')
+        await self.close(alice, bob)
+
+    @async_to_sync
+    async def test_direct_message_route(self):
+        await self.connect(self.alice, '/ws/direct_messages/nobody/', refused=True)
+        alice = await self.connect(self.alice, '/ws/direct_messages/bob/')
+        history = await self.receive(alice, 'history')
+        await alice.send_json_to({'type': 'message', 'message': 'yo', 'receiver': 'bob'})
+        sent = (await self.receive(alice, 'message_created'))['message']
+        self.assertEqual((sent['message'], sent['receiver']), ('yo', 'bob'))
+
+        bob = await self.connect(self.bob, '/ws/direct_messages/alice/')
+        history = await self.receive(bob, 'history')
+        self.assertEqual([m['message'] for m in history['messages']], ['yo'])
+        await self.close(alice, bob)
+
+    @async_to_sync
+    async def test_failed_frame_gets_error(self):
+        alice = await self.connect(self.alice)
+        stream = (await self.subscribe(alice, room='General'))[0]['stream']
+        with self.assertLogs('chat.consumers', 'ERROR'):
+            await alice.send_json_to({'type': 'message', 'stream': stream})
+            error = await self.receive(alice, 'error')
+        self.assertEqual(error, {'type': 'error', 'error': 'Message is missing', 'stream': stream})
+        await self.close(alice)
+
+
+class PresenceTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        presence.tick = 0.05
+
+    def tearDown(self):
+        presence.tick = PRESENCE_TICK
+
+    async def presence_frame(self, communicator):
+        # The next presence frame that says something, snapshots and ticks alike
+        while True:
+            frame = await self.receive(communicator, 'presence')
+            if frame['online'] or frame['offline'] or frame['typing'] or frame['idle']:
+                return frame
+
+    @async_to_sync
+    async def test_online_and_offline(self):
+        first, second, bob = await self.connect(self.alice), await self.connect(self.alice), await self.connect(self.bob)
+        stream = (await self.subscribe(first, room='General'))[0]['stream']
+        await self.subscribe(second, room='General')
+        await self.subscribe(bob, room='General')
+        self.assertEqual(presence.places[('room', self.room.id)].members['alice'].connections, 2)
+        self.assertEqual((await self.presence_frame(bob))['online'], ['alice', 'bob'])
+
+        # Alice is online while one of her sockets still shows the room
+        await first.send_json_to({'type': 'unsubscribe', 'stream': stream})
+        await self.receive(first, 'unsubscribed')
+        await second.send_json_to({'type': 'typing', 'stream': stream})
+        frame = await self.presence_frame(bob)
+        self.assertEqual((frame['typing'], frame['offline']), (['alice'], []))
+
+        await second.disconnect()
+        frame = await self.presence_frame(bob)
+        self.assertEqual((frame['offline'], frame['typing']), (['alice'], []))
+        await self.close(first, bob)
+
+
+class PresenceExpiryTests(SimpleTestCase):
+    @async_to_sync
+    async def test_members_and_typing_expire(self):
+        tracker = Presence(tick=3600, ttl=60, typing_ttl=5)
+        key = ('room', 1)
+        tracker.join(key, 'chat_General', 'room:General', 'alice')
+        tracker.join(key, 'chat_General', 'room:General', 'bob')
+        tracker.typing(key, 'chat_General', 'room:General', 'alice')
+        place = tracker.places[key]
+        now = time.monotonic()
+        frame = tracker._frame(place, now)
+        self.assertEqual((frame['online'], frame['typing']), (['alice', 'bob'], ['alice']))
+        self.assertIsNone(tracker._frame(place, now))
+
+        # Typing stops after typing_ttl, members without a heartbeat leave after ttl
+        place.members['alice'].seen = now + 30
+        frame = tracker._frame(place, now + 10)
+        self.assertEqual((frame['idle'], frame['offline']), (['alice'], []))
+        frame = tracker._frame(place, now + 61)
+        self.assertEqual(frame['offline'], ['bob'])
+        self.assertEqual(sorted(place.members), ['alice'])
+        tracker._task.cancel()
+
+
+class FlowControlTests(ConsumerTestCase):
+    @async_to_sync
+    async def test_malformed_frames_keep_the_socket(self):
+        alice = await self.connect(self.alice)
+        for frame in (
+            {'type': 'message', 'stream': ['x'], 'message': 'hi'},
+            {'type': 'subscribe', 'room': {'a': 1}},
+            {'type': ['message']},
+            ['not', 'a', 'dict'],
+        ):
+            await alice.send_json_to(frame)
+            self.assertEqual(await self.receive(alice, 'error'), {'type': 'error', 'error': 'Malformed frame'})
+        with self.assertLogs('chat.flow', 'ERROR'):
+            await alice.send_to(text_data='{not json')
+            self.assertEqual((await self.receive(alice, 'error'))['error'], 'Malformed frame')
+        self.assertEqual(flow.drops['malformed'] - self.malformed, 5)
+
+        subscribed, _ = await self.subscribe(alice, room='General')
+        self.assertEqual(subscribed['stream'], 'room:General')
+        await self.close(alice)
+
+    @async_to_sync
+    async def test_frame_too_large(self):
+        alice = await self.connect(self.alice)
+        stream = (await self.subscribe(alice, room='General'))[0]['stream']
+        await alice.send_json_to({'type': 'message', 'stream': stream, 'message': 'x' * flow.MAX_FRAME_BYTES})
+        self.assertEqual((await self.receive(alice, 'error'))['error'], 'Frame too large')
+        await self.close(alice)
+
+    @async_to_sync
+    async def test_rate_limit_per_stream(self):
+        alice = await self.connect(self.alice)
+        room = (await self.subscribe(alice, room='General'))[0]['stream']
+        dm = (await self.subscribe(alice, dm='bob'))[0]['stream']
+        with mock.patch.object(flow, 'RATE_LIMIT', 0), mock.patch.object(flow, 'RATE_BURST', 2):
+            for i in range(2):
+                await self.send_message(alice, room, f'hello {i}')
+            await alice.send_json_to({'type': 'message', 'stream': room, 'message': 'one too many'})
+            self.assertEqual(await self.receive(alice, 'error'), {
+                'type': 'error', 'error': 'Rate limit exceeded', 'stream': room,
+            })
+            # Other streams and free frames aren't charged to it
+            await self.send_message(alice, dm, 'still fine')
+            await alice.send_json_to({'type': 'typing', 'stream': room})
+            self.assertTrue(await alice.receive_nothing(timeout=0.1))
+        await self.close(alice)
+
+    def setUp(self):
+        super().setUp()
+        flow._buckets.clear()
+        self.malformed = flow.drops['malformed']
+
+
+class StalledSocket:
+    # Stands in for AsyncWebsocketConsumer: the client never reads, so every send after the first waits forever
+    channel_name = 'test!stalled'
+    scope = {}
+
+    def __init__(self):
+        self.written = []
+        self.closed = None
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.written.append(text_data)
+        await asyncio.Event().wait()
+
+    async def close(self, code=None):
+        self.closed = code
+
+
+class StalledClient(flow.FlowControlMixin, StalledSocket):
+    pass
+
+
+class EvictionTests(SimpleTestCase):
+    @async_to_sync
+    async def test_full_queue_evicts(self):
+        client = StalledClient()
+        with mock.patch.object(flow, 'SEND_QUEUE_SIZE', 3):
+            for i in range(6):
+                await client.send(text_data=f'frame {i}')
+                await asyncio.sleep(0)
+        self.assertEqual(client.closed, flow.CLOSE_TOO_SLOW)
+        self.assertTrue(client.evicted)
+        self.assertEqual(client.written, ['frame 0'])
+        client.writer.cancel()
+
+    @async_to_sync
+    async def test_unsent_bytes_evict(self):
+        client = StalledClient()
+        client.transport = SimpleNamespace(dataBuffer=b'x' * (flow.SEND_BUFFER_BYTES + 1), offset=0, _tempDataLen=0)
+        await client.send(text_data='frame')
+        self.assertEqual(client.closed, flow.CLOSE_TOO_SLOW)
+
+    def test_transport_needs_buffer_attributes(self):
+        transport = SimpleNamespace(dataBuffer=b'', offset=0, _tempDataLen=0)
+        self.assertIs(flow.transport_of(partial(print, SimpleNamespace(transport=transport))), transport)
+        del transport._tempDataLen
+        self.assertIsNone(flow.transport_of(partial(print, SimpleNamespace(transport=transport))))
+        self.assertIsNone(flow.transport_of(print))
+
+
+class MessageTests(ConsumerTestCase):
+    @async_to_sync
+    async def test_seq_is_dense_per_stream(self):
+        alice = await self.connect(self.alice)
+        room, _ = await self.subscribe(alice, room='General')
+        dm, _ = await self.subscribe(alice, dm='bob')
+        seqs = [(await self.send_message(alice, room['stream'], f'room {i}'))['seq'] for i in range(5)]
+        dm_seqs = [(await self.send_message(alice, dm['stream'], f'dm {i}'))['seq'] for i in range(3)]
+        self.assertEqual(seqs, [1, 2, 3, 4, 5])
+        self.assertEqual(dm_seqs, [1, 2, 3])
+        await self.close(alice)
+        self.assertEqual(
+            await database(lambda: list(Message.objects.order_by('seq').values_list('seq', flat=True))),
+            [1, 2, 3, 4, 5],
+        )
+
+    @async_to_sync
+    async def test_retried_client_id_is_sent_once(self):
+        alice = await self.connect(self.alice)
+        stream = (await self.subscribe(alice, room='General'))[0]['stream']
+        first = await self.send_message(alice, stream, 'once', client_id='c-1')
+        again = await self.send_message(alice, stream, 'once', client_id='c-1', retry=True)
+        self.assertEqual(again['message_id'], first['message_id'])
+        self.assertEqual(again['client_id'], 'c-1')
+        await self.close(alice)
+        self.assertEqual(await database(Message.objects.count), 1)
+
+    @async_to_sync
+    async def test_retry_after_restart_gets_stored_copy(self):
+        # Another process, or this one after a restart, doesn't remember the
+        # client_id, the stored row answers the retry
+        alice, bob = await self.connect(self.alice), await self.connect(self.bob)
+        stream = (await self.subscribe(alice, room='General'))[0]['stream']
+        await self.subscribe(bob, room='General')
+        first = await self.send_message(alice, stream, 'once', client_id='c-2')
+        await self.receive(bob, 'message_created')
+        await write_behind.flush()
+        recent_keys.keys.clear()
+
+        again = await self.send_message(alice, stream, 'once', client_id='c-2', retry=True)
+        self.assertEqual((again['message_id'], again['seq']), (first['message_id'], first['seq']))
+        # Only the sender hears about it again
+        self.assertTrue(await bob.receive_nothing(timeout=0.2))
+        await self.close(alice, bob)
+        self.assertEqual(await database(Message.objects.count), 1)
+
+    @async_to_sync
+    async def test_client_ids_are_per_sender(self):
+        alice, bob = await self.connect(self.alice), await self.connect(self.bob)
+        stream = (await self.subscribe(alice, room='General'))[0]['stream']
+        await self.subscribe(bob, room='General')
+        first = await self.send_message(alice, stream, 'mine', client_id='same')
+        await self.receive(bob, 'message_created')
+        other = await self.send_message(bob, stream, 'yours', client_id='same', retry=True)
+        self.assertNotEqual(other['message_id'], first['message_id'])
+        await self.close(alice, bob)
+        self.assertEqual(await database(Message.objects.count), 2)
+
+
+class UnnumberedHistoryTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        # Saved before messages had numbers: bulk_create skips the pre_save handler
+        Message.objects.bulk_create(
+            Message(room=self.room, username='Alice', message=f'old {i}', seq=None) for i in range(3)
+        )
+        Message.objects.create(room=self.room, username='Bob', message='new', seq=1)
+
+    @async_to_sync
+    async def test_history_numbers_older_rows(self):
+        alice = await self.connect(self.alice)
+        _, history = await self.subscribe(alice, room='General')
+        self.assertEqual([m['message'] for m in history['messages']], ['old 0', 'old 1', 'old 2', 'new'])
+        self.assertEqual([m['seq'] for m in history['messages']], [-2, -1, 0, 1])
+        self.assertEqual(history['cursor'], {'seq': -2})
+        self.assertFalse(await database(Message.objects.filter(seq__isnull=True).exists))
+
+        sent = await self.send_message(alice, history['stream'], 'newer')
+        self.assertEqual(sent['seq'], 2)
+        await self.close(alice)
+
+    @async_to_sync
+    async def test_pages_reach_older_rows(self):
+        with mock.patch('chat.history.HISTORY_PAGE_SIZE', 2), mock.patch('chat.access.PER_ROOM', 2):
+            alice = await self.connect(self.alice)
+            _, history = await self.subscribe(alice, room='General')
+            self.assertEqual([m['message'] for m in history['messages']], ['old 2', 'new'])
+            await alice.send_json_to({'type': 'load_older', 'stream': history['stream'], 'before': history['cursor']})
+            older = await self.receive(alice, 'older_history')
+        self.assertEqual([m['message'] for m in older['messages']], ['old 0', 'old 1'])
+        self.assertFalse(older['has_more'])
+        await self.close(alice)
+
+
+class SerializationTests(SimpleTestCase):
+    def test_history_is_packed_as_columns(self):
+        messages = [
+            {'message_id': 1, 'username': 'alice', 'seq': 1},
+            {'message_id': 2, 'username': 'bob', 'client_id': 'c'},
+        ]
+        frame = {'type': 'history', 'messages': messages, 'has_more': False}
+        self.assertEqual(serialization.unpack(serialization.pack(frame)), {
+            'type': 'history', 'has_more': False, 'columns': {
+                'message_id': [1, 2], 'username': ['alice', 'bob'], 'seq': [1, None], 'client_id': [None, 'c'],
+            },
+        })
+        self.assertEqual(frame['messages'], messages)
+        # Live events keep their shape
+        created = {'type': 'message_created', 'message': messages[0]}
+        self.assertEqual(serialization.unpack(serialization.pack_text(serialization.dumps(created))), created)
+
+
+class MessagePackTests(ConsumerTestCase):
+    async def receive_packed(self, communicator, *types):
+        while True:
+            frame = serialization.unpack(await communicator.receive_from(timeout=5))
+            if frame['type'] in types:
+                return frame
+
+    @async_to_sync
+    async def test_binary_frames_both_ways(self):
+        bob = await self.connect(self.bob)
+        stream = (await self.subscribe(bob, room='General'))[0]['stream']
+        await self.send_message(bob, stream, 'hello')
+
+        alice = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), '/ws/stream/', subprotocols=[serialization.MSGPACK_SUBPROTOCOL],
+        )
+        alice.scope['user'] = self.alice
+        self.assertEqual(await alice.connect(), (True, serialization.MSGPACK_SUBPROTOCOL))
+        await alice.send_to(bytes_data=serialization.pack({'type': 'subscribe', 'room': 'General'}))
+        history = await self.receive_packed(alice, 'history')
+        self.assertNotIn('messages', history)
+        self.assertEqual(history['columns']['message'], ['hello'])
+
+        # JSON text still works, and live events from JSON clients arrive packed
+        await alice.send_to(text_data=serialization.dumps({'type': 'message', 'stream': stream, 'message': 'hi'}))
+        self.assertEqual((await self.receive_packed(alice, 'message_created'))['message']['message'], 'hi')
+        await self.send_message(bob, stream, 'bye')
+        self.assertEqual((await self.receive_packed(alice, 'message_created'))['message']['message'], 'bye')
+        await self.close(alice, bob)
+
+    @async_to_sync
+    async def test_binary_frames_need_the_subprotocol(self):
+        alice = await self.connect(self.alice)
+        await alice.send_to(bytes_data=serialization.pack({'type': 'subscribe', 'room': 'General'}))
+        self.assertIn(serialization.MSGPACK_SUBPROTOCOL, (await self.receive(alice, 'error'))['error'])
+        await self.close(alice)
+
+
+class ResumeTests(ConsumerTestCase):
+    @async_to_sync
+    async def test_resume_sends_only_changes(self):
+        alice = await self.connect(self.alice)
+        subscribed, history = await self.subscribe(alice, room='General')
+        stream = subscribed['stream']
+        sent = [await self.send_message(alice, stream, f'hello {i}') for i in range(4)]
+        await alice.send_json_to({'type': 'delete', 'stream': stream, 'message_id': sent[1]['message_id']})
+        await self.receive(alice, 'message_deleted')
+        await self.close(alice)
+
+        for user in (self.alice, self.bob):
+            # From the database once nobody is subscribed, then from the hot history
+            other = await self.connect(user)
+            _, resumed = await self.subscribe(
+                other, room='General', resume={'seq': sent[0]['seq'], 'synced': history['synced']},
+            )
+            self.assertEqual(resumed['type'], 'resumed')
+            self.assertEqual([m['message'] for m in resumed['messages']], ['hello 2', 'hello 3'])
+            self.assertEqual(resumed['deleted'], [sent[1]['message_id']])
+        await self.close(other)
+
+    @async_to_sync
+    async def test_bad_resume_gets_history(self):
+        alice = await self.connect(self.alice)
+        _, history = await self.subscribe(alice, room='General', resume={'seq': 'x'})
+        self.assertEqual(history['type'], 'history')
+        _, history = await self.subscribe(alice, room='General', resume={'seq': 1, 'synced': 0})
+        self.assertEqual(history['type'], 'history')
+        await self.close(alice)
+
+
+class ReadTests(ConsumerTestCase):
+    @async_to_sync
+    async def test_receipts_name_only_messages_of_the_room(self):
+        alice, bob = await self.connect(self.alice), await self.connect(self.bob)
+        stream = (await self.subscribe(alice, room='General'))[0]['stream']
+        await self.subscribe(bob, room='General')
+        sent = await self.send_message(alice, stream, 'read me')
+        await self.receive(bob, 'message_created')
+
+        with mock.patch.object(receipts, 'interval', 0.1):
+            # An id from elsewhere moves the cursor in memory but gets no receipt
+            await bob.send_json_to({'type': 'read', 'stream': stream, 'message_id': sent['message_id'] + 100})
+            self.assertTrue(await alice.receive_nothing(timeout=0.3))
+            await bob.send_json_to({
+                'type': 'read', 'stream': stream, 'message_id': sent['message_id'], 'timestamp': sent['timestamp'],
+            })
+            frame = await self.receive(alice, 'read_receipts')
+        self.assertEqual(frame, {'type': 'read_receipts', 'stream': stream, 'readers': {'bob': sent['message_id']}})
+
+        await read_cursors.flush()
+        self.assertEqual(
+            await database(lambda: list(ReadCursor.objects.values_list('user_id', 'key', 'message_id'))),
+            [(self.bob.id, f'room:{self.room.id}', sent['message_id'])],
+        )
+        await self.close(alice, bob)
+
+    @async_to_sync
+    async def test_reading_a_conversation_updates_unread(self):
+        alice, bob = await self.connect(self.alice), await self.connect(self.bob)
+        stream = (await self.subscribe(alice, dm='bob'))[0]['stream']
+        sent = [await self.send_message(alice, stream, f'hi {i}') for i in range(3)]
+        await self.subscribe(bob, dm='alice')
+        await bob.send_json_to({
+            'type': 'read', 'stream': stream, 'message_id': sent[1]['message_id'], 'timestamp': sent[1]['timestamp'],
+        })
+        await self.receive(alice, 'read_receipts')
+        # An older report doesn't move the cursor back
+        history_key = ('dm', DirectMessage.conversation_key(self.alice, self.bob))
+        self.assertFalse(read_cursors.mark(self.bob.id, history_key, sent[0]['message_id'], sent[0]['timestamp']))
+
+        await read_cursors.flush()
+        unread = await database(lambda: Conversation.objects.get(user=self.bob).unread)
+        self.assertEqual(unread, 1)
+        await self.close(alice, bob)
+
+
+class WriteBehindQueueTests(ConsumerTestCase):
+    @async_to_sync
+    async def test_rows_are_written_on_flush(self):
+        rows = [await write_behind.add(Message, room_id=self.room.id, username='Alice', message=f'm{i}') for i in range(3)]
+        self.assertEqual(await database(Message.objects.count), 0)
+        await write_behind.flush()
+        self.assertEqual(
+            await database(lambda: list(Message.objects.order_by('id').values_list('id', flat=True))),
+            [row.id for row in rows],
+        )
+
+    @async_to_sync
+    async def test_failed_rows_are_retried(self):
+        missing = self.room.id + 100
+        row = await write_behind.add(Message, room_id=missing, username='Alice', message='no room yet')
+        with self.assertLogs('chat.writebehind', 'ERROR'):
+            await write_behind.flush()
+        self.assertEqual(write_behind.failed, [row])
+
+        await database(lambda: Room.objects.create(id=missing, name='Late'))
+        with self.assertLogs('chat.writebehind', 'WARNING') as logs:
+            await write_behind.retry_failed()
+        self.assertIn("Retrying 1 rows", logs.output[0])
+        self.assertEqual(write_behind.failed, [])
+        self.assertTrue(await database(Message.objects.filter(id=row.id).exists))
+
+    @async_to_sync
+    async def test_run_reads_queued_rows(self):
+        row = await write_behind.add(Message, room_id=self.room.id, username='Alice', message='queued')
+        self.assertTrue(await write_behind.run(Message.objects.filter(id=row.id).exists))
+        self.assertEqual(write_behind.pending, [])
+
+
+class UnixSocketLayerTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.TemporaryDirectory()
+        self.addCleanup(self.path.cleanup)
+
+    def layer(self, **kwargs):
+        return UnixSocketChannelLayer(path=self.path.name, **kwargs)
+
+    @async_to_sync
+    async def test_group_send_reaches_other_workers(self):
+        first, second = self.layer(), self.layer()
+        here, there = await first.new_channel(), await second.new_channel()
+        await first.group_add('chat_General', here)
+        await second.group_add('chat_General', there)
+        await first.group_send('chat_General', {'type': 'chat.message', 'text': 'hi'})
+        for layer, channel in ((first, here), (second, there)):
+            message = await asyncio.wait_for(layer.receive(channel), 5)
+            self.assertEqual(message['text'], 'hi')
+            self.assertIn('sent_at', message)
+        self.assertEqual(first.group_sizes(), {'chat_General': 2})
+
+        await second.group_discard('chat_General', there)
+        await first.group_send('chat_General', {'type': 'chat.message', 'text': 'again'})
+        self.assertEqual((await first.receive(here))['text'], 'again')
+        self.assertEqual(second.queued, 0)
+        await first.close()
+        await second.close()
+
+    @async_to_sync
+    async def test_exited_worker_loses_its_groups(self):
+        first, second = self.layer(), self.layer()
+        gone = await second.new_channel()
+        await second.group_add('chat_General', gone)
+        await second.close()
+        # As if the worker had died without close(): the first failed delivery purges its memberships
+        await first.group_add('chat_General', gone)
+        await first.group_send('chat_General', {'type': 'chat.message'})
+        self.assertEqual(first.group_sizes(), {})
+        await first.close()
+
+    @async_to_sync
+    async def test_full_channel(self):
+        layer = self.layer(capacity=2)
+        channel = await layer.new_channel()
+        await layer.group_add('chat_General', channel)
+        for i in range(2):
+            await layer.send(channel, {'type': 'chat.message', 'n': i})
+        with self.assertRaises(ChannelFull):
+            await layer.send(channel, {'type': 'chat.message'})
+        # group_send drops instead, like InMemoryChannelLayer
+        await layer.group_send('chat_General', {'type': 'chat.message'})
+        self.assertEqual((layer.dropped, layer.queued), (1, 2))
+        self.assertEqual((await layer.receive(channel))['n'], 0)
+        await layer.close()
@@ -9,6 +9,9 @@ urlpatterns = [
     path("index/", views.index, name="index"),
     path("room/", views.room, name="room"),  # Remove the room_name parameter
     path("direct_messages/", views.direct_messages, name="direct_messages"),
+    path("conversations/", views.conversations, name="conversations"),
+    path("search/", views.search, name="search"),
+    path("metrics/", views.metrics, name="metrics"),
     path('invite/<str:room_name>/', views.invite_to_room, name='invite_to_room'),
     path('remove/<str:room_name>/', views.remove_room, name='remove_room'),
     path('remove/<str:room_name>/<str:username>/', views.remove_user_from_room, name='remove_user_from_room'),
@@ -1,10 +1,19 @@
 # ChatApp/chat/views.py
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Q
 from django.urls import reverse
-from chat.models import Room, DirectMessage
+from chat.models import Room
+from chat import rooms as room_service
+from chat.conversations import conversation_page
+from chat.history import parse_cursor, retention_cutoff
+from chat.models import DirectMessage
+from chat import metrics as metrics_service
+from chat import search as search_service
 from users.models import User  
 
 def is_pro_user(user):
@@ -25,9 +34,8 @@ def index(request):
 
 def remove_room(request, room_name):
     room_name = request.GET.get('room_name')
-    try:
-        room = Room.objects.get(name=room_name)
-    except Room.DoesNotExist:
+    room = room_service.get_room(room_name)
+    if room is None:
         messages.error(request, "Room does not exist.")
         return redirect('chat:index')
     
@@ -41,13 +49,12 @@ def remove_room(request, room_name):
 
 def room(request):
     room_name = request.GET.get('room_name')
-    try:
-        room = Room.objects.get(name=room_name)
-    except Room.DoesNotExist:
+    room = room_service.get_room(room_name)
+    if room is None:
         messages.error(request, f"{room_name} does not exist.")
         return redirect('chat:index')
 
-    if request.user not in room.users.all():
+    if not room_service.is_member(room, request.user):
         messages.error(request, "You do not have access to this room.")
         return redirect('chat:index')
 
@@ -61,16 +68,15 @@ def room(request):
     })
 
 def remove_user_from_room(request, room_name, username):
-    try:
-        room = Room.objects.get(name=room_name)
-    except Room.DoesNotExist:
+    room = room_service.get_room(room_name)
+    if room is None:
         messages.error(request, "Room does not exist.")
         return redirect('chat:index')
     
     user_to_remove = get_object_or_404(User, username=username)
 
     if request.method == 'POST' and is_pro_user(request.user):
-        if user_to_remove in room.users.all():
+        if room_service.is_member(room, user_to_remove):
             room.users.remove(user_to_remove)
             messages.success(request, f"{username.capitalize()} has been removed from {room_name}.")
         else:
@@ -81,9 +87,8 @@ def remove_user_from_room(request, room_name, username):
     return redirect(reverse('chat:room') + f'?room_name={room_name}')
 
 def invite_to_room(request, room_name):
-    try:
-        room = Room.objects.get(name=room_name)
-    except Room.DoesNotExist:
+    room = room_service.get_room(room_name)
+    if room is None:
         messages.error(request, "Room does not exist.")
         return redirect('chat:index')
   
@@ -93,7 +98,6 @@ def invite_to_room(request, room_name):
 
         if user_to_invite:
             if request.user.user_type == 'pro':
-                room = Room.objects.get(name=room_name)
                 room.users.add(user_to_invite)
                 messages.success(request, f"{username.capitalize()} has been invited to {room_name}.")
             else:
@@ -110,19 +114,69 @@ def direct_messages(request):
     receiver_username = request.GET.get('receiver')
     receiver = User.objects.filter(username=receiver_username).first() if receiver_username else None
 
-    users = User.objects.exclude(id=request.user.id)
-    messages = DirectMessage.objects.filter(
-        Q(sender=request.user, receiver=receiver) | Q(receiver=request.user, sender=receiver)
-    ).order_by('timestamp') if receiver else []
-
+    # The sidebar comes from the conversations endpoint and the thread from the socket
     emoji_list = ['😀', '😂', '❤️', '👍', '🎉', '😎', '🥳', '😢', '🔥', '🎈']
 
     return render(request, "chat/direct_messages.html", {
-        "messages": messages,
-        "users": users,
         "current_receiver": receiver,
         'emoji_list': emoji_list,
     })
 
+def conversations(request):
+    # Sidebar page: ?before=<timestamp>&before_id=<id> from the previous page's cursor
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Not logged in"}, status=401)
+
+    before = None
+    if request.GET.get('before'):
+        before = parse_cursor({"timestamp": request.GET['before'], "message_id": request.GET.get('before_id')})
+    try:
+        limit = int(request.GET.get('limit', 0))
+    except ValueError:
+        limit = 0
+
+    items, cursor, has_more = conversation_page(request.user, before, limit)
+    return JsonResponse({"conversations": items, "cursor": cursor, "has_more": has_more})
+
+def search(request):
+    # ?q=<words>[&room=<name>|&dm=<username>][&cursor=<cursor of the previous page>]
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Not logged in"}, status=401)
+    if not search_service.available():
+        return JsonResponse({"error": "Search is not available on this database"}, status=501)
+
+    room = conversation = None
+    if request.GET.get('room'):
+        room = room_service.get_room(request.GET['room'])
+        if room is None or not room_service.is_member(room, request.user):
+            return JsonResponse({"error": "No such room"}, status=404)
+    elif request.GET.get('dm'):
+        peer = User.objects.filter(username=request.GET['dm']).first()
+        if peer is None:
+            return JsonResponse({"error": "No such user"}, status=404)
+        conversation = DirectMessage.conversation_key(request.user, peer)
+    try:
+        limit = int(request.GET.get('limit', 0))
+    except ValueError:
+        limit = 0
+
+    results, cursor, has_more = search_service.search(
+        request.user, request.GET.get('q', ''), room=room, conversation=conversation,
+        cutoff=retention_cutoff(request.user), after=search_service.parse_cursor(request.GET.get('cursor')),
+        limit=limit,
+    )
+    return JsonResponse({"results": results, "cursor": cursor, "has_more": has_more})
+
+def metrics(request):
+    # Prometheus text format, for staff or a scraper sending "Authorization: Bearer <CHAT_METRICS_TOKEN>"
+    token = getattr(settings, 'CHAT_METRICS_TOKEN', None)
+    bearer = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not request.user.is_staff and not (token and hmac.compare_digest(bearer, token)):
+        return JsonResponse({"error": "Not allowed"}, status=403)
+
+    snapshot = metrics_service.registry.collect()
+    snapshot.update(metrics_service.shared())
+    return HttpResponse(metrics_service.render(snapshot), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 def handle_unknown_url(request, any_path):
     return redirect('users:dashboard')
\ No newline at end of file
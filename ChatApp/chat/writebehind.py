@@ -0,0 +1,212 @@
+# chat/writebehind.py
+import asyncio
+import contextvars
+import atexit
+import logging
+
+from . import metrics
+from .db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.dispatch import Signal
+
+from .idempotency import stored_copy
+from .models import IdBlock
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = getattr(settings, 'CHAT_WRITE_BATCH_SIZE', 100)
+FLUSH_INTERVAL = getattr(settings, 'CHAT_WRITE_FLUSH_INTERVAL', 0.05)
+ID_BLOCK_SIZE = getattr(settings, 'CHAT_ID_BLOCK_SIZE', 1000)
+RETRY_INTERVAL = getattr(settings, 'CHAT_WRITE_RETRY_INTERVAL', 1.0)
+
+# Sent with sender=<model> and objs=<rows> inside the transaction that
+# bulk-inserted them, since bulk_create doesn't send post_save
+rows_written = Signal()
+
+
+def reserve_ids(model, count):
+    """
+    Reserve `count` consecutive primary keys for `model` and return them as a
+    range. Blocks never overlap between processes and always start above the
+    highest id already in the table. The database's own id counter is moved
+    past the block too, so rows inserted without the queue, e.g. from the
+    admin or Message.objects.create(), can't take one of its ids.
+    """
+    name = model._meta.label_lower
+    highest = Coalesce(Subquery(model.objects.order_by('-id').values('id')[:1]), Value(0))
+
+    with transaction.atomic():
+        IdBlock.objects.get_or_create(name=name)
+        # The UPDATE takes the write lock before we read the block back
+        IdBlock.objects.filter(name=name).update(next_id=Greatest(F('next_id'), highest + 1) + count)
+        end = IdBlock.objects.values_list('next_id', flat=True).get(name=name)
+        advance_id_counter(model, end - 1)
+    return range(end - count, end)
+
+
+def advance_id_counter(model, last_id):
+    # Make the table's autoincrement counter hand out ids above last_id
+    connection = transaction.get_connection()
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # Tables with an AUTOINCREMENT key get their row on the first insert
+            cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, %s) WHERE name = %s", [last_id, table])
+            if not cursor.rowcount:
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, last_id])
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                "GREATEST(%s, nextval(pg_get_serial_sequence(%s, 'id'))))",
+                [table, last_id, table],
+            )
+        else:
+            raise NotImplementedError(f"Reserving ids isn't supported on {connection.vendor}")
+
+
+class WriteBehindQueue:
+    """
+    Buffers new chat rows in memory and writes them with bulk_create once
+    BATCH_SIZE rows are waiting or FLUSH_INTERVAL seconds have passed.
+
+    Rows get their primary key up front from a reserved id block, so callers
+    can broadcast a message before it is written. A row that was broadcast
+    must not be lost, so rows that fail to insert are kept in `failed` and
+    retried every RETRY_INTERVAL seconds until they are written.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.failed = []
+        self.blocks = {}
+        self._timer = None
+        self._retry = None
+        self._lock = None
+        atexit.register(self.flush_sync)
+
+    async def add(self, model, **fields):
+        obj = model(id=await self._next_id(model), **fields)
+        self.pending.append(obj)
+        metrics.messages.labels(model._meta.model_name).inc()
+
+        # Flushes run outside the caller's measurement, they write everyone's rows
+        if len(self.pending) >= BATCH_SIZE:
+            asyncio.get_running_loop().call_soon(
+                lambda: asyncio.ensure_future(self.flush()), context=contextvars.Context()
+            )
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                FLUSH_INTERVAL, lambda: asyncio.ensure_future(self.flush()), context=contextvars.Context()
+            )
+        return obj
+
+    async def _next_id(self, model):
+        block = self.blocks.get(model)
+        if not block:
+            block = self.blocks[model] = iter(await database_sync_to_async(reserve_ids)(model, ID_BLOCK_SIZE))
+        try:
+            return next(block)
+        except StopIteration:
+            self.blocks.pop(model)
+            return await self._next_id(model)
+
+    async def flush(self):
+        # Waits for any flush already running, so callers can read their own writes
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch, self.pending = self.pending, []
+            if batch:
+                self._keep(await database_sync_to_async(self._write)(batch))
+
+    def _keep(self, failed):
+        if not failed:
+            return
+        self.failed.extend(failed)
+        if self._retry is None:
+            self._retry = asyncio.get_running_loop().call_later(
+                RETRY_INTERVAL, lambda: asyncio.ensure_future(self.retry_failed()), context=contextvars.Context()
+            )
+
+    async def retry_failed(self):
+        async with self._lock:
+            self._retry = None
+            batch, self.failed = self.failed, []
+            if batch:
+                logger.warning("Retrying %d rows that failed to write", len(batch))
+                self._keep(await database_sync_to_async(self._write)(batch))
+
+    async def run(self, func, *args):
+        """
+        Return func(*args), called on a database thread once everything
+        queued so far is written. Rows still queued are written in the same
+        call, so reading your own writes costs one hop instead of two.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        if not self.pending and not self._lock.locked():
+            return await database_sync_to_async(func)(*args)
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch, self.pending = self.pending, []
+            failed, result = await database_sync_to_async(self._write_then)(batch, func, args)
+            self._keep(failed)
+            return result
+
+    def _write_then(self, batch, func, args):
+        return self._write(batch) if batch else [], func(*args)
+
+    def flush_sync(self):
+        # Called at interpreter exit, after the event loop has stopped
+        batch, self.pending, self.failed = self.failed + self.pending, [], []
+        for obj in self._write(batch):
+            logger.error("Could not write %s %s before exiting", type(obj).__name__, obj.id)
+
+    def _write(self, batch):
+        # Returns the rows that couldn't be written
+        failed = []
+        by_model = {}
+        for obj in batch:
+            by_model.setdefault(type(obj), []).append(obj)
+
+        for model, objs in by_model.items():
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create(objs)
+                    rows_written.send(sender=model, objs=objs)
+            except Exception:
+                # Fall back to row by row so one bad row doesn't lose the batch
+                logger.exception("Bulk insert of %d %s rows failed", len(objs), model.__name__)
+                for obj in objs:
+                    try:
+                        # save() sends post_save itself
+                        obj.save(force_insert=True)
+                    except IntegrityError:
+                        if stored_copy(obj) is None:
+                            logger.exception("Could not write %s %s, will retry", model.__name__, obj.id)
+                            failed.append(obj)
+                        else:
+                            # A resend that reached another process first, see chat.idempotency
+                            logger.warning("Dropped %s %s, a copy of it is stored", model.__name__, obj.id)
+                    except Exception:
+                        logger.exception("Could not write %s %s, will retry", model.__name__, obj.id)
+                        failed.append(obj)
+        return failed
+
+
+write_behind = WriteBehindQueue()
+metrics.registry.callback(
+    'gauge', 'chat_write_behind_pending', "Rows waiting to be written.", lambda: {(): len(write_behind.pending)},
+)
+metrics.registry.callback(
+    'gauge', 'chat_write_behind_failed', "Rows that failed to write, waiting to be retried.",
+    lambda: {(): len(write_behind.failed)},
+)
@@ -0,0 +1,50 @@
+# users/directory.py
+# Username prefix lookups for the autocomplete endpoint and the user search.
+# Prefixes are matched against the indexed User.username_folded column with a
+# range scan, and results are cached per prefix for USER_AUTOCOMPLETE_TTL
+# seconds. The cache is cleared by users/signals.py when a user registers or
+# is renamed; other worker processes catch up when their entries expire.
+import time
+
+from django.conf import settings
+
+from .models import User
+
+AUTOCOMPLETE_LIMIT = getattr(settings, 'USER_AUTOCOMPLETE_LIMIT', 10)
+AUTOCOMPLETE_TTL = getattr(settings, 'USER_AUTOCOMPLETE_TTL', 10)
+MAX_LIMIT = 50
+MAX_CACHED_PREFIXES = 5000
+
+_prefixes = {}  # folded prefix -> (expires, usernames)
+
+
+def suggest(prefix, limit=None, exclude=None):
+    """
+    Return up to `limit` usernames starting with `prefix`, ignoring case and
+    leaving out `exclude` and staff accounts, in case-folded order.
+    """
+    limit = max(1, min(limit or AUTOCOMPLETE_LIMIT, MAX_LIMIT))
+    folded = (prefix or '').strip().casefold()
+    if not folded:
+        return []
+    usernames = [username for username in _lookup(folded) if username != exclude]
+    return usernames[:limit]
+
+
+def _lookup(folded):
+    entry = _prefixes.get(folded)
+    if entry is None or entry[0] < time.monotonic():
+        # One more than MAX_LIMIT so excluding the caller still fills a page
+        usernames = list(
+            User.objects.filter(
+                username_folded__gte=folded, username_folded__lt=folded + '\U0010ffff', is_staff=False,
+            ).order_by('username_folded').values_list('username', flat=True)[:MAX_LIMIT + 1]
+        )
+        if len(_prefixes) >= MAX_CACHED_PREFIXES:
+            _prefixes.clear()
+        entry = _prefixes[folded] = (time.monotonic() + AUTOCOMPLETE_TTL, usernames)
+    return entry[1]
+
+
+def invalidate():
+    _prefixes.clear()
@@ -0,0 +1,29 @@
+# users/management/commands/backfill_usernames.py
+from django.core.management.base import BaseCommand
+
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = "Fill in User.username_folded for users created or renamed before the column existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total = 0
+        batch = []
+        for user in User.objects.only('id', 'username', 'username_folded').order_by('id').iterator(chunk_size=batch_size):
+            # casefold() rather than the database's LOWER(), which leaves non-ASCII names alone on SQLite
+            if user.username_folded != user.username.casefold():
+                user.username_folded = user.username.casefold()
+                batch.append(user)
+            if len(batch) >= batch_size:
+                total += User.objects.bulk_update(batch, ['username_folded'])
+                batch = []
+                self.stdout.write(f"Backfilled {total} users")
+        if batch:
+            total += User.objects.bulk_update(batch, ['username_folded'])
+
+        self.stdout.write(self.style.SUCCESS(f"Done, {total} users updated."))
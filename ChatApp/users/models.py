@@ -9,4 +9,10 @@ class User(AbstractUser):
         ('pro', 'Pro User'),
     )
 
-    user_type = models.CharField(max_length=10, choices=USER_TYPE, default='basic')
\ No newline at end of file
+    user_type = models.CharField(max_length=10, choices=USER_TYPE, default='basic')
+    # Case-folded copy of username, indexed for prefix lookups (see users/directory.py)
+    username_folded = models.CharField(max_length=150, db_index=True, editable=False, default='')
+
+    def save(self, *args, **kwargs):
+        self.username_folded = self.username.casefold()
+        super().save(*args, **kwargs)
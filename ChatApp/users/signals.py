@@ -0,0 +1,18 @@
+# users/signals.py
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import directory
+from .models import User
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    # Logins save last_login only, they don't change what autocomplete shows
+    if created or update_fields is None or {'username', 'is_staff'} & set(update_fields):
+        directory.invalidate()
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    directory.invalidate()
@@ -1,3 +1,43 @@
+# users/tests.py
 from django.test import TestCase
+from django.urls import reverse
 
-# Create your tests here.
+from . import directory
+from .models import User
+
+
+class AutocompleteTests(TestCase):
+    def setUp(self):
+        directory.invalidate()
+        self.alice = User.objects.create_user('alice', password='secret')
+        for username in ('Albert', 'alfred', 'bob'):
+            User.objects.create_user(username, password='secret')
+        User.objects.create_user('alex', password='secret', is_staff=True)
+        self.client.force_login(self.alice)
+
+    def suggest(self, **params):
+        return self.client.get(reverse('users:autocomplete'), params).json()['users']
+
+    def test_prefix_ignores_case_and_leaves_out_caller_and_staff(self):
+        self.assertEqual(self.suggest(q='AL'), ['Albert', 'alfred'])
+        self.assertEqual(self.suggest(q='al', limit=1), ['Albert'])
+        self.assertEqual(self.suggest(q='  '), [])
+        self.assertEqual(self.suggest(q='al', limit='many'), ['Albert', 'alfred'])
+
+    def test_needs_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('users:autocomplete'), {'q': 'al'}).status_code, 401)
+
+    def test_prefixes_are_cached_until_users_change(self):
+        self.suggest(q='al')
+        with self.assertNumQueries(0):
+            self.assertEqual(directory.suggest('al', exclude='alice'), ['Albert', 'alfred'])
+
+        # A login only saves last_login and keeps the cache
+        bob = User.objects.get(username='bob')
+        bob.save(update_fields=['last_login'])
+        self.assertIn('al', directory._prefixes)
+
+        bob.username = 'Alvin'
+        bob.save()
+        self.assertEqual(directory.suggest('al', exclude='alice'), ['Albert', 'alfred', 'Alvin'])
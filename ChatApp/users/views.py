@@ -1,10 +1,13 @@
 # users/views.py
 
 from django.contrib.auth import login
-from users.models import User  
+from django.http import JsonResponse
 from django.shortcuts import redirect, render
 from django.urls import reverse
 from users.forms import CustomUserCreationForm
+from users import directory
+
+SEARCH_LIMIT = 50
 
 def dashboard(request):
     return render(request, "users/dashboard.html")
@@ -30,12 +33,23 @@ def register(request):
 def search_users(request):
     query = request.GET.get('query')
     if query:
-        # Filter users based on username (case-insensitive) excluding the logged-in user
-        users = User.objects.filter(username__icontains=query).exclude(username=request.user.username)
+        # Usernames starting with the query (case-insensitive) excluding the logged-in user
+        users = directory.suggest(query, SEARCH_LIMIT, exclude=request.user.username)
     else:
         users = []  # Empty list if no query
     context = {'users': users, 'query': query}
     return render(request, 'users/search_users.html', context)
 
+def autocomplete(request):
+    # ?q=<prefix>&limit=<n>, usernames for the invite form and the DM page
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Not logged in"}, status=401)
+    try:
+        limit = int(request.GET.get('limit', 0))
+    except ValueError:
+        limit = 0
+    usernames = directory.suggest(request.GET.get('q', ''), limit, exclude=request.user.username)
+    return JsonResponse({"users": usernames})
+
 def handle_unknown_url(request, any_path):
     return redirect('users:dashboard')
\ No newline at end of file